@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Simulates requests against a skewed set of replicas and compares the request
+latency percentiles of each balancer.
+
+One replica is ten times slower than its siblings for the middle part of the
+run (as if it were being vacuumed or backed up). The simulation uses its own
+clock, so it runs quickly and gives the same results each time.
+
+    python -m benchmarks.balancer
+
+"""
+import random
+
+from .common import percentile, report, setup
+
+setup(DATABASES={
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+})
+
+from multidb.balancer import EWMABalancer, RandomBalancer, RoundRobinBalancer  # noqa: E402
+
+REPLICAS = ['replica1', 'replica2', 'replica3', 'replica4']
+REQUESTS = 50000
+QUERIES_PER_REQUEST = 5
+REQUESTS_PER_SECOND = 500.0
+BASE_LATENCY = 0.002
+SLOW_FACTOR = 10
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def query_latency(alias, request_number, rng):
+    latency = rng.expovariate(1 / BASE_LATENCY)
+    slow_period = REQUESTS // 4 <= request_number < REQUESTS * 3 // 4
+    if alias == 'replica1' and slow_period:
+        latency *= SLOW_FACTOR
+    return latency
+
+
+def simulate(balancer, clock):
+    rng = random.Random(1234)
+    random.seed(1234)
+    latencies = []
+    for request_number in range(REQUESTS):
+        clock.now = request_number / REQUESTS_PER_SECOND
+        alias = balancer.choose(REPLICAS)
+        total = 0.0
+        for _ in range(QUERIES_PER_REQUEST):
+            elapsed = query_latency(alias, request_number, rng)
+            total += elapsed
+            clock.now += elapsed
+            balancer.observe(alias, elapsed)
+        latencies.append(total * 1000)
+    return latencies
+
+
+def main():
+    rows = []
+    for name, make_balancer in (
+        ('random', lambda clock: RandomBalancer()),
+        ('round-robin', lambda clock: RoundRobinBalancer()),
+        ('ewma-p2c', lambda clock: EWMABalancer(clock=clock)),
+    ):
+        clock = Clock()
+        latencies = simulate(make_balancer(clock), clock)
+        rows.append([name] + ['%.2f' % percentile(latencies, pct) for pct in (50, 90, 99, 99.9)])
+    report(
+        f'Request latency (ms), {len(REPLICAS)} replicas, one {SLOW_FACTOR}x slower for half the run',
+        rows,
+        ['balancer', 'p50', 'p90', 'p99', 'p99.9'],
+    )
+
+
+if __name__ == '__main__':
+    main()
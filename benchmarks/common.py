@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Shared helpers for the benchmark scripts. Each script is run directly from
+the repository root, e.g. python -m benchmarks.balancer
+
+"""
+import time
+
+import django
+from django.conf import settings
+
+
+def setup(**overrides):
+    """Configure Django with in-memory sqlite databases."""
+    options = {
+        'SECRET_KEY': 'benchmarks',
+        'INSTALLED_APPS': ['multidb', 'django.contrib.contenttypes'],
+        'DATABASES': {
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            },
+        },
+    }
+    options.update(overrides)
+    settings.configure(**options)
+    django.setup()
+
+
+def percentile(values, pct):
+    """Return the pct percentile of the values, using the nearest rank."""
+    ordered = sorted(values)
+    index = max(0, int(round(pct / 100.0 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def timeit(func, number):
+    """Return the average time taken by func in seconds."""
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+def report(title, rows, columns):
+    """Print a table of results."""
+    print(title)
+    widths = [max(len(str(column)), 12) for column in columns]
+    print('  '.join(str(column).ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)))
+    print()
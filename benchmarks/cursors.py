@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the per-statement overhead of the restricted cursor wrapper, over
+a cursor that does nothing, inside and outside of a request.
+
+"previous" is the implementation that classified every statement with a
+regex and looked up the database options and read-only mode each time
+(including the latency timing which both implementations do).
+
+    python -m benchmarks.cursors
+
+"""
+import logging
+import re
+import time
+
+from .common import report, setup, timeit
+
+setup(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+
+from django.db import connections  # noqa: E402
+
+from multidb.balancer import balancer  # noqa: E402
+from multidb.connection import connection_state  # noqa: E402
+from multidb.cursors import RestrictedCursorWrapper, RestrictedDatabaseError, get_sql_output  # noqa: E402
+from multidb.readonly import ReadOnlyError, read_only_mode  # noqa: E402
+
+STATEMENTS = 100000
+UPDATE_SQL = 'UPDATE "django_content_type" SET "model" = %s WHERE "django_content_type"."id" = %s'
+SQL = (
+    'SELECT "django_content_type"."id", "django_content_type"."app_label", '
+    '"django_content_type"."model" FROM "django_content_type" WHERE '
+    '("django_content_type"."app_label" = %s AND "django_content_type"."model" = %s) LIMIT 21'
+)
+
+
+class NullCursor(object):
+
+    rowcount = -1
+
+    def execute(self, sql, params=None):
+        pass
+
+
+class PreviousCursorWrapper(RestrictedCursorWrapper):
+
+    READ_SQL_RE = re.compile(r'\s*(SELECT|EXPLAIN|SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.IGNORECASE)
+
+    def execute(self, sql, params=()):
+        read_sql = bool(self.READ_SQL_RE.match(sql))
+
+        db_options = connections.databases[self.db.alias]
+        read_only_warning = db_options.get('READ_ONLY_WARNING')
+        read_only_database = db_options.get('READ_ONLY') or read_only_warning
+
+        if read_only_database:
+            if not read_sql:
+                if read_only_mode:
+                    raise ReadOnlyError
+                try:
+                    raise RestrictedDatabaseError(self.db.alias, get_sql_output(sql, params))
+                except RestrictedDatabaseError as error:
+                    if not read_only_warning:
+                        raise
+                    logging.warning('RestrictedDatabaseWarning: %s' % error)
+        elif not read_sql and read_only_mode:
+            raise ReadOnlyError
+
+        start = time.monotonic()
+        try:
+            result = self.cursor.execute(sql, params)
+        finally:
+            balancer.observe(self.db.alias, time.monotonic() - start)
+
+        if not read_sql:
+            connection_state.wrote = self.db.alias
+        return result
+
+
+def main():
+    db = connections['default']
+    params = ('contenttypes', 'contenttype')
+
+    rows = []
+    for kind, sql in (('SELECT', SQL), ('UPDATE', UPDATE_SQL)):
+        # Distinct string objects, as the ORM builds a new string for each query.
+        statements = [''.join([sql, ' ']) for _ in range(1000)]
+        for name, wrapper_class in (('previous', PreviousCursorWrapper), ('current', RestrictedCursorWrapper)):
+            for scope in ('request', 'no request'):
+                def func():
+                    cursor = wrapper_class(NullCursor(), db)
+                    for statement in statements:
+                        cursor.execute(statement, params)
+
+                if scope == 'request':
+                    connection_state.start_request()
+                per_statement = min(timeit(func, STATEMENTS // len(statements)) for _ in range(3)) / len(statements)
+                connection_state.end_request()
+                rows.append([kind, name, scope, '%.0f' % (per_statement * 1e9)])
+
+    report('Restricted cursor overhead per statement', rows, ['statement', 'wrapper', 'scope', 'ns/statement'])
+
+
+if __name__ == '__main__':
+    main()
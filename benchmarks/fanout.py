@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Compares running several independent queries one after another with running
+them concurrently with FanOut, as a dashboard page would. Each query calls
+a sleep() function registered with sqlite, which stands for the time spent
+waiting for a database server to run it.
+
+    python -m benchmarks.fanout
+
+"""
+import os
+import tempfile
+import time
+
+from .common import report, setup
+
+PATH = os.path.join(tempfile.mkdtemp(), 'fanout.sqlite3')
+
+setup(DATABASES={
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': PATH},
+})
+
+from django.db import connections  # noqa: E402
+from django.db.backends.signals import connection_created  # noqa: E402
+
+from multidb.connection import connection_state  # noqa: E402
+from multidb.fanout import FanOut  # noqa: E402
+from multidb.pool import TemporaryConnectionPool  # noqa: E402
+
+DURATIONS = (0.02, 0.04, 0.03, 0.01, 0.05, 0.02, 0.03, 0.06)
+ROUNDS = 3
+
+
+def add_sleep(connection, **kwargs):
+    connection.connection.create_function('sleep', 1, time.sleep)
+
+
+connection_created.connect(add_sleep)
+
+
+def query(duration):
+    def run():
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT sleep(%s)', [duration])
+            return cursor.fetchone()[0]
+    return run
+
+
+def best(func):
+    times = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    queries = [query(duration) for duration in DURATIONS]
+    pool = TemporaryConnectionPool('fanout', max_size=len(DURATIONS))
+    fan_out = FanOut(pool)
+    # Open the pool's connections before timing.
+    fan_out.gather(*queries)
+
+    with connection_state.force(None):
+        each = [best(run) for run in queries]
+        sequential = best(lambda: [run() for run in queries])
+    concurrent = best(lambda: fan_out.gather(*queries))
+    fan_out.close()
+    pool.close()
+
+    report(
+        f'{len(DURATIONS)} queries, best of {ROUNDS}',
+        [
+            ['sum of each', '%.1f' % (sum(each) * 1000)],
+            ['slowest one', '%.1f' % (max(each) * 1000)],
+            ['sequential', '%.1f' % (sequential * 1000)],
+            ['FanOut', '%.1f' % (concurrent * 1000)],
+        ],
+        ['', 'ms'],
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the time taken to find the databases for a request path, using the
+original loop over one regex per database and the compiled PathRouter (with
+and without its cache of recent paths).
+
+    python -m benchmarks.paths
+
+"""
+import random
+import re
+
+from .common import report, setup, timeit
+
+setup()
+
+from multidb.paths import PathRouter  # noqa: E402
+
+ALIASES = ['default', 'primary2', 'reports', 'search', 'archive']
+SEGMENTS = ['admin', 'api', 'account', 'orders', 'cart', 'reports', 'search', 'v1', 'v2', 'export']
+
+
+class LoopRouter(object):
+    """The original implementation: one regex search per database."""
+
+    def __init__(self, paths):
+        self.paths = {
+            alias: re.compile(r'^(%s)' % '|'.join(re.escape(path) for path in prefixes))
+            for alias, prefixes in paths.items()
+        }
+
+    def get_aliases(self, path):
+        db_aliases = []
+        for db_alias, paths_regex in self.paths.items():
+            if paths_regex.search(path):
+                db_aliases.append(db_alias)
+        return db_aliases
+
+
+def random_path(rng, depth):
+    return '/' + '/'.join(rng.choice(SEGMENTS) + str(rng.randint(0, 99)) for _ in range(depth)) + '/'
+
+
+def build_paths(rng, count):
+    paths = {alias: [] for alias in ALIASES}
+    for _ in range(count):
+        paths[rng.choice(ALIASES)].append(random_path(rng, rng.randint(1, 2)))
+    return paths
+
+
+def main():
+    rng = random.Random(1234)
+    rows = []
+    for count in (10, 100, 1000):
+        paths = build_paths(rng, count)
+        prefixes = [prefix for prefixes in paths.values() for prefix in prefixes]
+        # Half of the requests hit a configured prefix, half miss.
+        requests = [
+            rng.choice(prefixes) + 'detail/' if i % 2 else random_path(rng, 3)
+            for i in range(1000)
+        ]
+        loop_router = LoopRouter(paths)
+        uncached_router = PathRouter(paths, cache_size=0)
+        cached_router = PathRouter(paths)
+        for path in requests:
+            assert tuple(loop_router.get_aliases(path)) == uncached_router.get_aliases(path)
+
+        def run(router):
+            def func():
+                for path in requests:
+                    router.get_aliases(path)
+            return timeit(func, 20) / len(requests) * 1e6
+
+        rows.append([count, '%.2f' % run(loop_router), '%.2f' % run(uncached_router), '%.2f' % run(cached_router)])
+
+    report(
+        f'Microseconds per path lookup, prefixes spread over {len(ALIASES)} databases',
+        rows,
+        ['prefixes', 'loop', 'router', 'router+cache'],
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Compares TemporaryConnectionPool checkouts per second when connections are
+closed on release (the default) and when they are kept open for reuse. Each
+checkout runs one query against an sqlite database file.
+
+Connecting to sqlite is much cheaper than a TCP connection with TLS and
+authentication, so the difference is larger against a real server.
+
+    python -m benchmarks.pool
+
+"""
+import os
+import tempfile
+import threading
+import time
+
+from .common import report, setup
+
+PATH = os.path.join(tempfile.mkdtemp(), 'pool.sqlite3')
+
+setup(DATABASES={
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': PATH},
+})
+
+from django.db import connections  # noqa: E402
+
+from multidb.connection import connection_state  # noqa: E402
+from multidb.pool import TemporaryConnectionPool  # noqa: E402
+
+DURATION = 2.0
+
+
+def run(pool, threads):
+    counts = [0] * threads
+    stopped = threading.Event()
+
+    def worker(index):
+        while not stopped.is_set():
+            with pool.get() as alias, connection_state.force(alias):
+                with connections[alias].cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                    cursor.fetchone()
+            counts[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    time.sleep(DURATION)
+    stopped.set()
+    for thread in workers:
+        thread.join()
+    pool.close()
+    return sum(counts) / DURATION
+
+
+def main():
+    rows = []
+    for threads in (1, 8):
+        for mode, reuse in (('close', False), ('reuse', True)):
+            pool = TemporaryConnectionPool(f'bench_{mode}_{threads}_', max_size=4, reuse=reuse)
+            rows.append([mode, threads, '%.0f' % run(pool, threads)])
+    report(
+        f'TemporaryConnectionPool checkouts per second, max_size=4, {DURATION:.0f}s each',
+        rows,
+        ['mode', 'threads', 'checkouts/sec'],
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that TemporaryConnectionPool does not grow over many checkouts. The
+pool repeatedly bursts to several connections and is shrunk again by idle
+eviction, while the memory allocated by Python and the number of database
+aliases are sampled.
+
+    python -m benchmarks.pool_soak [checkouts] [close|reuse]
+
+"""
+import gc
+import sys
+import tracemalloc
+
+from .common import report, setup
+
+setup()
+
+from django.db import connections  # noqa: E402
+
+from multidb.pool import TemporaryConnectionPool  # noqa: E402
+
+CHECKOUTS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+MODE = sys.argv[2] if len(sys.argv) > 2 else 'reuse'
+BURST = 8
+SAMPLES = 10
+
+
+def main():
+    pool = TemporaryConnectionPool('soak', max_idle=0, reuse=MODE == 'reuse')
+    tracemalloc.start()
+    rows = []
+    done = 0
+    while done < CHECKOUTS:
+        # Grow the pool to BURST connections, then shrink it.
+        aliases = [pool.acquire() for _ in range(BURST)]
+        for alias in aliases:
+            pool.release(alias)
+        pool.evict_idle()
+        done += BURST
+        for _ in range(1000 - BURST):
+            with pool.get():
+                pass
+        done += 1000 - BURST
+        if done % (CHECKOUTS // SAMPLES) < 1000:
+            # Connection objects have reference cycles, so collect them first.
+            gc.collect()
+            current, peak = tracemalloc.get_traced_memory()
+            rows.append([done, '%.1f' % (current / 1024), len(connections.databases), pool.size])
+    report(
+        f'TemporaryConnectionPool memory over {CHECKOUTS} checkouts ({MODE} mode)',
+        rows,
+        ['checkouts', 'traced KiB', 'aliases', 'pool size'],
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Measures ORM queries per second against sqlite with and without the
+ConnectionProxy patched into the connection classes.
+
+"uncached proxy" is the previous implementation, which looked up the active
+connection on every attribute access (using the Local lookup that Django 3
+needs, since its connections are no longer stored in a dict).
+
+    python -m benchmarks.proxy
+
+"""
+from .common import report, setup
+
+setup()
+
+from django.contrib.contenttypes.models import ContentType  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connections  # noqa: E402
+from django.db.backends.base.base import BaseDatabaseWrapper  # noqa: E402
+
+from multidb.connection import ConnectionProxy, connection_state  # noqa: E402
+from .common import timeit  # noqa: E402
+
+QUERIES = 2000
+
+
+class UncachedConnectionProxy(object):
+
+    def __getattribute__(self, name):
+        alias = connection_state.alias
+        if alias and hasattr(connections._connections, alias):
+            connection = connections[alias]
+        else:
+            connection = self
+        return super(UncachedConnectionProxy, connection).__getattribute__(name)
+
+    def __setattr__(self, name, value):
+        alias = connection_state.alias
+        if alias and hasattr(connections._connections, alias):
+            connection = connections[alias]
+        else:
+            connection = self
+        return super(UncachedConnectionProxy, connection).__setattr__(name, value)
+
+
+def query():
+    list(ContentType.objects.filter(app_label='contenttypes')[:5])
+
+
+def main():
+    connection_class = connections['default'].__class__
+    call_command('migrate', verbosity=0)
+    query()
+
+    rows = []
+    for name, bases in (
+        ('no proxy', (BaseDatabaseWrapper,)),
+        ('uncached proxy', (UncachedConnectionProxy, BaseDatabaseWrapper)),
+        ('proxy', (ConnectionProxy, BaseDatabaseWrapper)),
+    ):
+        connection_class.__bases__ = bases
+        query()
+        per_query = min(timeit(query, QUERIES) for _ in range(5))
+        rows.append([name, '%d' % (1 / per_query), '%.1f' % (per_query * 1e6)])
+
+    report('ORM queries against sqlite', rows, ['connection', 'queries/s', 'us/query'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Measures SluggishCache under contention, as when every request thread checks
+read_only_mode. Threads read one key from a cache backend with a simulated
+network round trip, and the value expires locally many times during the run.
+
+The previous implementation, which let every thread that noticed an expired
+value go to the backend, is included for comparison.
+
+    python -m benchmarks.sluggish
+
+"""
+import threading
+import time
+
+from .common import report, setup
+
+setup()
+
+from multidb.cache.sluggish import SluggishCache  # noqa: E402
+
+DURATION = 2.0
+DELAY = 0.05
+BACKEND_LATENCY = 0.001
+
+
+class Backend(object):
+    """A cache backend that takes BACKEND_LATENCY to respond."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.gets = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get(self, key, default=None, version=None):
+        with self.lock:
+            self.gets += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(BACKEND_LATENCY)
+        with self.lock:
+            self.in_flight -= 1
+        return True
+
+    def set(self, key, value, timeout=None, version=None):
+        pass
+
+
+class UnguardedSluggishCache(object):
+    """The previous implementation of SluggishCache.get()."""
+
+    missed = object()
+
+    def __init__(self, cache, delay=15):
+        self.cache = cache
+        self.delay = delay
+        self._values = {}
+
+    def get(self, key, default=None, version=None):
+        now = time.time()
+        try:
+            value, expires = self._values[key]
+            if now > expires:
+                raise KeyError
+        except KeyError:
+            value = self.cache.get(key, self.missed, version=version)
+            self._values[key] = (value, now + self.delay)
+        return default if value is self.missed else value
+
+
+def run(name, cache_class, threads):
+    backend = Backend()
+    cache = cache_class(backend, delay=DELAY)
+    counts = [0] * threads
+    stopped = threading.Event()
+
+    def worker(index):
+        while not stopped.is_set():
+            cache.get('multidb.readonly')
+            counts[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    time.sleep(DURATION)
+    stopped.set()
+    for thread in workers:
+        thread.join()
+
+    expiries = DURATION / DELAY
+    return [
+        name,
+        threads,
+        '%.0f' % (sum(counts) / DURATION),
+        '%.1f' % (backend.gets / expiries),
+        backend.max_in_flight,
+    ]
+
+
+def main():
+    rows = []
+    for threads in (1, 8, 64):
+        for name, cache_class in (('unguarded', UnguardedSluggishCache), ('single-flight', SluggishCache)):
+            rows.append(run(name, cache_class, threads))
+    report(
+        f'SluggishCache.get() for {DURATION:.0f}s, value expiring every {DELAY * 1000:.0f}ms, '
+        f'{BACKEND_LATENCY * 1000:.0f}ms backend',
+        rows,
+        ['implementation', 'threads', 'gets/sec', 'backend/expiry', 'max in flight'],
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,7 @@ class MultiDbAppConfig(AppConfig):
         from django.db.backends.base.base import BaseDatabaseWrapper
 
         from . import decorators
+        from . import settings as config
         from .connection import ConnectionProxy
         from .cursors import PrintCursorWrapper, RestrictedCursorWrapper
 
@@ -29,25 +30,63 @@ class MultiDbAppConfig(AppConfig):
 
         test_mode = getattr(settings, 'TEST_MODE', False)
         sql_debug = getattr(settings, 'SQL_DEBUG', False)
-        sql_query_debug = getattr(settings, 'SQL_QUERY_DEBUG', False)
-
-        # # Patch Django's BaseDatabaseWrapper to enforce database write restrictions.
-        # if sql_debug and not test_mode:
-        #     def cursor(self):
-        #         # DJANGO 1.5: no need for this apparently: makes it break
-        #         # cursor = self.make_debug_cursor(self._cursor())
-        #         return PrintCursorWrapper(self._cursor(), self)
-        # elif sql_query_debug:
-        #     def cursor(self):
-        #         # DJANGO 1.5: no need for this apparently: makes it break
-        #         # cursor = self.make_debug_cursor(self._cursor())
-        #         return RestrictedCursorWrapper(cursor, self)
-        # else:
-        #     def cursor(self):
-        #         try:
-        #             return RestrictedCursorWrapper(self._cursor(), self)
-        #         except Error:
-        #             self.close()
-        #             return RestrictedCursorWrapper(self._cursor(), self)
-        #
-        # BaseDatabaseWrapper.cursor = cursor
+
+        # Patch Django's BaseDatabaseWrapper to enforce database write restrictions
+        # and to time queries for the balancer. The restricted cursor wraps the
+        # database driver's cursor, underneath Django's own cursor wrappers.
+        if sql_debug and not test_mode:
+            cursor_wrapper_class = PrintCursorWrapper
+        else:
+            cursor_wrapper_class = RestrictedCursorWrapper
+
+        prepare_cursor = BaseDatabaseWrapper._prepare_cursor
+
+        def _prepare_cursor(self, cursor):
+            return prepare_cursor(self, cursor_wrapper_class(cursor, self))
+
+        BaseDatabaseWrapper._prepare_cursor = _prepare_cursor
+
+        # Patch Django's BaseDatabaseWrapper to send the pre_commit, post_commit
+        # and post_rollback signals, and to run the functions queued for them.
+        BaseDatabaseWrapper.commit = decorators.commit(BaseDatabaseWrapper.commit)
+        BaseDatabaseWrapper.rollback = decorators.rollback(BaseDatabaseWrapper.rollback)
+
+        # Patch Django's BaseDatabaseWrapper to make cached query results stale
+        # when a transaction that wrote to their tables commits, if enabled.
+        from .results import result_cache
+        if result_cache is not None:
+            BaseDatabaseWrapper.commit = decorators.committed(BaseDatabaseWrapper.commit, result_cache)
+            BaseDatabaseWrapper.rollback = decorators.rolled_back(BaseDatabaseWrapper.rollback, result_cache)
+
+        # Patch Django's BaseDatabaseWrapper to count failures to connect, so the
+        # balancer avoids databases that are down, and so databases that keep
+        # failing are taken out of the routing if that is enabled.
+        from .balancer import balancer
+        from .breaker import circuit_breaker
+        BaseDatabaseWrapper.connect = decorators.connect(BaseDatabaseWrapper.connect, balancer, circuit_breaker)
+
+        # Start measuring replication lag, if it is used for routing.
+        if config.LAG_INTERVAL and config.MAX_LAGS:
+            from .lag import LagSampler, replica_lag
+            LagSampler(replica_lag, config.LAG_INTERVAL).start()
+
+        # Publish query metrics for the querymetrics command, if enabled.
+        if config.METRICS and config.METRICS_PUBLISH_INTERVAL:
+            from .metrics import MetricsPublisher, metrics
+            MetricsPublisher(metrics, config.METRICS_PUBLISH_INTERVAL).start()
+
+        from .readonly import read_only_mode
+
+        # Keep the read-only mode fresh in the background, if enabled.
+        if config.READ_ONLY_REFRESH_AHEAD and hasattr(read_only_mode.cache, 'refresh_ahead'):
+            for key in read_only_mode.get_keys():
+                read_only_mode.cache.refresh_ahead(key)
+
+        # Listen for changes to the read-only mode made by other processes, if enabled.
+        if read_only_mode.notifier is not None:
+            read_only_mode.notifier.listen(read_only_mode.refresh)
+
+        # Open connections ahead of the first requests, if enabled.
+        if config.PREWARM and not test_mode:
+            from .warmup import warm_up
+            warm_up()
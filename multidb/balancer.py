@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Strategies for choosing one database when several are configured for the
+same request.
+
+The strategy is chosen with the MULTIDB_BALANCER setting, which is the
+dotted path of one of the classes below (or of any other Balancer subclass).
+Keyword arguments for the class can be given with MULTIDB_BALANCER_OPTIONS.
+
+"""
+import itertools
+import math
+import random
+import time
+
+from django.utils.module_loading import import_string
+
+from . import settings as config
+
+
+class Balancer(object):
+    """
+    Base class for balancers. Subclasses must implement choose(), and may
+    implement observe() to receive the time taken by each query.
+
+    """
+
+    def choose(self, aliases):
+        """Return one of the given database aliases."""
+        raise NotImplementedError
+
+    def observe(self, alias, elapsed):
+        """Record that a query on the given alias took elapsed seconds."""
+        pass
+
+    def failed(self, alias):
+        """Record that connecting to the given alias failed, or that the connection was lost."""
+        pass
+
+
+class RandomBalancer(Balancer):
+    """Chooses a random database - poor man's database load balancing."""
+
+    def choose(self, aliases):
+        return random.choice(aliases)
+
+
+class RoundRobinBalancer(Balancer):
+    """Cycles through the databases configured for each set of aliases."""
+
+    def __init__(self):
+        self.counters = {}
+
+    def choose(self, aliases):
+        key = tuple(aliases)
+        try:
+            counter = self.counters[key]
+        except KeyError:
+            counter = self.counters.setdefault(key, itertools.count())
+        return aliases[next(counter) % len(aliases)]
+
+
+class EWMABalancer(Balancer):
+    """
+    Power of two choices over an exponentially weighted moving average of
+    the query latency of each database.
+
+    Two distinct databases are picked at random and the one with the lower
+    average latency wins. This sends most of the traffic to healthy databases
+    without herding it all onto the single fastest one.
+
+    The averages are weighted by time rather than by sample count, using
+    the decay (in seconds) as the time constant. When a database receives
+    no queries, its average decays towards the mean of the other databases,
+    and once it has all but decayed it is forgotten, so that the database
+    will be tried again and can recover from a bad period. A database with
+    no average costs the mean of the others.
+
+    Failures to connect, and lost connections, count as queries that took
+    penalty seconds. Other failed queries are not counted, as their time
+    says nothing about how fast the database is.
+
+    There is no locking around the averages. A race between two threads
+    can lose one sample, which does not matter for a moving average.
+
+    """
+
+    # The weight below which an average is forgotten.
+    forget_weight = 0.01
+
+    def __init__(self, decay=10.0, penalty=1.0, clock=time.monotonic):
+        self.decay = decay
+        self.penalty = penalty
+        self.clock = clock
+        self.latencies = {}
+
+    def weight(self, updated, now):
+        """The weight of an average last updated at the given time, or 0 if it is forgotten."""
+        weight = math.exp((updated - now) / self.decay)
+        return weight if weight >= self.forget_weight else 0.0
+
+    def prior(self, alias, aliases, now):
+        """The mean latency of the other databases, or None if none are known."""
+        others = []
+        for other in aliases:
+            if other != alias and other in self.latencies:
+                latency, updated = self.latencies[other]
+                if self.weight(updated, now):
+                    others.append(latency)
+        return sum(others) / len(others) if others else None
+
+    def cost(self, alias, aliases=(), now=None):
+        if now is None:
+            now = self.clock()
+        prior = self.prior(alias, aliases, now)
+        try:
+            latency, updated = self.latencies[alias]
+        except KeyError:
+            return prior or 0.0
+        weight = self.weight(updated, now)
+        if prior is None:
+            # There is nothing to compare it with.
+            return latency if weight else 0.0
+        return prior + (latency - prior) * weight
+
+    def choose(self, aliases):
+        if len(aliases) == 1:
+            return aliases[0]
+        first, second = random.sample(aliases, 2)
+        now = self.clock()
+        if self.cost(second, aliases, now) < self.cost(first, aliases, now):
+            return second
+        return first
+
+    def observe(self, alias, elapsed):
+        now = self.clock()
+        try:
+            latency, updated = self.latencies[alias]
+        except KeyError:
+            self.latencies[alias] = (elapsed, now)
+        else:
+            weight = self.weight(updated, now)
+            self.latencies[alias] = (latency * weight + elapsed * (1 - weight), now)
+
+    def failed(self, alias):
+        self.observe(alias, self.penalty)
+
+
+def get_balancer(path=None, options=None):
+    """Create the balancer configured in the settings."""
+    balancer_class = import_string(path or config.BALANCER)
+    return balancer_class(**(options if options is not None else config.BALANCER_OPTIONS))
+
+
+balancer = get_balancer()
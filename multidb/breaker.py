@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+A circuit breaker for each database, which takes a database that keeps
+failing out of the routing for a while, instead of sending requests to it
+to wait for connection timeouts.
+
+Errors connecting to a database, and errors which mean the connection was
+lost while running a query, count as failures. Errors caused by the query
+itself, timeouts and deadlocks don't. After threshold failures in a row the
+database is ejected for backoff seconds. Then a single request is sent to it
+as a probe: if its queries succeed the database is readmitted, and if not it
+is ejected again for twice as long, up to max_backoff seconds.
+
+"""
+import threading
+import time
+
+from . import settings as config
+from .signals import replica_ejected, replica_probing, replica_readmitted
+
+# MySQL client and server errors for lost connections: can't connect, server
+# gone away, lost connection, too many connections, shutting down, killed.
+MYSQL_CONNECTION_ERRORS = frozenset((1040, 1053, 1927, 2002, 2003, 2006, 2013, 2055))
+
+# PostgreSQL SQLSTATE codes for lost connections are in class 08, and 57P01
+# to 57P03 for shut down servers. Errors with no code come from the client.
+POSTGRESQL_CONNECTION_ERRORS = ('08', '57P01', '57P02', '57P03')
+
+# SQLite raises OperationalError for bad SQL too, so only the errors for
+# failing to read the database file count.
+SQLITE_CONNECTION_ERRORS = ('unable to open database file', 'disk I/O error')
+
+
+def is_connection_error(error, connection):
+    """Return whether an error raised by the database driver means the connection was lost."""
+    database = connection.Database
+    if isinstance(error, database.InterfaceError):
+        return True
+    if not isinstance(error, database.OperationalError):
+        return False
+    if connection.vendor == 'mysql':
+        return bool(error.args) and error.args[0] in MYSQL_CONNECTION_ERRORS
+    if connection.vendor == 'postgresql':
+        code = getattr(error, 'pgcode', None)
+        return code is None or code.startswith(POSTGRESQL_CONNECTION_ERRORS)
+    if connection.vendor == 'sqlite':
+        return str(error).startswith(SQLITE_CONNECTION_ERRORS)
+    return False
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, threshold=5, backoff=1.0, max_backoff=60.0, clock=time.monotonic):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.lock = threading.Lock()
+        # The number of failures in a row of each database that has any.
+        self.failures = {}
+        # The ejected databases, with when they can next be probed and for
+        # how long they were ejected.
+        self.ejected = {}
+        # Ejected databases whose probe is in progress.
+        self.probing = set()
+
+    def record_success(self, alias):
+        if alias not in self.failures:
+            return
+        with self.lock:
+            if alias in self.ejected and alias not in self.probing:
+                # A query that started before it was ejected.
+                return
+            self.failures.pop(alias, None)
+            readmitted = self.ejected.pop(alias, None) is not None
+            self.probing.discard(alias)
+        if readmitted:
+            replica_readmitted.send(sender=self.__class__, alias=alias)
+
+    def record_failure(self, alias):
+        now = self.clock()
+        with self.lock:
+            if alias in self.ejected and alias not in self.probing:
+                return
+            failures = self.failures.get(alias, 0) + 1
+            self.failures[alias] = failures
+            if alias in self.probing:
+                # The probe failed, so wait longer before the next one.
+                backoff = min(self.ejected[alias][1] * 2, self.max_backoff)
+                self.probing.discard(alias)
+            elif failures >= self.threshold:
+                backoff = self.backoff
+            else:
+                return
+            self.ejected[alias] = (now + backoff, backoff)
+        replica_ejected.send(sender=self.__class__, alias=alias, failures=failures, backoff=backoff)
+
+    def is_ejected(self, alias):
+        return alias in self.ejected
+
+    def filter(self, aliases, fallback=None):
+        """
+        Return the aliases that aren't ejected. When one of them is due to be
+        probed, only that alias is returned, so the request is the probe. If
+        they are all ejected, the fallback is returned instead.
+        """
+        if not self.ejected:
+            return aliases
+        now = self.clock()
+        available = []
+        probe = None
+        with self.lock:
+            for alias in aliases:
+                ejection = self.ejected.get(alias)
+                if ejection is None:
+                    available.append(alias)
+                elif probe is None and ejection[0] <= now:
+                    # Another probe is allowed after the same backoff, in case
+                    # this request doesn't use the database.
+                    probe = alias
+                    self.ejected[alias] = (now + ejection[1], ejection[1])
+                    self.probing.add(alias)
+        if probe is not None:
+            replica_probing.send(sender=self.__class__, alias=probe)
+            return [probe]
+        return available or [fallback or config.FALLBACK_DATABASE]
+
+
+def get_circuit_breaker():
+    """Create the circuit breaker configured in the settings, if any."""
+    if config.CIRCUIT_BREAKER is not None:
+        return CircuitBreaker(**config.CIRCUIT_BREAKER)
+    return None
+
+
+circuit_breaker = get_circuit_breaker()
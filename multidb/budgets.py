@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request limits on the number of queries and the database time.
+
+Budgets are defined per database with QUERY_BUDGET (a number of queries) and
+QUERY_TIME_BUDGET (seconds) in settings.DATABASES, and per path prefix with
+the MULTIDB_PATH_BUDGETS setting. QUERY_BUDGET_MODE decides what happens when
+a budget is exceeded:
+
+    'raise' (default): raise QueryBudgetExceeded before the next query.
+    'warn': issue a QueryBudgetWarning, once per request.
+    'log': log a warning, once per request, and continue.
+
+"""
+import logging
+import warnings
+
+from django.utils.encoding import smart_str
+
+RAISE = 'raise'
+WARN = 'warn'
+LOG = 'log'
+
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, name, queries, time):
+        message = f'Query budget for {name} exceeded: {queries} queries taking {time:.3f}s'
+        super(QueryBudgetExceeded, self).__init__(smart_str(message))
+
+
+class QueryBudgetWarning(UserWarning):
+    pass
+
+
+def get_limits(queries=None, time=None, mode=None):
+    """
+    Return the (queries, time, mode) budget from database or path options,
+    or None if there is no budget.
+    """
+    if queries is None and time is None:
+        return None
+    return queries, time, mode or RAISE
+
+
+class QueryBudget(object):
+    """The queries and database time spent against one budget in a request."""
+
+    def __init__(self, name, max_queries=None, max_time=None, mode=RAISE):
+        self.name = name
+        self.max_queries = max_queries
+        self.max_time = max_time
+        self.mode = mode
+        self.queries = 0
+        self.time = 0.0
+        self.reported = False
+        # What had been spent when this was copied from another budget.
+        self.base = (0, 0.0)
+
+    def check(self):
+        """Enforce the budget before running another query."""
+        if (
+            self.max_queries is not None and self.queries >= self.max_queries or
+            self.max_time is not None and self.time >= self.max_time
+        ):
+            try:
+                raise QueryBudgetExceeded(self.name, self.queries, self.time)
+            except QueryBudgetExceeded as error:
+                if self.mode == RAISE:
+                    raise
+                if not self.reported:
+                    self.reported = True
+                    if self.mode == WARN:
+                        warnings.warn(smart_str(error), QueryBudgetWarning)
+                    else:
+                        logging.warning('QueryBudgetWarning: %s' % smart_str(error))
+
+    def spend(self, elapsed):
+        self.queries += 1
+        self.time += elapsed
+
+    def copy(self):
+        """A copy for another thread, which starts from what has been spent so far."""
+        budget = QueryBudget(self.name, self.max_queries, self.max_time, self.mode)
+        budget.queries, budget.time, budget.reported = self.queries, self.time, self.reported
+        budget.base = (self.queries, self.time)
+        return budget
+
+    def merge(self, budget):
+        """Add what was spent against a copy of this budget since it was made."""
+        queries, time = budget.base
+        self.queries += budget.queries - queries
+        self.time += budget.time - time
+        self.reported = self.reported or budget.reported
+
+
+class RequestBudgets(object):
+    """
+    The budgets of a request: one for the request path, if it has one,
+    and one for each database with a budget that the request uses.
+
+    """
+
+    def __init__(self, path_budget=None):
+        self.path_budget = path_budget
+        self.alias_budgets = {}
+
+    def check(self, alias, limits):
+        """Enforce the budgets before a query on the alias, which has the given limits."""
+        if self.path_budget is not None:
+            self.path_budget.check()
+        if limits is not None:
+            budget = self.alias_budgets.get(alias)
+            if budget is None:
+                budget = self.alias_budgets[alias] = QueryBudget(alias, *limits)
+            budget.check()
+
+    def spend(self, alias, elapsed):
+        """Charge a query on the alias, which took elapsed seconds."""
+        if self.path_budget is not None:
+            self.path_budget.spend(elapsed)
+        budget = self.alias_budgets.get(alias)
+        if budget is not None:
+            budget.spend(elapsed)
+
+    def copy(self):
+        """A copy for another thread, such as a FanOut task, to spend against."""
+        budgets = RequestBudgets(self.path_budget and self.path_budget.copy())
+        budgets.alias_budgets = {alias: budget.copy() for alias, budget in self.alias_budgets.items()}
+        return budgets
+
+    def merge(self, budgets):
+        """Add what was spent against a copy of these budgets since it was made."""
+        if self.path_budget is not None and budgets.path_budget is not None:
+            self.path_budget.merge(budgets.path_budget)
+        for alias, budget in budgets.alias_budgets.items():
+            if alias in self.alias_budgets:
+                self.alias_budgets[alias].merge(budget)
+            else:
+                self.alias_budgets[alias] = budget
@@ -6,6 +6,10 @@ __all__ = [
 try:
     from apncore.cache.sluggish import SluggishCache
 except ImportError:
+    import collections
+    import logging
+    import queue
+    import threading
     import time
 
     class SluggishCache(object):
@@ -18,12 +22,20 @@ except ImportError:
         It also supports dictionary-like access for getting, setting and deleting
         values.
 
-        Be careful about storing too many keys with this, as they will take up
-        memory in the Python application using it, plus in the cache backend.
-        Also note that the values will only be eventually-correct; this wrapper
-        trades accuracy for performance. In line with this, there is no thread
-        safety surrounding these values. Don't use this for fast-changing values.
-        Instead, use it for manually setting modes.
+        Each instance remembers at most max_size values, discarding the least
+        recently used ones. Also note that the values will only be
+        eventually-correct; this wrapper trades accuracy for performance. Don't
+        use this for fast-changing values. Instead, use it for manually setting
+        modes.
+
+        When a value expires, one thread fetches it from the cache backend
+        while the other threads keep using the expired value, rather than
+        every thread going to the cache backend at once.
+
+        Keys registered with refresh_ahead() are fetched by a background
+        thread shortly before they expire, so requests never wait for the
+        cache backend. If the backend fails or takes longer than fetch_timeout,
+        the last known value is kept.
 
         Here is a rough comparison between some Django cache backends and
         SluggishCache. The memcache connection is to a single node running on
@@ -48,11 +60,20 @@ except ImportError:
 
         missed = object()
 
-        _values = {}
-
-        def __init__(self, cache, delay=15):
+        def __init__(self, cache, delay=15, max_size=1000, fetch_timeout=1):
             self.cache = cache
             self.delay = delay
+            self.max_size = max_size
+            self.fetch_timeout = fetch_timeout
+            # Values and their expiry times, keyed by (key, version).
+            self._values = collections.OrderedDict()
+            # Events for the keys being fetched from the cache backend.
+            self._fetching = {}
+            self._lock = threading.Lock()
+            # The (key, version) pairs that are refreshed ahead of expiry.
+            self._hot_keys = set()
+            self._refresh_queue = None
+            self._stopped = threading.Event()
 
         def __getitem__(self, key):
             value = self._get(key)
@@ -66,17 +87,57 @@ except ImportError:
         def __delitem__(self, key):
             self.delete(key)
 
+        def _remember(self, local_key, value):
+            with self._lock:
+                self._values[local_key] = (value, time.monotonic() + self.delay)
+                self._values.move_to_end(local_key)
+                while len(self._values) > self.max_size:
+                    self._values.popitem(last=False)
+
         def _get(self, key, version=None):
-            now = time.time()
+            local_key = (key, version)
+            # Fresh values are returned without taking the lock. Single
+            # OrderedDict operations are atomic, but the key may be discarded
+            # by another thread in between.
+            entry = self._values.get(local_key)
+            if entry is not None and time.monotonic() <= entry[1]:
+                try:
+                    self._values.move_to_end(local_key)
+                except KeyError:
+                    pass
+                return entry[0]
+
+            with self._lock:
+                entry = self._values.get(local_key)
+                if entry is not None and time.monotonic() <= entry[1]:
+                    return entry[0]
+                fetching = self._fetching.get(local_key)
+                if fetching is None:
+                    fetching = self._fetching[local_key] = threading.Event()
+                    fetcher = True
+                else:
+                    fetcher = False
+
+            if not fetcher:
+                if entry is not None:
+                    # Another thread is fetching it, so use the expired value.
+                    return entry[0]
+                # There is no value yet, so wait for the other thread.
+                fetching.wait(self.delay)
+                with self._lock:
+                    entry = self._values.get(local_key)
+                if entry is not None:
+                    return entry[0]
+                return self.cache.get(key, self.missed, version=version)
+
             try:
-                value, expires = self._values[key]
-                if now > expires:
-                    raise KeyError
-                return value
-            except KeyError:
                 value = self.cache.get(key, self.missed, version=version)
-                self._values[key] = (value, now + self.delay)
+                self._remember(local_key, value)
                 return value
+            finally:
+                with self._lock:
+                    del self._fetching[local_key]
+                fetching.set()
 
         def get(self, key, default=None, version=None):
             value = self._get(key, version=version)
@@ -106,13 +167,85 @@ except ImportError:
             return miss and self.missed or self.get(key, self.missed)
 
         def set(self, key, value, timeout=None, version=None):
-            now = time.time()
-            self._values[key] = (value, now + self.delay)
+            self._remember((key, version), value)
             self.cache.set(key, value, timeout=timeout, version=version)
 
         def delete(self, key, version=None):
             self.cache.delete(key, version=version)
-            try:
-                del self._values[key]
-            except KeyError:
-                pass
+            self.expire(key, version=version)
+
+        def is_fresh(self, key, version=None):
+            """Return whether the key has a local value that hasn't expired."""
+            entry = self._values.get((key, version))
+            return entry is not None and time.monotonic() <= entry[1]
+
+        def expire(self, key, version=None):
+            """Forget the local value, so the next get checks the cache backend."""
+            with self._lock:
+                self._values.pop((key, version), None)
+
+        def refresh_ahead(self, key, version=None):
+            """
+            Keep the value of a key fresh from a background thread. The threads
+            are started when the first key is registered.
+            """
+            with self._lock:
+                self._hot_keys.add((key, version))
+                if self._refresh_queue is None:
+                    self._refresh_queue = queue.Queue()
+                    for target, name in (
+                        (self._refresh_loop, 'multidb-sluggish-refresh'),
+                        (self._fetch_loop, 'multidb-sluggish-fetch'),
+                    ):
+                        threading.Thread(target=target, name=name, daemon=True).start()
+
+        def stop_refreshing(self):
+            self._stopped.set()
+            if self._refresh_queue is not None:
+                self._refresh_queue.put(None)
+
+        def _refresh_loop(self):
+            # Refresh values when they have a fifth of their delay left,
+            # checking twice as often as that.
+            margin = self.delay / 5.0
+            fetch = None
+            while not self._stopped.is_set():
+                now = time.monotonic()
+                for local_key in list(self._hot_keys):
+                    entry = self._values.get(local_key)
+                    if entry is not None and entry[1] - now > margin:
+                        continue
+                    if fetch is None or fetch.done.is_set():
+                        fetch = _Fetch(local_key)
+                        self._refresh_queue.put(fetch)
+                        fetch.done.wait(self.fetch_timeout)
+                    if fetch.local_key == local_key and fetch.done.is_set() and not fetch.failed:
+                        self._remember(local_key, fetch.value)
+                    elif entry is not None:
+                        # Keep the last known value, and try again later.
+                        self._remember(local_key, entry[0])
+                self._stopped.wait(margin / 2)
+
+        def _fetch_loop(self):
+            # Fetches happen in their own thread, so that the refresh thread
+            # can give up on them after fetch_timeout.
+            while True:
+                fetch = self._refresh_queue.get()
+                if fetch is None:
+                    break
+                key, version = fetch.local_key
+                try:
+                    fetch.value = self.cache.get(key, self.missed, version=version)
+                except Exception:
+                    fetch.failed = True
+                    logging.warning('Could not refresh %s from the cache' % key, exc_info=True)
+                fetch.done.set()
+
+    class _Fetch(object):
+        """A fetch of a value for the refresh thread."""
+
+        def __init__(self, local_key):
+            self.local_key = local_key
+            self.done = threading.Event()
+            self.value = None
+            self.failed = False
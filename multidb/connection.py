@@ -1,27 +1,125 @@
 # -*- coding: utf-8 -*-
 import contextlib
+import contextvars
 import threading
 
 from django.db import connections
 
+from .readonly import read_only_mode
+from . import settings as config
 from .settings import FALLBACK_DATABASE
 
 
-class ConnectionState(threading.local):
-
-    _alias = FALLBACK_DATABASE
+class ConnectionState(object):
+    """
+    The routing state of the current request. This is stored in context
+    variables, so each thread has its own state, and so does each asyncio
+    task when serving requests with ASGI.
+
+    """
+
+    # Read-only mode is checked every time outside of requests.
+    _unscoped = object()
+
+    def __init__(self):
+        self._alias = contextvars.ContextVar('multidb.alias', default=FALLBACK_DATABASE)
+        # The alias of the database that write SQL was last run on, if any.
+        self._wrote = contextvars.ContextVar('multidb.wrote', default=None)
+        # A snapshot of the read-only mode, taken at the start of the request,
+        # and of the aliases that are read-only.
+        self._read_only = contextvars.ContextVar('multidb.read_only', default=self._unscoped)
+        self._read_only_aliases = contextvars.ContextVar('multidb.read_only_aliases', default=self._unscoped)
+        # The number of times each SQL fingerprint ran in the current request,
+        # when repeated queries are being detected.
+        self._query_counts = contextvars.ContextVar('multidb.query_counts', default=None)
+        # The query budgets of the current request, if it has any.
+        self._budgets = contextvars.ContextVar('multidb.budgets', default=None)
+        # How many more failed reads the current request may retry.
+        self._retries = contextvars.ContextVar('multidb.retries', default=0)
 
     def _get_alias(self):
-        return self._alias
+        return self._alias.get()
 
     def _set_alias(self, value):
-        self._alias = value
+        self._alias.set(value)
 
     def _del_alias(self):
-        self._alias = FALLBACK_DATABASE
+        self._alias.set(FALLBACK_DATABASE)
 
     alias = property(_get_alias, _set_alias, _del_alias)
 
+    def _get_wrote(self):
+        return self._wrote.get()
+
+    def _set_wrote(self, value):
+        self._wrote.set(value)
+
+    wrote = property(_get_wrote, _set_wrote)
+
+    def _get_query_counts(self):
+        return self._query_counts.get()
+
+    def _set_query_counts(self, value):
+        self._query_counts.set(value)
+
+    query_counts = property(_get_query_counts, _set_query_counts)
+
+    def _get_budgets(self):
+        return self._budgets.get()
+
+    def _set_budgets(self, value):
+        self._budgets.set(value)
+
+    budgets = property(_get_budgets, _set_budgets)
+
+    def _get_retries(self):
+        return self._retries.get()
+
+    def _set_retries(self, value):
+        self._retries.set(value)
+
+    retries = property(_get_retries, _set_retries)
+
+    @property
+    def read_only(self):
+        """
+        Whether read-only mode is enabled. Within a request this is the
+        snapshot taken when it started, so the mode is consistent for the
+        whole request and statements don't each have to check it.
+        """
+        value = self._read_only.get()
+        if value is self._unscoped:
+            return bool(read_only_mode)
+        return value
+
+    def is_alias_read_only(self, alias):
+        """Whether writes to the alias are refused, from the request's snapshot."""
+        aliases = self._read_only_aliases.get()
+        if aliases is self._unscoped:
+            return read_only_mode.is_alias_read_only(alias)
+        return alias in aliases
+
+    def start_request(self):
+        """
+        Reset the state that is remembered for a single request, and take
+        a snapshot of the read-only mode.
+        """
+        self._wrote.set(None)
+        self._query_counts.set(None)
+        self._budgets.set(None)
+        self._retries.set(config.READ_RETRIES)
+        self._read_only.set(bool(read_only_mode))
+        self._read_only_aliases.set(read_only_mode.get_read_only_aliases())
+
+    def end_request(self):
+        self._wrote.set(None)
+        self._query_counts.set(None)
+        self._budgets.set(None)
+        self._retries.set(0)
+        self._read_only.set(self._unscoped)
+        self._read_only_aliases.set(self._unscoped)
+        self._alias.set(FALLBACK_DATABASE)
+
     @contextlib.contextmanager
     def force(self, value):
         old_value = self.alias
@@ -32,39 +130,63 @@ class ConnectionState(threading.local):
             self.alias = old_value
 
 
+class ResolvedConnection(threading.local):
+    """
+    The connection object for the most recently active alias, cached for each
+    thread because Django's connection objects belong to a single thread.
+
+    """
+
+    # Never equal to an alias, including None.
+    alias = _unresolved = object()
+    connection = None
+
+    def resolve(self, alias):
+        """Return the connection for the alias, or None if it has not been initialized."""
+        if alias != self.alias:
+            connection = getattr(connections._connections, alias, None) if alias else None
+            if connection is None:
+                # Check again next time, as it may be initialized by then.
+                return None
+            self.alias, self.connection = alias, connection
+        return self.connection
+
+    def clear(self):
+        """Forget the cached connection, after replacing a connection object."""
+        self.alias, self.connection = self._unresolved, None
+
+
 class ConnectionProxy(object):
+    """
+    Makes every connection object act as the "active" connection chosen by the
+    middleware, if it has been initialized in this thread. The active
+    connection is looked up once per change of alias, rather than on every
+    attribute access.
+
+    """
 
     def __init__(self, *args, **kwargs):
         with connection_state.force(None):
             super(ConnectionProxy, self).__init__(*args, **kwargs)
 
+    # These are called for every attribute of every connection object, so the
+    # cached connection is checked inline before calling resolve().
+
     def __getattribute__(self, name):
-        alias = connection_state.alias
-        # This is supporting Django 1.2 / 1.4 where in 1.2 _connections is a dict and in 1.4 it's threads.local()
-        # - if there's an alias then the connection has already been initialized, otherwise use self.
-        if alias and (
-            isinstance(connections._connections, dict) and alias in connections._connections or
-            alias in connections._connections.__dict__
-        ):
-            connection = alias and connections[alias] or self
+        alias = connection_state._alias.get()
+        if alias == resolved_connection.alias:
+            connection = resolved_connection.connection
         else:
-            connection = self
-
-        return super(ConnectionProxy, connection).__getattribute__(name)
+            connection = resolved_connection.resolve(alias) or self
+        return object.__getattribute__(connection, name)
 
     def __setattr__(self, name, value):
-        alias = connection_state.alias
-        # This is supporting Django 1.2 / 1.4 where in 1.2 _connections is a dict and in 1.4 it's threads.local()
-        # - if there's an alias then the connection has already been initialized, otherwise use self.
-        if alias and (
-            isinstance(connections._connections, dict) and alias in connections._connections or
-            alias in connections._connections.__dict__
-        ):
-            connection = alias and connections[alias] or self
+        alias = connection_state._alias.get()
+        if alias == resolved_connection.alias:
+            connection = resolved_connection.connection
         else:
-            connection = self
-
-        return super(ConnectionProxy, connection).__setattr__(name, value)
+            connection = resolved_connection.resolve(alias) or self
+        return object.__setattr__(connection, name, value)
 
     @property
     def is_mysql(self):
@@ -80,3 +202,4 @@ class ConnectionProxy(object):
 
 
 connection_state = ConnectionState()
+resolved_connection = ResolvedConnection()
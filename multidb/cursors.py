@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import functools
 import re
 import sys
 import time
@@ -7,8 +8,17 @@ import logging
 from django.db import connections
 from django.utils.encoding import force_str, smart_str
 
+from . import settings as config
+from .balancer import balancer
+from .breaker import circuit_breaker, is_connection_error
 from .colorize import colorize
-from .readonly import read_only_mode, ReadOnlyError
+from .connection import connection_state
+from .lag import replica_lag
+from .metrics import metrics
+from .readonly import ReadOnlyError
+from .results import get_read_tables, get_replica_group, get_written_tables, result_cache
+from .signals import batch_executed
+from .slowlog import slow_query_log
 
 
 class RestrictedDatabaseError(Exception):
@@ -17,13 +27,78 @@ class RestrictedDatabaseError(Exception):
         super(RestrictedDatabaseError, self).__init__(smart_str(message))
 
 
-class RestrictedCursorWrapper(object):
+READ = 'read'
+WRITE = 'write'
+SAVEPOINT = 'savepoint'
+# Transaction control and session statements, which Django runs itself.
+SESSION = 'session'
+
+SQL_CLASS_RE = re.compile(
+    r'\s*(?:(SELECT|EXPLAIN)|(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)|'
+    r'BEGIN|START TRANSACTION|COMMIT|ROLLBACK|SET|SHOW)\b',
+    re.IGNORECASE,
+)
+
+
+@functools.lru_cache(maxsize=config.SQL_CACHE_SIZE)
+def classify_sql(sql):
+    """
+    Return whether an SQL statement is a READ, a WRITE, a SAVEPOINT command
+    or a SESSION command. ORM-generated SQL repeats heavily, so this is
+    cached by the SQL text.
+    """
+    match = SQL_CLASS_RE.match(sql)
+    if match is None:
+        return WRITE
+    if match.group(1):
+        return READ
+    return SAVEPOINT if match.group(2) else SESSION
+
+
+FINGERPRINT_SUBSTITUTIONS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),  # string literals
+    (re.compile(r'%\([^)]*\)s|%s'), '?'),  # query parameters
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),  # numbers, but not digits within names
+    (re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE), 'IN (...)'),
+    (re.compile(r'\s+'), ' '),
+]
+
 
-    READ_SQL_RE = re.compile(r'\s*(SELECT|EXPLAIN|SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.IGNORECASE)
+@functools.lru_cache(maxsize=config.SQL_CACHE_SIZE)
+def fingerprint_sql(sql):
+    """
+    Return the SQL statement with its literals, parameters and IN lists
+    replaced, so that queries which differ only by their values are equal.
+    This is cached by the SQL text, like classify_sql().
+    """
+    for regex, replacement in FINGERPRINT_SUBSTITUTIONS:
+        sql = regex.sub(replacement, sql)
+    return sql.strip()
+
+
+class RestrictedCursorWrapper(object):
 
     def __init__(self, cursor, db):
+        self.result = None
+        self.retrying = False
+        self.use(cursor, db)
+
+    def use(self, cursor, db):
+        """Run statements with a driver cursor of the given connection."""
         self.cursor = cursor
         self.db = db  # Instance of a BaseDatabaseWrapper subclass
+        self.alias = db.alias
+
+        db_options = db.settings_dict
+        self.read_only_warning = db_options.get('READ_ONLY_WARNING')
+        self.read_only_database = db_options.get('READ_ONLY') or self.read_only_warning
+        self.budget_limits = config.QUERY_BUDGETS.get(self.alias)
+
+        # Results are cached for read-only databases, when enabled.
+        self.cache_results = result_cache is not None and self.alias in config.READ_ONLY_DATABASES_SET
+        self.replica_group = get_replica_group(db_options) if result_cache is not None else None
+        # Reads can run again on another read-only database, when enabled.
+        self.retry_reads = bool(config.READ_RETRIES) and self.alias in config.REPLICA_SIBLINGS
 
     def __getattr__(self, attr):
         if attr in self.__dict__:
@@ -32,7 +107,26 @@ class RestrictedCursorWrapper(object):
             return getattr(self.cursor, attr)
 
     def __iter__(self):
-        return iter(self.cursor)
+        return iter(self.result if self.result is not None else self.cursor)
+
+    @property
+    def description(self):
+        return (self.result or self.cursor).description
+
+    @property
+    def rowcount(self):
+        return (self.result or self.cursor).rowcount
+
+    def fetchone(self):
+        return (self.result or self.cursor).fetchone()
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return (self.result or self.cursor).fetchmany()
+        return (self.result or self.cursor).fetchmany(size)
+
+    def fetchall(self):
+        return (self.result or self.cursor).fetchall()
 
     def __enter__(self):
         return self
@@ -40,35 +134,224 @@ class RestrictedCursorWrapper(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
-    def execute(self, sql, params=()):
-
-        read_sql = bool(self.READ_SQL_RE.match(sql))
-
-        db_options = connections.databases[self.db.alias]
-        read_only_warning = db_options.get('READ_ONLY_WARNING')
-        read_only_database = db_options.get('READ_ONLY') or read_only_warning
-
-        if read_only_database:
-            if not read_sql:
-                if read_only_mode:
-                    raise ReadOnlyError
+    def check(self, sql_class, sql, params):
+        """Raise an error if the statement is not allowed to run."""
+        if sql_class is WRITE:
+            if connection_state.read_only or connection_state.is_alias_read_only(self.alias):
+                raise ReadOnlyError
+            if self.read_only_database:
                 try:
-                    raise RestrictedDatabaseError(self.db.alias, get_sql_output(sql, params))
+                    raise RestrictedDatabaseError(self.alias, get_sql_output(sql, params))
                 except RestrictedDatabaseError as error:
-                    if not read_only_warning:
+                    if not self.read_only_warning:
                         raise
                     logging.warning(
                         'RestrictedDatabaseWarning: %s' % smart_str(error)
                     )
-        elif not read_sql and read_only_mode:
-            raise ReadOnlyError
+        budgets = connection_state.budgets
+        if budgets is not None and sql_class in (READ, WRITE):
+            budgets.check(self.alias, self.budget_limits)
+
+    def executed(self, sql_class, elapsed, sql, params=None, error=False, count=1):
+        """Record a statement (or a batch of count statements) that has been run."""
+        if config.METRICS:
+            rows = 0 if error else max(self.cursor.rowcount or 0, 0)
+            metrics.record(self.alias, sql_class, elapsed, rows, error, count)
+        if slow_query_log is not None and elapsed >= slow_query_log.threshold:
+            slow_query_log.record(self.alias, sql, params, elapsed, error)
+        query_counts = connection_state.query_counts
+        if query_counts is not None and sql_class in (READ, WRITE):
+            fingerprint = fingerprint_sql(sql)
+            query_counts[fingerprint] = query_counts.get(fingerprint, 0) + count
+        if circuit_breaker is not None and not error:
+            circuit_breaker.record_success(self.alias)
+        budgets = connection_state.budgets
+        if budgets is not None and sql_class in (READ, WRITE):
+            # A batch is a single round trip, so it is charged as one query.
+            budgets.spend(self.alias, elapsed)
+        if sql_class is WRITE and not error:
+            tables = get_written_tables(sql)
+            if tables is None or tables:
+                if self.alias in config.ROUTED_DATABASES_SET:
+                    # Remember the write, so the client's next requests can read it.
+                    connection_state.wrote = self.alias
+                if result_cache is not None:
+                    self.invalidate_results(tables)
+
+    def failed(self, error):
+        """Tell the balancer and the circuit breaker about an error, if it means the database is failing."""
+        with connection_state.force(None):
+            lost = is_connection_error(error, self.db)
+        if lost:
+            balancer.failed(self.alias)
+            if circuit_breaker is not None:
+                circuit_breaker.record_failure(self.alias)
+
+    def can_retry(self, sql_class, error):
+        """Return whether a failed statement can run again on another database."""
+        if not (self.retry_reads and sql_class is READ and not self.retrying and connection_state.retries > 0):
+            return False
+        # The state of this wrapper's connection, rather than the active one.
+        with connection_state.force(None):
+            return (
+                not self.db.in_atomic_block and self.db.get_autocommit() and is_connection_error(error, self.db)
+            )
+
+    def retry(self, sql, params, error):
+        """
+        Run a read again on another read-only database after the connection
+        to this one was lost, and use that database for the rest of the
+        request. It is only tried once.
+        """
+        siblings = [
+            alias for alias in config.REPLICA_SIBLINGS[self.alias]
+            if not replica_lag.is_stale(alias) and not (circuit_breaker and circuit_breaker.is_ejected(alias))
+        ]
+        if not siblings:
+            raise error
+        alias = balancer.choose(siblings)
+        connection_state.retries -= 1
+        if config.METRICS:
+            metrics.record_retry(self.alias, READ)
+        logging.warning('Retrying a query on %s after losing the connection to %s: %s', alias, self.alias, error)
+
+        with connection_state.force(None):
+            # Close the broken connection now, as close_old_connections() at
+            # the end of the request only sees the active alias's connection.
+            try:
+                self.db.close()
+            except Exception:
+                logging.debug('Could not close the connection to %s', self.alias, exc_info=True)
+            db = connections[alias]
+            db.ensure_connection()
+            # The driver's cursor, as this wrapper checks and records the statement.
+            cursor = db.create_cursor()
+        connection_state.alias = alias
+        self.use(cursor, db)
+        self.retrying = True
+        try:
+            return self.execute(sql, params)
+        finally:
+            self.retrying = False
+
+    def invalidate_results(self, tables):
+        """
+        Make cached results of the tables stale, once the write is committed.
+        Tables of None means that any table might have been written to.
+        """
+        with connection_state.force(None):
+            in_transaction = self.db.in_atomic_block or not self.db.get_autocommit()
+        if in_transaction:
+            result_cache.invalidate_on_commit(self.alias, tables, self.replica_group)
+        else:
+            result_cache.invalidate(tables, self.replica_group)
+
+    def execute(self, sql, params=None):
+        sql_class = classify_sql(sql)
+        self.result = None
+        tables = versions = None
+        if self.cache_results and sql_class is READ:
+            tables = get_read_tables(sql)
+            if tables is not None:
+                empty = self.db.features.empty_fetchmany_value
+                self.result, versions = result_cache.get(sql, params, tables, empty, self.replica_group)
+                if self.result is not None:
+                    # Served from the cache, without running a query.
+                    return self
+        self.check(sql_class, sql, params)
+
+        start = time.monotonic()
+        try:
+            result = self.cursor.execute(sql, params)
+        except Exception as error:
+            self.executed(sql_class, time.monotonic() - start, sql, params, error=True)
+            self.failed(error)
+            if not self.can_retry(sql_class, error):
+                raise
+            return self.retry(sql, params, error)
+        elapsed = time.monotonic() - start
+        balancer.observe(self.alias, elapsed)
+        self.executed(sql_class, elapsed, sql, params)
+        if versions is not None:
+            self.result = result_cache.fetch(
+                self.cursor, sql, params, tables, versions, empty, self.alias, self.replica_group,
+            )
+        return result
+
+    def executemany(self, sql, param_list):
+        """
+        Execute a statement for a batch of parameters. The statement is
+        checked once for the whole batch, and the batch_executed signal
+        reports its size and duration.
+        """
+        sql_class = classify_sql(sql)
+        self.result = None
+        self.check(sql_class, sql, None)
+
+        if hasattr(param_list, '__len__'):
+            size = len(param_list)
+        else:
+            # Count the parameters as the driver consumes them.
+            param_list = size = CountingIterator(param_list)
+
+        start = time.monotonic()
+        try:
+            result = self.cursor.executemany(sql, param_list)
+        except Exception as error:
+            self.executed(sql_class, time.monotonic() - start, sql, error=True, count=int(size))
+            self.failed(error)
+            raise
+        elapsed = time.monotonic() - start
+        self.executed(sql_class, elapsed, sql, count=int(size))
+
+        batch_executed.send(
+            sender=self.__class__, alias=self.alias, sql=sql, size=int(size), elapsed=elapsed,
+        )
+        return result
+
+    def callproc(self, procname, *args):
+        """
+        Call a stored procedure. The procedure could do anything, so it is
+        treated as write SQL.
+        """
+        self.result = None
+        self.check(WRITE, procname, None)
+
+        start = time.monotonic()
+        try:
+            result = self.cursor.callproc(procname, *args)
+        except Exception as error:
+            self.executed(WRITE, time.monotonic() - start, procname, error=True)
+            self.failed(error)
+            raise
+        elapsed = time.monotonic() - start
+        balancer.observe(self.alias, elapsed)
+        self.executed(WRITE, elapsed, procname)
+        return result
+
+
+class CountingIterator(object):
+    """Counts the items taken from an iterable, without storing them."""
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self.iterator)
+        self.count += 1
+        return item
 
-        return self.cursor.execute(sql, params)
+    def __int__(self):
+        return self.count
 
 
 class PrintCursorWrapper(RestrictedCursorWrapper):
 
-    def execute(self, sql, params=()):
+    def execute(self, sql, params=None):
         start = time.time()
         color = 'red'
         try:
@@ -79,9 +362,7 @@ class PrintCursorWrapper(RestrictedCursorWrapper):
                 raise
             else:
                 sql = self.db.ops.last_executed_query(self.cursor, sql, params)
-                options = connections.databases[self.db.alias]
-                read_only = options.get('READ_ONLY') or options.get('READ_ONLY_WARNING')
-                color = read_only and 'green' or 'purple'
+                color = self.read_only_database and 'green' or 'purple'
                 return result
         finally:
             elapsed = (time.time() - start) * 1000
@@ -99,7 +380,9 @@ def get_sql_output(sql, params):
         return force_str(s, strings_only=True, errors='replace')
 
     # Convert params to contain Unicode values.
-    if isinstance(params, (list, tuple)):
+    if params is None:
+        return smart_str(sql)
+    elif isinstance(params, (list, tuple)):
         u_params = tuple([to_text(val) for val in params])
     else:
         u_params = dict([(to_text(k), to_text(v)) for k, v in params.items()])
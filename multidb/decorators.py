@@ -3,7 +3,9 @@ import functools
 
 from django.forms.utils import ErrorList
 
-from .readonly import read_only_mode, ReadOnlyError
+from .breaker import is_connection_error
+from .connection import connection_state
+from .readonly import ReadOnlyError
 from .signals import send_post_commit, send_post_rollback, send_pre_commit
 
 
@@ -12,7 +14,7 @@ def full_clean_if_not_read_only(full_clean):
 
     def wrapper(self):
         full_clean(self)
-        if read_only_mode:
+        if connection_state.read_only:
             if '__all__' not in self._errors:
                 self._errors['__all__'] = ErrorList()
             self._errors.get('__all__').insert(0, ReadOnlyError.message)
@@ -90,3 +92,49 @@ commit = wrap(
 rollback = wrap_after(
     after=send_post_rollback,
 )
+
+
+def connect(func, balancer, breaker=None):
+    """
+    Decorator for reporting failures to connect to a database to the
+    balancer, and to the circuit breaker if there is one.
+    """
+
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except Exception as error:
+            balancer.failed(self.alias)
+            if breaker is not None and is_connection_error(error, self):
+                breaker.record_failure(self.alias)
+            raise
+    return wrapped
+
+
+def committed(func, result_cache):
+    """
+    Decorator for a connection's commit, which makes the cached results of
+    the tables written in its transaction stale.
+    """
+
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        result = func(self, *args, **kwargs)
+        result_cache.committed(self.alias)
+        return result
+    return wrapped
+
+
+def rolled_back(func, result_cache):
+    """
+    Decorator for a connection's rollback, which forgets the invalidations
+    of cached results that were waiting for its transaction to commit.
+    """
+
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        result = func(self, *args, **kwargs)
+        result_cache.rolled_back(self.alias)
+        return result
+    return wrapped
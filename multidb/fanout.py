@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Runs independent queries at the same time, each on its own connection from
+a TemporaryConnectionPool, so a page that needs several of them waits for
+the slowest rather than for all of them in turn.
+
+"""
+import contextvars
+import threading
+from concurrent.futures import ALL_COMPLETED, FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+
+from django.db import connections
+
+from .connection import connection_state
+from .pool import interrupt
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Task(object):
+    """A callable or queryset to run on a pooled connection, and its outcome."""
+
+    def __init__(self, target, context):
+        self.target = target
+        self.context = context
+        self.future = Future()
+        self.lock = threading.Lock()
+        # The connection object while the task is using it.
+        self.wrapper = None
+        self.timer = None
+        # The task counts its queries against its own copies of the caller's
+        # budgets and repeated query counts, which merge() adds back.
+        self.budgets = connection_state.budgets
+        self.query_counts = connection_state.query_counts
+        self.task_budgets = self.budgets and self.budgets.copy()
+        self.task_query_counts = None if self.query_counts is None else {}
+        self.stopped = False
+
+    def run(self, pool, timeout):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            with pool.get() as alias:
+                with connection_state.force(None):
+                    wrapper = connections[alias]
+                    # Connect now, so there is a connection to interrupt.
+                    wrapper.ensure_connection()
+                with self.lock:
+                    if self.future.done():
+                        return
+                    self.wrapper = wrapper
+                    if timeout is not None:
+                        self.timer = threading.Timer(timeout, self.expire, args=(timeout,))
+                        self.timer.daemon = True
+                        self.timer.start()
+                try:
+                    # A copy of the caller's context, so the routing state of
+                    # the task doesn't reach the caller or the other tasks.
+                    result = self.context.run(self.call, alias)
+                finally:
+                    with self.lock:
+                        self.wrapper = None
+                        self.stopped = True
+                        if self.timer is not None:
+                            self.timer.cancel()
+        except BaseException as error:
+            self.finish(exception=error)
+        else:
+            self.finish(result=result)
+
+    def call(self, alias):
+        if self.future.done():
+            return None
+        connection_state.budgets = self.task_budgets
+        connection_state.query_counts = self.task_query_counts
+        with connection_state.force(alias):
+            if callable(self.target):
+                return self.target()
+            return list(self.target)
+
+    def finish(self, result=None, exception=None):
+        with self.lock:
+            if self.future.done():
+                # It has timed out or been cancelled.
+                return
+            if exception is None:
+                self.future.set_result(result)
+            else:
+                self.future.set_exception(exception)
+
+    def merge(self):
+        """
+        Add the queries the task ran to the caller's budgets and repeated
+        query counts, once it has stopped running. Call it from the caller.
+        """
+        with self.lock:
+            if not self.stopped:
+                return
+            budgets, self.task_budgets = self.task_budgets, None
+            query_counts, self.task_query_counts = self.task_query_counts, None
+        if budgets is not None:
+            self.budgets.merge(budgets)
+        if query_counts:
+            for fingerprint, count in query_counts.items():
+                self.query_counts[fingerprint] = self.query_counts.get(fingerprint, 0) + count
+
+    def expire(self, timeout):
+        self.stop(TaskTimeout(f'Task took longer than {timeout}s'))
+
+    def cancel(self):
+        if not self.future.cancel():
+            self.stop(TaskCancelled('Task was cancelled'))
+
+    def stop(self, exception):
+        """Fail the task, and interrupt the statement it is running, if the database driver can."""
+        with self.lock:
+            if self.future.done():
+                return
+            self.future.set_exception(exception)
+        self.interrupt()
+
+    def interrupt(self):
+        # Until the task lets go of its connection, as it may start another
+        # statement, or one that had not quite started when interrupted.
+        with self.lock:
+            if self.wrapper is not None and interrupt(self.wrapper):
+                timer = threading.Timer(0.05, self.interrupt)
+                timer.daemon = True
+                timer.start()
+
+
+class FanOut(object):
+    """
+    Runs callables and querysets concurrently on connections taken from the
+    pool, in up to max_workers threads (by default the pool's max_size).
+    Querysets are evaluated to lists, and callables are called with the
+    routing pinned to their connection, in a copy of the caller's context.
+
+    Each task may run for timeout seconds once it has a connection, after
+    which it fails with TaskTimeout, and its statement is cancelled where the
+    database driver supports that (PostgreSQL and SQLite).
+
+    """
+
+    def __init__(self, pool, max_workers=None, timeout=None):
+        self.pool = pool
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or pool.max_size,
+            thread_name_prefix=f'multidb-fanout-{pool.prefix}',
+        )
+
+    def submit(self, target, timeout=None):
+        """
+        Start running a task, and return it. Task.future holds its outcome,
+        and Task.merge() adds its queries to the caller's budgets once done.
+        """
+        task = Task(target, contextvars.copy_context())
+        started = self.executor.submit(task.run, self.pool, self.timeout if timeout is None else timeout)
+        # The executor cancels the tasks that are still queued when it is shut down.
+        started.add_done_callback(lambda started: started.cancelled() and task.cancel())
+        return task
+
+    def gather(self, *targets, timeout=None, return_exceptions=False):
+        """
+        Run the tasks and return their results in the same order. If one
+        fails, the others are cancelled and its exception is raised, unless
+        return_exceptions is true, when exceptions are returned as results.
+        """
+        tasks = [self.submit(target, timeout) for target in targets]
+        futures = [task.future for task in tasks]
+        try:
+            done, pending = wait(futures, return_when=ALL_COMPLETED if return_exceptions else FIRST_EXCEPTION)
+            if pending:
+                raise next(future.exception() for future in done if future.exception() is not None)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            for task in tasks:
+                task.merge()
+        if return_exceptions:
+            return [future.exception() or future.result() for future in futures]
+        return [future.result() for future in futures]
+
+    def close(self, wait=True):
+        """Cancel the tasks that haven't started, and stop the worker threads."""
+        self.executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Replication lag monitoring.
+
+A background sampler periodically measures the lag of each database with a
+MAX_LAG option, using a probe chosen by the database backend. The results are
+published to a process-local table which the middleware reads to skip stale
+replicas, with a single dict lookup per request.
+
+"""
+import logging
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS, ProgrammingError, connections
+from django.utils.module_loading import import_string
+
+from . import settings as config
+from .connection import connection_state
+
+
+class LagProbe(object):
+    """Base class for measuring the replication lag of a database."""
+
+    def measure(self, connection):
+        """Return the lag of the connection's database in seconds."""
+        raise NotImplementedError
+
+
+class PostgreSQLLagProbe(LagProbe):
+    """
+    Uses the replay timestamp of a PostgreSQL standby. A standby that has
+    replayed everything it has received is not lagging, even if the primary
+    has been idle for a while. A primary always has no lag.
+
+    """
+
+    sql = (
+        'SELECT CASE'
+        ' WHEN NOT pg_is_in_recovery() THEN 0'
+        ' WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0'
+        ' ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())'
+        ' END'
+    )
+
+    def measure(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(self.sql)
+            lag = cursor.fetchone()[0]
+        return float(lag or 0)
+
+
+class MySQLLagProbe(LagProbe):
+    """
+    Uses Seconds_Behind_Source (or Seconds_Behind_Master) from the replica
+    status. A server without replica status is a primary, so it has no lag.
+    A replica with stopped replication reports NULL, which counts as
+    infinitely stale.
+
+    SHOW REPLICA STATUS is tried first, as MySQL 8.4 removed SHOW SLAVE
+    STATUS, which is used for servers older than MySQL 8.0.22 and MariaDB
+    10.5.1.
+
+    """
+
+    statements = ('SHOW REPLICA STATUS', 'SHOW SLAVE STATUS')
+    columns = ('Seconds_Behind_Source', 'Seconds_Behind_Master')
+
+    def __init__(self):
+        # The statement that the server supports, once it is known.
+        self.sql = None
+
+    def execute(self, cursor):
+        if self.sql is None:
+            for sql in self.statements[:-1]:
+                try:
+                    cursor.execute(sql)
+                except ProgrammingError:
+                    continue
+                self.sql = sql
+                return
+            self.sql = self.statements[-1]
+        cursor.execute(self.sql)
+
+    def measure(self, connection):
+        with connection.cursor() as cursor:
+            self.execute(cursor)
+            row = cursor.fetchone()
+            if row is None:
+                return 0.0
+            status = dict(zip([column[0] for column in cursor.description], row))
+        for column in self.columns:
+            if column in status:
+                lag = status[column]
+                return float('inf') if lag is None else float(lag)
+        return 0.0
+
+
+class FakeLagProbe(LagProbe):
+    """A probe for tests, which reports the lag set in its lags dict."""
+
+    def __init__(self, lags=None):
+        self.lags = lags if lags is not None else {}
+
+    def measure(self, connection):
+        return self.lags.get(connection.alias, 0.0)
+
+
+_PROBES = {
+    'postgresql': PostgreSQLLagProbe,
+    'mysql': MySQLLagProbe,
+}
+
+
+def get_probe(alias):
+    """
+    Return the lag probe for a database. This is controlled by defining
+    LAG_PROBE within the settings.DATABASES options, otherwise it is chosen
+    by the database vendor. Returns None for unsupported databases.
+    """
+    path = config.LAG_PROBES.get(alias)
+    if path:
+        return import_string(path)()
+    with connection_state.force(None):
+        vendor = connections[alias].vendor
+    probe_class = _PROBES.get(vendor)
+    return probe_class and probe_class()
+
+
+class ReplicaLagTable(object):
+    """
+    The most recently measured lag of each database, along with the HTTP
+    method mappings with stale databases removed. The mappings are rebuilt
+    whenever new lags are published, so reading them costs nothing extra.
+
+    """
+
+    def __init__(self, mappings=None, max_lags=None, fallback=None):
+        self.all_mappings = config.DATABASE_MAPPINGS if mappings is None else mappings
+        self.max_lags = config.MAX_LAGS if max_lags is None else max_lags
+        self.fallback = fallback or config.FALLBACK_DATABASE
+        self.lags = {}
+        self.sampled = 0.0
+        self.mappings = self.all_mappings
+
+    def is_stale(self, alias, lags=None):
+        max_lag = self.max_lags.get(alias)
+        if max_lag is None:
+            return False
+        lag = (self.lags if lags is None else lags).get(alias)
+        return lag is not None and lag > max_lag
+
+    def publish(self, lags, sampled=None):
+        """Replace the lags measured at the sampled time, and rebuild the mappings."""
+        mappings = {}
+        for method, aliases in self.all_mappings.items():
+            fresh = [alias for alias in aliases if not self.is_stale(alias, lags)]
+            mappings[method] = fresh or [self.fallback]
+        # Swap them all in at once, so readers never need a lock.
+        self.lags, self.sampled, self.mappings = lags, sampled or time.time(), mappings
+
+    def has_replicated(self, alias, timestamp):
+        """Return whether the database is known to contain writes made at the given time."""
+        lag = self.lags.get(alias)
+        return lag is not None and self.sampled - lag >= timestamp
+
+    def get_aliases_for_method(self, method):
+        mappings = self.mappings
+        return mappings.get(method) or mappings.get(None) or [DEFAULT_DB_ALIAS]
+
+
+class LagSampler(object):
+    """
+    Measures the lag of each database in a background thread and publishes
+    the results to a ReplicaLagTable. Each thread has its own connections in
+    Django, so sampling does not interfere with request threads.
+
+    """
+
+    def __init__(self, table, interval, probes=None):
+        self.table = table
+        self.interval = interval
+        if probes is None:
+            probes = {alias: get_probe(alias) for alias in table.max_lags}
+        self.probes = {alias: probe for alias, probe in probes.items() if probe}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def measure(self, alias, probe):
+        with connection_state.force(None):
+            connection = connections[alias]
+            try:
+                return probe.measure(connection)
+            except Exception:
+                logging.warning('Could not measure replication lag of %s', alias, exc_info=True)
+                connection.close()
+                # An unreachable database cannot be shown to be fresh.
+                return float('inf')
+
+    def sample(self):
+        """Measure every database once and publish the results."""
+        sampled = time.time()
+        lags = {alias: self.measure(alias, probe) for alias, probe in self.probes.items()}
+        self.table.publish(lags, sampled)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        if self.probes and not self.thread:
+            self.thread = threading.Thread(target=self.run, name='multidb-lag-sampler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+replica_lag = ReplicaLagTable()
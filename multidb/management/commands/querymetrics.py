@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from ...metrics import estimate_percentile, get_published_metrics, merge_metrics
+
+
+class Command(BaseCommand):
+
+    help = _('Show the query metrics published by each process.')
+
+    requires_migration_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', dest='as_json',
+                            help=_('Output the merged metrics as JSON'))
+        parser.add_argument('--by-process', action='store_true',
+                            help=_('Show the metrics of each process separately'))
+
+    def handle(self, as_json=False, by_process=False, **options):
+        published = get_published_metrics()
+        if by_process:
+            snapshots = published
+        else:
+            snapshots = {'all processes': merge_metrics(published.values())}
+
+        if as_json:
+            self.stdout.write(json.dumps(snapshots, indent=2, sort_keys=True))
+            return
+
+        if not published:
+            self.stdout.write('No metrics have been published. Set MULTIDB_METRICS_PUBLISH_INTERVAL to enable this.')
+            return
+
+        for name, snapshot in sorted(snapshots.items()):
+            self.stdout.write(f'{name}:')
+            self.stdout.write(
+                f'  {"alias":<20} {"class":<10} {"count":>10} {"errors":>8} {"retries":>8} {"rows":>12} '
+                f'{"mean ms":>10} {"p50 ms":>10} {"p99 ms":>10}'
+            )
+            for alias, classes in sorted(snapshot['aliases'].items()):
+                for sql_class, metrics in sorted(classes.items()):
+                    mean = metrics['time'] / metrics['count'] * 1000 if metrics['count'] else 0
+                    p50, p99 = (
+                        estimate_percentile(snapshot['bounds'], metrics['buckets'], pct)
+                        for pct in (50, 99)
+                    )
+                    self.stdout.write(
+                        f'  {alias:<20} {sql_class:<10} {metrics["count"]:>10} {metrics["errors"]:>8} '
+                        f'{metrics.get("retries", 0):>8} '
+                        f'{metrics["rows"]:>12} {mean:>10.2f} {format_bound(p50):>10} {format_bound(p99):>10}'
+                    )
+
+
+def format_bound(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return 'inf'
+    return '<=%g' % (seconds * 1000)
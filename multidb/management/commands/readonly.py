@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.translation import gettext as _
 
-from ...readonly import read_only_mode
+from ...readonly import CLUSTER, HOST, read_only_mode
 
 
 class Command(BaseCommand):
@@ -14,9 +15,14 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('action', action='store', choices=('enable', 'disable', 'status'),
                             help=_('Action to take'))
+        parser.add_argument('--scope', choices=(CLUSTER, HOST), default=HOST,
+                            help=_('Apply to the whole cluster, or only to this host (the default)'))
+        parser.add_argument('--alias',
+                            help=_('Apply only to writes to this database alias'))
 
-    def handle(self, action=None, **options):
-        outfp = self.stdout
+    def handle(self, action=None, scope=HOST, alias=None, **options):
+        if alias is not None and alias not in settings.DATABASES:
+            raise CommandError(f"unknown database alias '{alias}'")
 
         methods = {
             'enable': self.enable,
@@ -28,18 +34,26 @@ class Command(BaseCommand):
         except KeyError:
             raise CommandError(f"unknown action '{action}'")
         else:
-            method()
+            method(scope, alias)
 
-    def enable(self):
-        read_only_mode.enable()
-        self.status()
+    def enable(self, scope, alias):
+        read_only_mode.enable(scope, alias)
+        self.status(scope, alias)
 
-    def disable(self):
-        read_only_mode.disable()
-        self.status()
+    def disable(self, scope, alias):
+        read_only_mode.disable(scope, alias)
+        self.status(scope, alias)
 
-    def status(self):
+    def status(self, scope, alias):
         if read_only_mode:
             print('Server is in read-only mode')
         else:
             print('Server is in read/write mode')
+        for name, enabled in (
+            ('cluster', read_only_mode.is_enabled(CLUSTER)),
+            ('host', read_only_mode.is_enabled(HOST)),
+        ):
+            print(f'  {name}: {"read-only" if enabled else "read/write"}')
+        for db_alias in settings.DATABASES:
+            if read_only_mode.is_alias_read_only(db_alias):
+                print(f'  database {db_alias}: read-only')
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+In-process query metrics, recorded by the cursor wrappers.
+
+For each database alias and class of statement (read, write or savepoint)
+the registry counts queries, errors, retries and rows, and keeps a histogram
+of query latency. Each histogram has a fixed set of buckets, allocated when the
+alias and statement class are first seen, so memory use does not grow.
+
+Exporters can read the metrics of the current process with get_metrics().
+Processes can also publish their metrics to the cache, which is how the
+querymetrics management command reads them.
+
+"""
+import bisect
+import logging
+import os
+import socket
+import threading
+
+from django.core.cache import cache as cache_backend
+
+from . import settings as config
+
+PROCESSES_KEY = 'multidb.metrics.processes'
+
+
+class Histogram(object):
+    """
+    Counts of values falling into buckets with the given upper bounds. The
+    last bucket counts the values above the highest bound.
+
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+
+def estimate_percentile(bounds, counts, pct):
+    """
+    Estimate a percentile from histogram counts, as the upper bound of the
+    bucket that contains it. Returns None if there are no values, or
+    infinity if it falls into the last bucket.
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = pct / 100.0 * total
+    seen = 0
+    for bound, count in zip(bounds, counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return float('inf')
+
+
+class QueryMetrics(object):
+    """The metrics for one database alias and class of statement."""
+
+    def __init__(self, bounds):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.rows = 0
+        self.histogram = Histogram(bounds)
+
+    def record(self, elapsed, rows=0, error=False, count=1):
+        with self.lock:
+            self.count += count
+            self.rows += rows
+            if error:
+                self.errors += 1
+            self.histogram.observe(elapsed)
+
+    def retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'errors': self.errors,
+                'retries': self.retries,
+                'rows': self.rows,
+                'time': self.histogram.total,
+                'buckets': list(self.histogram.counts),
+            }
+
+
+class MetricsRegistry(object):
+    """
+    All query metrics of this process. Locking is limited to creating new
+    entries, and to each entry while it is updated or read.
+
+    """
+
+    def __init__(self, bounds=None):
+        self.bounds = sorted(bounds or config.METRICS_BUCKETS)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get_entry(self, alias, sql_class):
+        key = (alias, sql_class)
+        try:
+            return self.entries[key]
+        except KeyError:
+            with self.lock:
+                return self.entries.setdefault(key, QueryMetrics(self.bounds))
+
+    def record(self, alias, sql_class, elapsed, rows=0, error=False, count=1):
+        """Record a query, or a batch of count queries, which took elapsed seconds."""
+        self.get_entry(alias, sql_class).record(elapsed, rows, error, count)
+
+    def record_retry(self, alias, sql_class):
+        """Record that a failed query on the alias was run again on another database."""
+        self.get_entry(alias, sql_class).retry()
+
+    def snapshot(self):
+        """
+        Return the metrics in the format
+        {
+            'bounds': [bound1, bound2, ...],
+            'aliases': {
+                alias: {
+                    sql_class: {
+                        'count': n, 'errors': n, 'retries': n, 'rows': n, 'time': seconds, 'buckets': [n, ...],
+                    },
+                    ...
+                },
+                ...
+            },
+        }
+        """
+        aliases = {}
+        for (alias, sql_class), entry in list(self.entries.items()):
+            aliases.setdefault(alias, {})[sql_class] = entry.snapshot()
+        return {'bounds': list(self.bounds), 'aliases': aliases}
+
+    def reset(self):
+        with self.lock:
+            self.entries = {}
+
+    @property
+    def process_key(self):
+        return 'multidb.metrics:%s:%d' % (socket.gethostname(), os.getpid())
+
+    def publish(self, cache=cache_backend, timeout=None):
+        """
+        Store a snapshot in the cache, and add this process to the list of
+        processes that have published metrics.
+        """
+        timeout = timeout or config.METRICS_PUBLISH_INTERVAL * 3
+        key = self.process_key
+        cache.set(key, self.snapshot(), timeout)
+        # Another process may be updating the list at the same time, but
+        # anything lost is added back when that process publishes again.
+        processes = cache.get(PROCESSES_KEY) or []
+        if key not in processes:
+            cache.set(PROCESSES_KEY, [other for other in processes if cache.get(other)] + [key], None)
+
+
+class MetricsPublisher(object):
+    """Publishes the registry's metrics to the cache in a background thread."""
+
+    def __init__(self, registry, interval, cache=cache_backend):
+        self.registry = registry
+        self.interval = interval
+        self.cache = cache
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.registry.publish(self.cache)
+            except Exception:
+                logging.warning('Could not publish database metrics', exc_info=True)
+
+    def start(self):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, name='multidb-metrics', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def get_published_metrics(cache=cache_backend):
+    """Return the metrics published by each process, keyed by process."""
+    processes = cache.get(PROCESSES_KEY) or []
+    return {key: value for key, value in cache.get_many(processes).items() if value}
+
+
+def merge_metrics(snapshots):
+    """Add together metrics snapshots taken with the same histogram bounds."""
+    merged = {'bounds': None, 'aliases': {}}
+    for snapshot in snapshots:
+        merged['bounds'] = snapshot['bounds']
+        for alias, classes in snapshot['aliases'].items():
+            for sql_class, metrics in classes.items():
+                total = merged['aliases'].setdefault(alias, {}).get(sql_class)
+                if total is None:
+                    merged['aliases'][alias][sql_class] = dict(metrics, buckets=list(metrics['buckets']))
+                else:
+                    for name in ('count', 'errors', 'rows', 'time'):
+                        total[name] += metrics[name]
+                    # Processes running an older version don't count retries.
+                    total['retries'] = total.get('retries', 0) + metrics.get('retries', 0)
+                    total['buckets'] = [a + b for a, b in zip(total['buckets'], metrics['buckets'])]
+    return merged
+
+
+metrics = MetricsRegistry()
+
+
+def get_metrics():
+    """Return a snapshot of this process's query metrics, for exporters."""
+    return metrics.snapshot()
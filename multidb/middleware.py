@@ -5,19 +5,29 @@ request's HTTP method.
 
 The databases used will depend on the value of 'HTTP_METHODS' defined in
 settings.DATABASES. If more than one database is configured for the same
-HTTP method, then this middleware will randomly choose one per-request.
+HTTP method, then this middleware will choose one per-request using the
+balancer configured with the MULTIDB_BALANCER setting.
 
 """
 
-import random
+import logging
+import time
 
+from asgiref.sync import sync_to_async
 from django.core.exceptions import MiddlewareNotUsed
 from django.db import connection, DEFAULT_DB_ALIAS
 from django.utils.deprecation import MiddlewareMixin
 
 from . import settings as config
+from .balancer import balancer
+from .breaker import circuit_breaker
+from .budgets import QueryBudget, RequestBudgets
 from .connection import connection_state
+from .lag import replica_lag
 from .readonly import read_only_mode
+from .signals import repeated_queries
+
+_STICKY_SALT = 'multidb.sticky'
 
 
 class MultiDBMiddleware(MiddlewareMixin):
@@ -28,17 +38,28 @@ class MultiDBMiddleware(MiddlewareMixin):
         if not config.DATABASE_MAPPINGS and not config.READ_ONLY_DATABASES:
             raise MiddlewareNotUsed
 
+    async def __acall__(self, request):
+        """
+        Handle a request under ASGI. The routing state is held in context
+        variables, so it belongs to this request's task and can be set from
+        the event loop. Unlike MiddlewareMixin, this doesn't switch to a
+        thread to call process_request and process_response, unless the
+        read-only mode has to be fetched from the cache backend, which would
+        block the event loop (or fail, with the database cache backend).
+        """
+        if not read_only_mode.is_fresh():
+            await sync_to_async(read_only_mode.load)()
+        self.process_request(request)
+        response = await self.get_response(request)
+        return self.process_response(request, response)
+
     def get_aliases_for_path(self, path):
         """
         See if the current request path has been configured to use any
         particular databases. This is controlled by defining HTTP_PATHS
         within the settings.DATABASES options.
         """
-        db_aliases = []
-        for db_alias, paths_regex in config.DATABASE_PATHS.items():
-            if paths_regex.search(path):
-                db_aliases.append(db_alias)
-        return db_aliases
+        return config.DATABASE_PATHS.get_aliases(path)
 
     def get_aliases_for_method(self, method):
         """
@@ -47,38 +68,113 @@ class MultiDBMiddleware(MiddlewareMixin):
         settings.DATABASES options, will fallback to any databases that
         have no methods defined and default to "default" if the method has
         not been specified anywhere or where a d.
+
+        Databases ejected by the circuit breaker and databases lagging by
+        more than their MAX_LAG are skipped, falling back to the
+        FALLBACK_DATABASE when no database qualifies.
         """
-        return config.DATABASE_MAPPINGS.get(method) or \
-               config.DATABASE_MAPPINGS.get(None) or \
-               [DEFAULT_DB_ALIAS]
+        db_aliases = replica_lag.get_aliases_for_method(method)
+        if circuit_breaker is not None:
+            db_aliases = circuit_breaker.filter(db_aliases)
+        return db_aliases
 
     def override_for_readonly(self, db_aliases):
         """
         Override and use a read-only database when in read-only mode. This is
         controlled by defining READ_ONLY or READ_ONLY_WARNING within the
-        settings.DATABASES options. This is slightly more complicated than
-        necessary so it can avoid unnecessarily checking the value of
-        read_only_mode (which accesses memcache).
+        settings.DATABASES options. The mode is read from the snapshot taken
+        when the request started.
         """
-        if config.READ_ONLY_DATABASES:
+        if config.READ_ONLY_DATABASES and connection_state.read_only:
             for alias in db_aliases:
                 if alias not in config.READ_ONLY_DATABASES_SET:
-                    # One of the options is not a read database,
-                    # so read-only mode will have to be checked.
-                    if read_only_mode:
-                        db_aliases = config.READ_ONLY_DATABASES
-                    break
+                    # One of the options is not a read database.
+                    return config.READ_ONLY_DATABASES
+        return db_aliases
+
+    def get_recent_write(self, request):
+        """
+        Return the alias and time of the client's last write, as recorded in
+        the cookie set by process_response, or None if there was no write in
+        the last MULTIDB_STICKY_WINDOW seconds.
+        """
+        value = request.get_signed_cookie(
+            config.STICKY_COOKIE, default=None, salt=_STICKY_SALT, max_age=config.STICKY_WINDOW,
+        )
+        if value:
+            timestamp, _, alias = value.partition(':')
+            if alias in config.ROUTED_DATABASES_SET:
+                try:
+                    return alias, float(timestamp)
+                except ValueError:
+                    pass
+        return None
+
+    def override_for_recent_write(self, request, db_aliases):
+        """
+        Use the database that the client last wrote to, so it can read its
+        own writes, along with the databases that are known to have
+        replicated the write. This lasts for MULTIDB_STICKY_WINDOW seconds.
+        """
+        if config.STICKY_WINDOW:
+            recent_write = self.get_recent_write(request)
+            if recent_write:
+                alias, timestamp = recent_write
+                replicated = [
+                    db_alias for db_alias in db_aliases
+                    if db_alias != alias and replica_lag.has_replicated(db_alias, timestamp)
+                ]
+                db_aliases = [alias] + replicated
         return db_aliases
 
+    def report_repeated_queries(self, request):
+        """
+        Report the SQL statements which ran more than the threshold number of
+        times in this request, with the repeated_queries signal and a warning.
+        """
+        query_counts = connection_state.query_counts
+        if query_counts:
+            repeated = {
+                fingerprint: count for fingerprint, count in query_counts.items()
+                if count > config.REPEATED_QUERY_THRESHOLD
+            }
+            if repeated:
+                repeated_queries.send(sender=self.__class__, request=request, queries=repeated)
+                for fingerprint, count in sorted(repeated.items(), key=lambda item: -item[1]):
+                    logging.warning(
+                        'Repeated query in %s %s: %d times: %s', request.method, request.path, count, fingerprint,
+                    )
+
+    def get_budgets(self, request):
+        """
+        Create the query budgets of the request: the budget of the longest
+        prefix of its path in MULTIDB_PATH_BUDGETS, if any, and the budgets
+        of the databases it uses, which are created when first queried.
+        """
+        path_budget = None
+        prefixes = config.PATH_BUDGET_PATHS.get_aliases(request.path)
+        if prefixes:
+            prefix = max(prefixes, key=len)
+            path_budget = QueryBudget(prefix, *config.PATH_BUDGETS[prefix])
+        return RequestBudgets(path_budget)
+
     def process_request(self, request):
+        connection_state.start_request()
+        if config.REPEATED_QUERY_THRESHOLD is not None:
+            connection_state.query_counts = {}
+        if config.QUERY_BUDGETS or config.PATH_BUDGETS:
+            connection_state.budgets = self.get_budgets(request)
+
         db_aliases = self.get_aliases_for_path(request.path)
         if not db_aliases:
-            db_aliases = self.override_for_readonly(self.get_aliases_for_method(request.method))
+            db_aliases = self.get_aliases_for_method(request.method)
+            db_aliases = self.override_for_recent_write(request, db_aliases)
+            db_aliases = self.override_for_readonly(db_aliases)
 
         if len(db_aliases) == 1:
             connection_state.alias = db_aliases[0]
         elif db_aliases:
-            connection_state.alias = random.choice(db_aliases)
+            connection_state.alias = balancer.choose(db_aliases)
         else:
             # This request method is not specified in the settings,
             # so use the default database connection.
@@ -88,7 +184,13 @@ class MultiDBMiddleware(MiddlewareMixin):
         del connection_state.alias
 
     def process_response(self, request, response):
-        del connection_state.alias
+        if connection_state.wrote and config.STICKY_WINDOW:
+            response.set_signed_cookie(
+                config.STICKY_COOKIE, f'{time.time():.3f}:{connection_state.wrote}', salt=_STICKY_SALT,
+                max_age=config.STICKY_WINDOW, httponly=True, samesite='Lax',
+            )
+        self.report_repeated_queries(request)
+        connection_state.end_request()
         return response
 
 
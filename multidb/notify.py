@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Notification backends, which tell the processes that are listening that the
+read-only mode has changed, so they don't wait for their local copy of it
+to expire.
+
+The backend is configured with the MULTIDB_READ_ONLY_NOTIFIER setting, which
+is off by default, and MULTIDB_READ_ONLY_NOTIFIER_OPTIONS holds keyword
+arguments for it. Other
+backends (for example using Redis pub/sub across hosts) can subclass
+Notifier.
+
+"""
+import atexit
+import glob
+import logging
+import os
+import socket
+import tempfile
+import threading
+import uuid
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from . import settings as config
+
+
+class Notifier(object):
+
+    def notify(self):
+        """Tell every listening process that the read-only mode has changed."""
+        raise NotImplementedError
+
+    def listen(self, callback):
+        """Call the callback, from a background thread, for each notification."""
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class FileNotifier(Notifier):
+    """
+    Notifies by replacing a file, which every process watches. This needs no
+    external service, and reaches other hosts if the file is on a shared
+    filesystem. The path defaults to the MULTIDB_READ_ONLY_NOTIFY_PATH setting.
+
+    """
+
+    def __init__(self, path=None, interval=0.1):
+        self.path = path or config.READ_ONLY_NOTIFY_PATH
+        if not self.path:
+            raise ImproperlyConfigured('FileNotifier needs a path, such as MULTIDB_READ_ONLY_NOTIFY_PATH.')
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def notify(self):
+        temp_path = f'{self.path}.{uuid.uuid4().hex}'
+        with open(temp_path, 'w') as temp_file:
+            temp_file.write(uuid.uuid4().hex)
+        os.replace(temp_path, self.path)
+
+    def get_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def listen(self, callback):
+        def run():
+            signature = self.get_signature()
+            while not self.stopped.wait(self.interval):
+                new_signature = self.get_signature()
+                if new_signature != signature:
+                    signature = new_signature
+                    _call(callback)
+
+        threading.Thread(target=run, name='multidb-readonly-file', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class UnixSocketNotifier(Notifier):
+    """
+    Notifies by sending a datagram to a Unix socket for each listening process
+    on this host. The sockets are created in the given directory.
+
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'multidb.readonly.d')
+        self.socket = None
+        self.stopped = threading.Event()
+
+    def notify(self):
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            for path in glob.glob(os.path.join(self.directory, '*.sock')):
+                try:
+                    sender.sendto(b'changed', path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # The process has gone away without removing its socket.
+                    _remove(path)
+                except OSError:
+                    logging.warning('Could not notify %s' % path, exc_info=True)
+        finally:
+            sender.close()
+
+    def listen(self, callback):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.sock')
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        atexit.register(_remove, path)
+
+        def run():
+            while True:
+                self.socket.recv(64)
+                if self.stopped.is_set():
+                    break
+                _call(callback)
+            self.socket.close()
+            _remove(path)
+
+        threading.Thread(target=run, name='multidb-readonly-socket', daemon=True).start()
+
+    def stop(self):
+        if self.socket is not None:
+            self.stopped.set()
+            # Wake up the listening thread, which closes the socket.
+            sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                sender.sendto(b'stop', self.socket.getsockname())
+            except OSError:
+                # The socket file has already been removed.
+                self.socket.close()
+            finally:
+                sender.close()
+
+
+def _call(callback):
+    try:
+        callback()
+    except Exception:
+        logging.warning('Could not update the read-only mode', exc_info=True)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def get_notifier(path=None, options=None):
+    """Create the notification backend configured in the settings, if any."""
+    path = path or config.READ_ONLY_NOTIFIER
+    if not path:
+        return None
+    return import_string(path)(**(options if options is not None else config.READ_ONLY_NOTIFIER_OPTIONS))
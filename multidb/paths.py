@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Matching of request paths against the HTTP_WRITE_PATHS of each database.
+
+"""
+import functools
+import re
+
+_TERMINAL = ''
+
+
+def _trie_pattern(node):
+    """Build a regex pattern from a prefix trie, preferring longer matches."""
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    if _TERMINAL in node:
+        return '(?:%s)?' % '|'.join(branches)
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:%s)' % '|'.join(branches)
+
+
+class PathRouter(object):
+    """
+    Finds all databases that have been configured to use a request path,
+    in a single regex match.
+
+    All path prefixes are compiled into one regex shaped like a prefix trie,
+    which matches the longest configured prefix of a path. Every prefix is
+    mapped to the databases for it and for all shorter prefixes of it, so
+    the longest prefix gives the complete result.
+
+    Results are remembered for the most recently used paths.
+
+    """
+
+    def __init__(self, paths, cache_size=1024):
+        """
+        Takes a mapping of database alias to a list of path prefixes, in the
+        order that the databases should be returned.
+        """
+        self.paths = paths
+
+        trie = {}
+        prefix_aliases = {}
+        for alias, prefixes in paths.items():
+            for prefix in prefixes:
+                node = trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                node[_TERMINAL] = {}
+                prefix_aliases.setdefault(prefix, set()).add(alias)
+
+        self.regex = re.compile(_trie_pattern(trie)) if trie else None
+        self.aliases = {}
+        for prefix in prefix_aliases:
+            matching = set()
+            for length in range(len(prefix) + 1):
+                matching.update(prefix_aliases.get(prefix[:length], ()))
+            self.aliases[prefix] = tuple(alias for alias in paths if alias in matching)
+
+        self.get_aliases = functools.lru_cache(maxsize=cache_size)(self._get_aliases)
+
+    def __bool__(self):
+        return self.regex is not None
+
+    def _get_aliases(self, path):
+        if self.regex is not None:
+            match = self.regex.match(path)
+            if match:
+                return self.aliases[match.group()]
+        return ()
@@ -1,62 +1,607 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import collections
 import contextlib
-import itertools
+import contextvars
+import copy
+import logging
 import threading
-from queue import Queue, Empty
+import time
+import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 from django.db import connections
+from django.db.utils import load_backend
 
-from .connection import connection_state
+from .connection import connection_state, resolved_connection
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# Every pool, so they can be filled when the application starts.
+pools = weakref.WeakSet()
+
+
+def interrupt(wrapper):
+    """Stop the statement running on a connection object, from another thread, if the driver can."""
+    with connection_state.force(None):
+        connection = wrapper.connection
+    # psycopg2 and sqlite3 can stop a statement from another thread.
+    for name in ('cancel', 'interrupt'):
+        method = getattr(connection, name, None)
+        if method is not None:
+            method()
+            return True
+    return False
+
+
+def create_connection(alias):
+    """Create a new connection object for the alias, as Django does on first use in a thread."""
+    connections.ensure_defaults(alias)
+    connections.prepare_test_settings(alias)
+    settings_dict = connections.databases[alias]
+    backend = load_backend(settings_dict['ENGINE'])
+    return backend.DatabaseWrapper(settings_dict, alias)
+
+
+class Checkout(object):
+    """A connection that has been taken from the pool, for leak detection."""
+
+    def __init__(self, stack=None):
+        self.started = time.monotonic()
+        self.thread = threading.current_thread().name
+        self.stack = stack
+        self.reported = False
 
 
 class TemporaryConnectionPool(object):
     """
-    An unlimited pool of temporary connections which can be used in
-    isolation. An instance of this class should be created at the process
-    level. Threads can safely "get" a connection using the get() context
-    manager and have sole access to it for the duration of the context.
+    A pool of temporary connections which can be used in isolation. An
+    instance of this class should be created at the process level. Threads
+    can safely "get" a connection using the get() context manager and have
+    sole access to it for the duration of the context.
+
+    The pool is unlimited unless max_size is given. When that many
+    connections are in use, get() waits up to timeout seconds (or forever)
+    for one to be released, and then raises PoolTimeout.
+
+    Connections that have been idle for more than max_idle seconds are
+    discarded, keeping at least min_size of them. Connections checked out for
+    more than leak_threshold seconds are logged with the stack that took them.
+
+    The connections use a fixed set of aliases, which are preallocated when
+    there is a max_size, and are reused when the pool shrinks and grows again.
+    Each alias has its own copy of the settings of from_alias.
+
+    By default each connection is closed when it is released. With reuse,
+    the pool keeps the database connections open instead: any transaction
+    left open is rolled back on release, and on checkout connections are
+    checked with a cheap liveness query and reopened if they are older than
+    max_lifetime seconds. Connections idle for more than keepalive seconds
+    are checked in the background too, so that the server or a firewall
+    doesn't drop them for being idle.
 
     """
 
-    def __init__(self, alias_prefix, from_alias='default'):
+    def __init__(self, alias_prefix, from_alias='default', max_size=None, min_size=0,
+                 timeout=None, max_idle=None, leak_threshold=None, reuse=False, max_lifetime=None,
+                 keepalive=None):
         self.prefix = alias_prefix
         self.from_alias = from_alias
-        self.count = itertools.count(1)
-        self.lock = threading.Lock()
-        self.connections = Queue()
+        self.max_size = max_size
+        self.min_size = min_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.leak_threshold = leak_threshold
+        self.reuse = reuse
+        self.max_lifetime = max_lifetime
+        self.keepalive = keepalive
+        # With reuse, the pool owns the connection object of each alias, and
+        # knows when it may have opened its database connection.
+        self.wrappers = {}
+        self.opened = {}
+        self.lock = threading.Condition()
+        # Aliases without a connection, which can be used for new ones.
+        self.slots = collections.deque()
+        self.slot_count = 0
+        # Released aliases and when they were released, oldest first.
+        self.idle = collections.deque()
+        # When idle connections were last checked by the keepalive.
+        self.pinged = {}
+        self.size = 0
+        self.checked_out = {}
+        self.reaper = None
+        self.closed = False
+
+        if max_size is not None:
+            for _ in range(max_size):
+                self.slots.append(self._new_slot())
+        pools.add(self)
+
+    def _new_slot(self):
+        """Add an alias to the pool, with a copy of the details of another."""
+        self.slot_count += 1
+        alias = f'{self.prefix}{self.slot_count}'
+        connections.databases[alias] = copy.deepcopy(connections.databases[self.from_alias])
+        return alias
 
     def _new_connection(self):
         """Create a new unique connection, using details from another."""
         with self.lock:
-            alias = f'{self.prefix}{next(self.count)}'
-            connections.databases[alias] = connections.databases[self.from_alias]
+            alias = self.slots.popleft() if self.slots else self._new_slot()
 
+        if self.reuse:
+            with connection_state.force(None):
+                wrapper = create_connection(alias)
+                # The pool makes sure that one thread uses it at a time.
+                wrapper.inc_thread_sharing()
+            self.wrappers[alias] = wrapper
+        else:
             # initialise the "lock" connection
             with connection_state.force(None):
                 _ = connections[alias]
         return alias
 
+    def _reinitialise(self, alias):
+        # reinitialise the "lock" connection
+        with connection_state.force(None):
+            if hasattr(connections._connections, alias):
+                delattr(connections._connections, alias)
+                resolved_connection.clear()
+            _ = connections[alias]
+
+    def _check_out(self, alias):
+        """Validate a kept connection and make it the alias's connection in this thread."""
+        wrapper = self.wrappers[alias]
+        with connection_state.force(None):
+            if wrapper.connection is not None:
+                expired = (
+                    self.max_lifetime is not None and
+                    time.monotonic() - self.opened.get(alias, 0) > self.max_lifetime
+                )
+                if expired or not wrapper.is_usable():
+                    wrapper.close()
+            if wrapper.connection is None:
+                # It will be connected when it is first used.
+                self.opened[alias] = time.monotonic()
+            setattr(connections._connections, alias, wrapper)
+            resolved_connection.clear()
+
+    def _reset(self, alias):
+        """Undo any changes to a kept connection, or close it."""
+        wrapper = self.wrappers[alias]
+        with connection_state.force(None):
+            try:
+                if wrapper.connection is not None:
+                    if wrapper.in_atomic_block:
+                        # Released from inside a transaction.atomic block.
+                        wrapper.close()
+                    elif not wrapper.get_autocommit():
+                        # Roll back without sending the post_rollback signal.
+                        wrapper._rollback()
+                        wrapper.set_autocommit(True)
+            except Exception:
+                wrapper.close()
+            finally:
+                if getattr(connections._connections, alias, None) is wrapper:
+                    delattr(connections._connections, alias)
+                    resolved_connection.clear()
+
+    def _discard(self, alias):
+        """
+        Evict an alias from the pool and free its slot, with the lock held.
+        Returns its connection object, if the pool kept one, which must be
+        passed to _close() once the lock is released.
+        """
+        wrapper = self.wrappers.pop(alias, None)
+        self.opened.pop(alias, None)
+        self.pinged.pop(alias, None)
+        if self.closed:
+            connections.databases.pop(alias, None)
+        else:
+            self.slots.append(alias)
+        return wrapper
+
+    def _close(self, alias, wrapper):
+        """Close the connection of a discarded alias, without holding the lock."""
+        if wrapper is None:
+            return
+        with connection_state.force(None):
+            try:
+                wrapper.close()
+            except Exception:
+                logging.warning('Could not close %s' % alias, exc_info=True)
+            wrapper.dec_thread_sharing()
+
+    def acquire(self, timeout=None):
+        """
+        Take a connection from the pool, or create one, and return its alias.
+        It must be returned with release().
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.lock:
+            while True:
+                if self.idle:
+                    # The most recently used connection, so that the others
+                    # can become idle for long enough to be evicted.
+                    alias = self.idle.pop()[0]
+                    break
+                if self.max_size is None or self.size < self.max_size:
+                    self.size += 1
+                    alias = None
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout(f'All {self.max_size} connections of the {self.prefix} pool are in use')
+                self.lock.wait(remaining)
+
+        try:
+            if alias is None:
+                alias = self._new_connection()
+            elif not self.reuse:
+                self._reinitialise(alias)
+            if self.reuse:
+                self._check_out(alias)
+        except Exception:
+            wrapper = None
+            with self.lock:
+                self.size -= 1
+                if alias is not None:
+                    wrapper = self._discard(alias)
+                self.lock.notify()
+            self._close(alias, wrapper)
+            raise
+
+        stack = traceback.format_stack()[:-1] if self.leak_threshold else None
+        with self.lock:
+            self.checked_out[alias] = Checkout(stack)
+        self._start_reaper()
+        return alias
+
+    def release(self, alias):
+        """Close or reset a connection and return it to the pool."""
+        try:
+            if self.reuse:
+                self._reset(alias)
+            else:
+                with connection_state.force(None):
+                    connections[alias].close()
+                    # Don't leave a connection object in every thread that used the alias.
+                    delattr(connections._connections, alias)
+                    resolved_connection.clear()
+        finally:
+            wrapper = None
+            with self.lock:
+                self.checked_out.pop(alias, None)
+                if self.closed:
+                    self.size -= 1
+                    wrapper = self._discard(alias)
+                else:
+                    self.idle.append((alias, time.monotonic()))
+                self.lock.notify()
+            self._close(alias, wrapper)
+
     @contextlib.contextmanager
-    def get(self):
+    def get(self, timeout=None):
         """
         Get or create a database connection for temporary use.
-        The connection is automatically closed when the context exits.
+        The connection is automatically closed (or reset, with reuse)
+        when the context exits.
 
         """
+        alias = self.acquire(timeout)
         try:
-            alias = self.connections.get(block=False)
+            yield alias
+        finally:
+            self.release(alias)
+
+    def fill(self):
+        """
+        Create connections until the pool has min_size of them. With reuse,
+        they are connected to the database too.
+        """
+        while True:
+            with self.lock:
+                if self.size >= self.min_size:
+                    break
+                self.size += 1
+            alias = None
+            try:
+                alias = self._new_connection()
+                if self.reuse:
+                    with connection_state.force(None):
+                        self.wrappers[alias].ensure_connection()
+                    self.opened[alias] = time.monotonic()
+            except Exception:
+                wrapper = None
+                with self.lock:
+                    self.size -= 1
+                    if alias is not None:
+                        wrapper = self._discard(alias)
+                self._close(alias, wrapper)
+                raise
+            with self.lock:
+                self.idle.append((alias, time.monotonic()))
+                self.lock.notify()
+        self._start_reaper()
+
+    def evict_idle(self):
+        """Discard connections that have been idle for more than max_idle seconds."""
+        if self.max_idle is None:
+            return
+        expired = time.monotonic() - self.max_idle
+        discarded = []
+        with self.lock:
+            while self.idle and self.size > self.min_size and self.idle[0][1] < expired:
+                alias = self.idle.popleft()[0]
+                self.size -= 1
+                discarded.append((alias, self._discard(alias)))
+        for alias, wrapper in discarded:
+            self._close(alias, wrapper)
 
-            # reinitialise the "lock" connection
+    def ping_idle(self):
+        """
+        Check the kept connections that have been idle for more than
+        keepalive seconds, and close the ones that don't respond, so they
+        are reopened when they are next used.
+        """
+        if not self.reuse or self.keepalive is None:
+            return
+        due = time.monotonic() - self.keepalive
+        with self.lock:
+            # Taken out of the pool while they are checked.
+            pinging = [
+                (alias, released) for alias, released in self.idle
+                if max(released, self.pinged.get(alias, 0)) < due
+            ]
+            if not pinging:
+                return
+            self.idle = collections.deque(entry for entry in self.idle if entry not in pinging)
+
+        for alias, released in pinging:
+            wrapper = self.wrappers[alias]
             with connection_state.force(None):
-                if hasattr(connections._connections, alias):
-                    delattr(connections._connections, alias)
-                _ = connections[alias]
+                try:
+                    if wrapper.connection is not None and not wrapper.is_usable():
+                        wrapper.close()
+                except Exception:
+                    logging.warning('Could not check %s' % alias, exc_info=True)
+                    wrapper.close()
+            self.pinged[alias] = time.monotonic()
+
+        discarded = []
+        with self.lock:
+            if self.closed:
+                for alias, released in pinging:
+                    self.size -= 1
+                    discarded.append((alias, self._discard(alias)))
+            else:
+                # Put them back in order, so the oldest can still be evicted first.
+                self.idle = collections.deque(sorted(list(self.idle) + pinging, key=lambda entry: entry[1]))
+            self.lock.notify(len(pinging))
+        for alias, wrapper in discarded:
+            self._close(alias, wrapper)
+
+    def report_leaks(self):
+        """Log connections that have been checked out for more than leak_threshold seconds."""
+        if self.leak_threshold is None:
+            return
+        leaked = time.monotonic() - self.leak_threshold
+        with self.lock:
+            checkouts = [
+                (alias, checkout) for alias, checkout in self.checked_out.items()
+                if checkout.started < leaked and not checkout.reported
+            ]
+            for alias, checkout in checkouts:
+                checkout.reported = True
+        for alias, checkout in checkouts:
+            logging.warning(
+                'Connection %s has been checked out by %s for %.1fs, from:\n%s' % (
+                    alias, checkout.thread, time.monotonic() - checkout.started, ''.join(checkout.stack or ()),
+                )
+            )
+
+    def close(self):
+        """
+        Discard the idle connections and remove the free aliases. Connections
+        in use are discarded when they are released.
+        """
+        discarded = []
+        with self.lock:
+            self.closed = True
+            self.min_size = 0
+            while self.idle:
+                alias = self.idle.popleft()[0]
+                self.size -= 1
+                discarded.append((alias, self._discard(alias)))
+            while self.slots:
+                connections.databases.pop(self.slots.popleft(), None)
+        for alias, wrapper in discarded:
+            self._close(alias, wrapper)
+
+    def _start_reaper(self):
+        if self.reaper is None and (self.max_idle or self.leak_threshold or (self.reuse and self.keepalive)):
+            with self.lock:
+                if self.reaper is None:
+                    self.reaper = threading.Thread(target=self._reap, name=f'multidb-pool-{self.prefix}', daemon=True)
+                    self.reaper.start()
+
+    def _reap(self):
+        interval = min(value for value in (self.max_idle, self.leak_threshold, self.keepalive) if value) / 2.0
+        while not self.closed:
+            time.sleep(interval)
+            try:
+                self.evict_idle()
+                self.ping_idle()
+                self.report_leaks()
+            except Exception:
+                logging.warning('Could not maintain the %s connection pool' % self.prefix, exc_info=True)
+
+
+class AsyncConnection(object):
+    """A connection checked out of an AsyncConnectionPool."""
 
-        except Empty:
-            alias = self._new_connection()
+    def __init__(self, pool, alias):
+        self.pool = pool
+        self.alias = alias
+        self.lock = asyncio.Lock()
+        # The work being done with the connection in the executor, if any.
+        self.running = None
+
+    async def run(self, target, *args, **kwargs):
+        """
+        Call a function, or evaluate a queryset to a list, in one of the
+        pool's threads with the routing pinned to this connection. It runs in
+        a copy of the current context, so it sees the routing state of the
+        request. If this is cancelled, the statement is interrupted.
+        """
+        async with self.lock:
+            context = contextvars.copy_context()
+            self.running = self.pool.executor.submit(context.run, self._call, target, args, kwargs)
+            try:
+                return await asyncio.wrap_future(self.running)
+            except asyncio.CancelledError:
+                if not self.running.cancel():
+                    interrupt(self.pool.pool.wrappers[self.alias])
+                raise
+
+    def _call(self, target, args, kwargs):
+        # Any thread of the pool can use the connection, one at a time.
+        wrapper = self.pool.pool.wrappers[self.alias]
+        with connection_state.force(None):
+            setattr(connections._connections, self.alias, wrapper)
+            resolved_connection.clear()
         try:
-            yield alias
+            with connection_state.force(self.alias):
+                if callable(target):
+                    return target(*args, **kwargs)
+                return list(target)
         finally:
             with connection_state.force(None):
-                connections[alias].close()
-            self.connections.put(alias)
+                delattr(connections._connections, self.alias)
+                resolved_connection.clear()
+
+
+class AsyncConnectionPool(object):
+    """
+    A pool of connections for coroutines, which wait for a connection without
+    blocking the event loop:
+
+        async with pool.acquire() as connection:
+            rows = await connection.run(queryset)
+
+    The connections are kept open between checkouts (see the reuse option of
+    TemporaryConnectionPool, which takes the other options), and the blocking
+    database calls run in a thread pool with one thread per connection, so
+    many coroutines can share a few connections without a thread each.
+
+    """
+
+    def __init__(self, alias_prefix, from_alias='default', max_size=10, timeout=None, **options):
+        self.pool = TemporaryConnectionPool(
+            alias_prefix, from_alias, max_size=max_size, timeout=timeout, reuse=True, **options
+        )
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix=f'multidb-async-{alias_prefix}')
+        # Coroutines waiting for a connection, first come first served.
+        self.waiters = collections.deque()
+        # Counts releases, so acquire() knows if it missed one while it was busy.
+        self.releases = 0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout=None):
+        """
+        Take a connection from the pool for the duration of the context,
+        waiting up to timeout seconds (or forever) for one to be released.
+        """
+        connection = await self._acquire(timeout)
+        try:
+            yield connection
+        finally:
+            await self._release(connection)
+
+    async def _acquire(self, timeout):
+        loop = asyncio.get_running_loop()
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while True:
+            releases = self.releases
+            # Checking a connection can block, so it is done in a thread.
+            acquiring = loop.run_in_executor(self.executor, self._acquire_nowait)
+            try:
+                alias = await asyncio.shield(acquiring)
+            except PoolTimeout:
+                pass
+            except asyncio.CancelledError:
+                acquiring.add_done_callback(self._abandon)
+                raise
+            else:
+                return AsyncConnection(self, alias)
+            if self.releases != releases:
+                continue
+
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                raise PoolTimeout(f'All {self.pool.max_size} connections of the {self.pool.prefix} pool are in use')
+            waiter = loop.create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Pass the released connection on to the next coroutine.
+                    self._wake()
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+    def _acquire_nowait(self):
+        alias = self.pool.acquire(timeout=0)
+        # The connection is used from whichever thread runs each call.
+        with connection_state.force(None):
+            delattr(connections._connections, alias)
+            resolved_connection.clear()
+        return alias
+
+    def _abandon(self, acquiring):
+        """Release a connection that was taken for a coroutine that has been cancelled."""
+        if not acquiring.cancelled() and acquiring.exception() is None:
+            asyncio.ensure_future(self._reset(AsyncConnection(self, acquiring.result())))
+
+    async def _release(self, connection):
+        # The connection is returned to the pool even if this is cancelled.
+        await asyncio.shield(self._reset(connection))
+
+    async def _reset(self, connection):
+        if connection.running is not None and not connection.running.done():
+            # Wait for an interrupted call to finish before resetting the connection.
+            with contextlib.suppress(Exception):
+                await asyncio.wrap_future(connection.running)
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.pool.release, connection.alias)
+        finally:
+            self._wake()
+
+    def _wake(self):
+        self.releases += 1
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def close(self):
+        """Close the pool's connections, and stop its threads."""
+        self.pool.close()
+        self.executor.shutdown(wait=False)
@@ -3,7 +3,12 @@ import socket
 
 from django.core.cache import cache as cache_backend
 
+from . import settings as config
 from .cache.sluggish import SluggishCache
+from .notify import get_notifier
+
+CLUSTER = 'cluster'
+HOST = 'host'
 
 
 class ReadOnlyError(Exception):
@@ -14,19 +19,77 @@ class ReadOnlyError(Exception):
 
 
 class ReadOnlyManager(object):
+    """
+    The read-only mode, which can be enabled for the whole cluster, for this
+    host, or for writes to a single database alias. The mode is stored in the
+    cache, and changes are pushed to other processes by the notifier.
+
+    """
 
     cache = SluggishCache(cache_backend, delay=5)
+    cluster_key = 'multidb.readonly'
     cache_key = 'multidb.readonly:%s' % socket.gethostname()
+    alias_key = 'multidb.readonly.alias:%s'
+    notifier = get_notifier()
+
+    def get_key(self, scope=HOST, alias=None):
+        if alias is not None:
+            return self.alias_key % alias
+        if scope == CLUSTER:
+            return self.cluster_key
+        return self.cache_key
 
-    def enable(self):
+    def get_keys(self):
+        """
+        Return the keys of every scope that affects this host. Aliases added
+        later, such as those of connection pools, have no scope of their own.
+        """
+        return [self.cluster_key, self.cache_key] + [self.alias_key % alias for alias in self.get_aliases()]
+
+    def get_aliases(self):
+        return sorted(config.ROUTED_DATABASES_SET)
+
+    def enable(self, scope=HOST, alias=None):
         two_weeks = 60 * 60 * 24 * 14
-        self.cache.set(self.cache_key, True, two_weeks)
+        self.cache.set(self.get_key(scope, alias), True, two_weeks)
+        self.notify()
+
+    def disable(self, scope=HOST, alias=None):
+        self.cache.delete(self.get_key(scope, alias))
+        self.notify()
+
+    def notify(self):
+        if self.notifier is not None:
+            self.notifier.notify()
+
+    def refresh(self):
+        """Fetch the mode from the cache again, when notified of a change."""
+        for key in self.get_keys():
+            self.cache.expire(key)
+            self.cache.get(key)
+
+    def is_enabled(self, scope=HOST, alias=None):
+        """Return whether the mode is enabled in exactly this scope."""
+        return bool(self.cache.get(self.get_key(scope, alias)))
+
+    def is_fresh(self):
+        """Return whether the mode can be checked without going to the cache backend."""
+        is_fresh = getattr(self.cache, 'is_fresh', None)
+        return is_fresh is not None and all(is_fresh(key) for key in self.get_keys())
+
+    def load(self):
+        """Fetch any expired scopes of the mode from the cache backend."""
+        bool(self)
+        self.get_read_only_aliases()
+
+    def is_alias_read_only(self, alias):
+        return bool(self.cache.get(self.alias_key % alias))
 
-    def disable(self):
-        self.cache.delete(self.cache_key)
+    def get_read_only_aliases(self):
+        return frozenset(alias for alias in self.get_aliases() if self.is_alias_read_only(alias))
 
     def __bool__(self):
-        return bool(self.cache.get(self.cache_key))
+        return bool(self.cache.get(self.cluster_key) or self.cache.get(self.cache_key))
 
 
 read_only_mode = ReadOnlyManager()
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+A read-through cache for the results of SELECT queries on read-only databases.
+
+Results are stored in a Django cache, keyed by the database's replica group
+(its REPLICA_GROUP option, or else its NAME), the SQL and its params, and
+kept in local memory for a short time in front of it, like SluggishCache.
+Each entry records a version token for every table that the query reads.
+Writes replace the tokens of the tables they touch, after the transaction
+commits, so later lookups see the entries as stale. The tokens record when
+the tables were written, and results of tables written in the last
+lag_window seconds aren't cached, unless the replica is known to have
+replicated the write, as a lagging replica may still return the old rows.
+
+This is enabled with the MULTIDB_RESULT_CACHE setting.
+
+"""
+import collections
+import contextvars
+import functools
+import hashlib
+import logging
+import re
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+
+from . import settings as config
+from .lag import replica_lag
+from .settings import _get_option
+
+# The version key for every table, replaced when the tables that a write
+# touches cannot be determined.
+ALL_TABLES = '*'
+
+# How long after a write to its tables a query's results aren't cached, when
+# no database has a MAX_LAG.
+DEFAULT_LAG_WINDOW = 5.0
+
+_REPLICA_GROUP = 'REPLICA_GROUP'
+
+_IDENTIFIER = r'((?:[`"]?[\w$]+[`"]?\.)*[`"]?[\w$]+[`"]?)'
+
+READ_TABLES_RE = re.compile(r'\b(?:FROM|JOIN)\s+' + _IDENTIFIER, re.IGNORECASE)
+
+# Queries that should not be cached, such as those locking rows or listing
+# tables with commas, which READ_TABLES_RE would not find.
+UNCACHEABLE_RE = re.compile(
+    r'\bFOR\s+(?:UPDATE|SHARE|NO\s+KEY\s+UPDATE|KEY\s+SHARE)\b|'
+    r'\bFROM\s+' + _IDENTIFIER + r'(?:\s+(?:AS\s+)?[`"]?\w+[`"]?)?\s*,',
+    re.IGNORECASE,
+)
+
+WRITE_TABLE_RE = re.compile(
+    r'\s*(?:INSERT\s+(?:OR\s+\w+\s+|IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)'
+    r'\s+(?:ONLY\s+)?' + _IDENTIFIER,
+    re.IGNORECASE,
+)
+
+# Statements that are classified as writes but don't change any tables.
+NO_TABLES_RE = re.compile(r'\s*(?:BEGIN|START\s+TRANSACTION|COMMIT|ROLLBACK|END|SET|SHOW|RESET)\b', re.IGNORECASE)
+
+
+def _normalize_table(name):
+    return name.replace('"', '').replace('`', '').lower()
+
+
+@functools.lru_cache(maxsize=config.SQL_CACHE_SIZE)
+def get_read_tables(sql):
+    """
+    Return the tables that a SELECT statement reads, or None if its results
+    should not be cached. This is cached by the SQL text.
+    """
+    if UNCACHEABLE_RE.search(sql):
+        return None
+    tables = frozenset(_normalize_table(name) for name in READ_TABLES_RE.findall(sql))
+    return tables or None
+
+
+@functools.lru_cache(maxsize=config.SQL_CACHE_SIZE)
+def get_written_tables(sql):
+    """
+    Return the tables that a write statement touches, or None if they
+    cannot be determined. This is cached by the SQL text.
+    """
+    if NO_TABLES_RE.match(sql):
+        return frozenset()
+    match = WRITE_TABLE_RE.match(sql)
+    if match is None:
+        return None
+    return frozenset([_normalize_table(match.group(1))])
+
+
+def get_replica_group(settings_dict):
+    """
+    Return the name that a database shares with its replicas, so writes to it
+    make their cached results stale, and results of other databases are kept
+    apart: REPLICA_GROUP in its options, or else its NAME.
+    """
+    return str(_get_option(settings_dict, _REPLICA_GROUP) or settings_dict.get('NAME'))
+
+
+class CachedResult(object):
+    """
+    The result set of a query, served to the cursor wrapper from memory. Rows
+    beyond those in memory are fetched from the cursor, if there is one.
+
+    """
+
+    def __init__(self, description, rows, cursor=None, empty=()):
+        self.description = description
+        self.rows = rows
+        self.position = 0
+        self.cursor = cursor
+        # The driver's empty result from fetchmany(), which Django compares with.
+        self.empty = empty
+
+    @property
+    def rowcount(self):
+        return -1 if self.cursor is not None else len(self.rows)
+
+    def fetchone(self):
+        if self.position < len(self.rows):
+            self.position += 1
+            return self.rows[self.position - 1]
+        if self.cursor is not None:
+            return self.cursor.fetchone()
+        return None
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        if len(rows) < size and self.cursor is not None:
+            rows.extend(self.cursor.fetchmany(size - len(rows)))
+        return rows or self.empty
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        if self.cursor is not None:
+            rows.extend(self.cursor.fetchall())
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+class ResultCache(object):
+
+    def __init__(self, timeout=60, local_timeout=1, cache='default', max_rows=1000, local_size=1000,
+                 lag_window=None):
+        self.timeout = timeout
+        if lag_window is None:
+            lag_window = max(config.MAX_LAGS.values(), default=DEFAULT_LAG_WINDOW)
+        self.lag_window = lag_window
+        self.local_timeout = local_timeout
+        self.cache_alias = cache
+        self.max_rows = max_rows
+        self.local_size = local_size
+        self.local = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # The invalidations waiting for each alias's transaction to commit.
+        self.pending = contextvars.ContextVar('multidb.results.pending', default=None)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def make_key(self, sql, params, group=None):
+        digest = hashlib.sha1(f'{group}\0{sql.strip()}\0{params!r}'.encode('utf-8')).hexdigest()
+        return f'multidb.results:{digest}'
+
+    def version_keys(self, tables, group=None):
+        return [f'multidb.results.table:{group}:{table}' for table in sorted(tables)] + [
+            f'multidb.results.table:{group}:{ALL_TABLES}',
+        ]
+
+    def get(self, sql, params, tables, empty=(), group=None):
+        """
+        Look up the results of a query that reads the given tables of the
+        replica group. Returns a CachedResult, or None and the versions of
+        the tables, which must be passed to fetch() after running the query.
+        """
+        key = self.make_key(sql, params, group)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is not None and entry[0] > now:
+                self.local.move_to_end(key)
+                self.hits += 1
+                return CachedResult(entry[3], entry[4], empty=empty), None
+
+        version_keys = self.version_keys(tables, group)
+        try:
+            values = self.cache.get_many([key] + version_keys)
+        except Exception:
+            logging.warning('Could not read the query result cache', exc_info=True)
+            return None, None
+        versions = tuple(values.get(version_key) for version_key in version_keys)
+
+        entry = values.get(key)
+        if entry is not None and entry[0] == versions:
+            self.remember(key, group, tables, entry[1], entry[2], now)
+            self.hits += 1
+            return CachedResult(entry[1], entry[2], empty=empty), None
+        self.misses += 1
+        return None, versions
+
+    def is_replicated(self, versions, alias):
+        """Return whether the last writes to the tables have reached the database."""
+        now = time.time()
+        for version in versions:
+            timestamp, _, token = (version or '').partition(':')
+            if not token:
+                # Never written, or written before the tokens had times.
+                continue
+            written = float(timestamp)
+            if written > now - self.lag_window and not replica_lag.has_replicated(alias, written):
+                return False
+        return True
+
+    def fetch(self, cursor, sql, params, tables, versions, empty=(), alias=None, group=None):
+        """
+        Read the results of a query that has just run on the alias, in the
+        replica group, and cache them if there are no more than max_rows.
+        """
+        if cursor.description is None or not self.is_replicated(versions, alias):
+            return None
+        description = tuple(tuple(column) for column in cursor.description)
+        rows = list(cursor.fetchmany(self.max_rows + 1))
+        if len(rows) > self.max_rows:
+            return CachedResult(cursor.description, rows, cursor, empty)
+
+        rows = [tuple(row) for row in rows]
+        key = self.make_key(sql, params, group)
+        try:
+            self.cache.set(key, (versions, description, rows), self.timeout)
+        except Exception:
+            # The rows may contain values that cannot be pickled.
+            logging.debug('Could not cache query results', exc_info=True)
+            return CachedResult(cursor.description, rows, empty=empty)
+        self.remember(key, group, tables, description, rows, time.monotonic())
+        return CachedResult(cursor.description, rows, empty=empty)
+
+    def remember(self, key, group, tables, description, rows, now):
+        with self.lock:
+            self.local[key] = (now + self.local_timeout, group, tables, description, rows)
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def invalidate(self, tables=None, group=None):
+        """Make the cached results of the given tables, or of every table, of the replica group stale."""
+        tables = tables or (ALL_TABLES,)
+        with self.lock:
+            for key, entry in list(self.local.items()):
+                if entry[1] == group and (ALL_TABLES in tables or not entry[2].isdisjoint(tables)):
+                    del self.local[key]
+        version_keys = [f'multidb.results.table:{group}:{table}' for table in tables]
+        try:
+            written = f'{time.time():.3f}'
+            self.cache.set_many({version_key: f'{written}:{uuid.uuid4().hex}' for version_key in version_keys}, None)
+        except Exception:
+            logging.warning('Could not invalidate the query result cache', exc_info=True)
+
+    def invalidate_on_commit(self, alias, tables=None, group=None):
+        """Make the cached results of the tables stale once the alias's transaction commits."""
+        pending = self.pending.get()
+        if pending is None:
+            pending = {}
+            self.pending.set(pending)
+        pending.setdefault(alias, set()).add((tables, group))
+
+    def committed(self, alias):
+        """Run the invalidations of the alias's committed transaction."""
+        pending = self.pending.get()
+        if pending:
+            for tables, group in pending.pop(alias, ()):
+                self.invalidate(tables, group)
+
+    def rolled_back(self, alias):
+        """Forget the invalidations of the alias's rolled back transaction."""
+        pending = self.pending.get()
+        if pending:
+            pending.pop(alias, None)
+
+
+def get_result_cache():
+    """Create the result cache configured in the settings, if any."""
+    if config.RESULT_CACHE:
+        return ResultCache(**config.RESULT_CACHE)
+    return None
+
+
+result_cache = get_result_cache()
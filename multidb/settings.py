@@ -1,15 +1,29 @@
 # -*- coding: utf-8 -*-
 from collections import defaultdict
 from random import choice
-import re
 
 from django.conf import settings
 from django.db import DEFAULT_DB_ALIAS
 
+from .budgets import get_limits
+from .paths import PathRouter
+
 _OPTIONS = 'OPTIONS'
 _HTTP_METHODS = 'HTTP_METHODS'
 _HTTP_WRITE_PATHS = 'HTTP_WRITE_PATHS'
 _READ_ONLY_OPTIONS = ('READ_ONLY', 'READ_ONLY_WARNING')
+_MAX_LAG = 'MAX_LAG'
+_LAG_PROBE = 'LAG_PROBE'
+_QUERY_BUDGET = 'QUERY_BUDGET'
+_QUERY_TIME_BUDGET = 'QUERY_TIME_BUDGET'
+_QUERY_BUDGET_MODE = 'QUERY_BUDGET_MODE'
+
+
+def _get_option(options, name, default=None):
+    """Get a database option, which may also be defined within OPTIONS."""
+    if name in options:
+        return options[name]
+    return options.get(_OPTIONS, {}).get(name, default)
 
 
 def _build_mappings():
@@ -32,10 +46,11 @@ def _build_mappings():
 
 def _get_read_only_databases():
     result = set()
-    for db_alias, options in settings.DATABASES.items():
+    for db_alias, db_options in settings.DATABASES.items():
         for read_only_option in _READ_ONLY_OPTIONS:
+            options = db_options
             if read_only_option not in options:
-                options = options.get(_OPTIONS, [])
+                options = options.get(_OPTIONS, {})
             if options.get(read_only_option):
                 result.add(db_alias)
                 break
@@ -46,15 +61,77 @@ def _build_paths():
     """
     Built list of paths that should always use the master/write
     database, even for read requests
-    :return: mapping of urls/paths for each database
+    :return: router finding the databases for urls/paths
     """
     result = {}
     for db_alias, options in settings.DATABASES.items():
         paths = options.get(_HTTP_WRITE_PATHS)
         if paths:
-            any_path = '|'.join(re.escape(path) for path in paths)
-            regex = re.compile(r'^(%s)' % any_path)
-            result[db_alias] = regex
+            result[db_alias] = list(paths)
+    return PathRouter(result, cache_size=getattr(settings, 'MULTIDB_PATH_CACHE_SIZE', 1024))
+
+
+def _build_max_lags():
+    """
+    Build the maximum replication lag allowed for each database used by
+    HTTP methods, falling back to the MULTIDB_MAX_LAG setting.
+    :return: mapping of database alias to seconds
+    """
+    default = getattr(settings, 'MULTIDB_MAX_LAG', None)
+    result = {}
+    for db_alias in set(alias for aliases in DATABASE_MAPPINGS.values() for alias in aliases):
+        max_lag = _get_option(settings.DATABASES[db_alias], _MAX_LAG, default)
+        if max_lag is not None:
+            result[db_alias] = max_lag
+    return result
+
+
+def _build_lag_probes():
+    result = {}
+    for db_alias, options in settings.DATABASES.items():
+        probe = _get_option(options, _LAG_PROBE)
+        if probe:
+            result[db_alias] = probe
+    return result
+
+
+def _build_replica_siblings():
+    """
+    Find the other read-only databases that are used for the same HTTP
+    methods as each read-only database, which can run its reads instead.
+    :return: mapping of database alias to a list of aliases
+    """
+    result = defaultdict(set)
+    for aliases in DATABASE_MAPPINGS.values():
+        replicas = [alias for alias in aliases if alias in READ_ONLY_DATABASES_SET]
+        for alias in replicas:
+            result[alias].update(other for other in replicas if other != alias)
+    return {alias: sorted(siblings) for alias, siblings in result.items() if siblings}
+
+
+def _get_limits(options):
+    return get_limits(
+        _get_option(options, _QUERY_BUDGET),
+        _get_option(options, _QUERY_TIME_BUDGET),
+        _get_option(options, _QUERY_BUDGET_MODE),
+    )
+
+
+def _build_query_budgets():
+    result = {}
+    for alias, options in settings.DATABASES.items():
+        limits = _get_limits(options)
+        if limits:
+            result[alias] = limits
+    return result
+
+
+def _build_path_budgets():
+    result = {}
+    for prefix, options in getattr(settings, 'MULTIDB_PATH_BUDGETS', {}).items():
+        limits = _get_limits(options)
+        if limits:
+            result[prefix] = limits
     return result
 
 
@@ -66,6 +143,7 @@ def _build_paths():
 #   ...
 # }
 DATABASE_MAPPINGS = _build_mappings()
+ROUTED_DATABASES_SET = frozenset(alias for aliases in DATABASE_MAPPINGS.values() for alias in aliases)
 
 
 # Determine a single fallback database to use.
@@ -75,15 +153,149 @@ FALLBACK_DATABASE = choice(DATABASE_MAPPINGS.get(None) or [DEFAULT_DB_ALIAS])
 
 # Determine which paths should be excluded from each database.
 # For example, the /admin/ URLs should not be read-only.
-# It will be in the format
+# It will be a PathRouter built from
 # {
-#   alias1: '^(pathx1|pathx2|...|pathxN)'
-#   alias2: '^(pathy1|pathy2|...|pathyN)'
+#   alias1: [pathx1, pathx2, ..., pathxN]
+#   alias2: [pathy1, pathy2, ..., pathyN]
 #   ...
 # }
+# with the most recently used MULTIDB_PATH_CACHE_SIZE paths remembered.
 DATABASE_PATHS = _build_paths()
 
 
 # Determine which databases are for read-only purposes.
 READ_ONLY_DATABASES_SET = _get_read_only_databases()
 READ_ONLY_DATABASES = list(READ_ONLY_DATABASES_SET)
+
+
+# Determine the replication lag limits. Databases lagging by more than
+# their MAX_LAG (in seconds) are skipped. The lag is measured every
+# MULTIDB_LAG_INTERVAL seconds, or never if that is not set.
+# It will be in the format
+# {
+#   alias1: max_lag1,
+#   ...
+# }
+MAX_LAGS = _build_max_lags()
+LAG_PROBES = _build_lag_probes()
+LAG_INTERVAL = getattr(settings, 'MULTIDB_LAG_INTERVAL', None)
+
+
+# Determine how to choose between several databases configured for the same
+# request. This is the dotted path of a multidb.balancer.Balancer subclass,
+# and MULTIDB_BALANCER_OPTIONS holds keyword arguments for it.
+BALANCER = getattr(settings, 'MULTIDB_BALANCER', 'multidb.balancer.EWMABalancer')
+BALANCER_OPTIONS = getattr(settings, 'MULTIDB_BALANCER_OPTIONS', {})
+
+
+# Determine how long clients are pinned to the database they last wrote to,
+# so they can read their own writes. Set MULTIDB_STICKY_WINDOW to a number of
+# seconds to enable this. The write is recorded in a signed cookie.
+STICKY_WINDOW = getattr(settings, 'MULTIDB_STICKY_WINDOW', None)
+STICKY_COOKIE = getattr(settings, 'MULTIDB_STICKY_COOKIE', 'multidb_wrote')
+
+
+# Determine how many distinct SQL statements to remember the classification
+# (read, write, savepoint or session) of.
+SQL_CACHE_SIZE = getattr(settings, 'MULTIDB_SQL_CACHE_SIZE', 1024)
+
+
+# Determine whether the cursor wrappers record query metrics, and the upper
+# bounds (in seconds) of the latency histogram buckets. Processes publish
+# their metrics to the cache every MULTIDB_METRICS_PUBLISH_INTERVAL seconds,
+# or never if that is not set.
+METRICS = getattr(settings, 'MULTIDB_METRICS', True)
+METRICS_BUCKETS = getattr(settings, 'MULTIDB_METRICS_BUCKETS', (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+))
+METRICS_PUBLISH_INTERVAL = getattr(settings, 'MULTIDB_METRICS_PUBLISH_INTERVAL', None)
+
+
+# Determine whether slow queries are logged. This is a dict of keyword
+# arguments for multidb.slowlog.SlowQueryLog, for example
+# {
+#   'threshold': 0.5,  # seconds
+#   'sample_rate': 0.1,
+#   'path': '/var/log/app/slow_queries.jsonl',  # or 'logger': 'name'
+# }
+SLOW_QUERY_LOG = getattr(settings, 'MULTIDB_SLOW_QUERY_LOG', None)
+
+
+# Determine whether to report requests that run the same SQL statement (with
+# different values) more than this many times, which usually means an N+1
+# query problem. Set MULTIDB_REPEATED_QUERY_THRESHOLD to enable this.
+REPEATED_QUERY_THRESHOLD = getattr(settings, 'MULTIDB_REPEATED_QUERY_THRESHOLD', None)
+
+
+# Determine the query budgets of each request. Databases with QUERY_BUDGET
+# or QUERY_TIME_BUDGET limit the queries a request runs on them, and
+# MULTIDB_PATH_BUDGETS limits all queries of requests by path prefix, with
+# the same options. See multidb.budgets for QUERY_BUDGET_MODE.
+# They will be in the format
+# {
+#   alias_or_prefix: (max_queries, max_time, mode),
+#   ...
+# }
+QUERY_BUDGETS = _build_query_budgets()
+PATH_BUDGETS = _build_path_budgets()
+PATH_BUDGET_PATHS = PathRouter({prefix: [prefix] for prefix in PATH_BUDGETS})
+
+
+# Determine whether the results of SELECT queries on read-only databases are
+# cached. This is a dict of keyword arguments for multidb.results.ResultCache,
+# for example
+# {
+#   'timeout': 60,  # seconds in the cache backend
+#   'local_timeout': 1,  # seconds in local memory
+#   'cache': 'default',
+#   'max_rows': 1000,
+#   'lag_window': 5,  # seconds after a write that its tables aren't cached
+# }
+RESULT_CACHE = getattr(settings, 'MULTIDB_RESULT_CACHE', None)
+
+
+# Determine whether the read-only mode is refreshed from the cache by a
+# background thread before it expires locally, so that requests never wait
+# for the cache backend to check it.
+READ_ONLY_REFRESH_AHEAD = getattr(settings, 'MULTIDB_READ_ONLY_REFRESH_AHEAD', False)
+
+
+# Determine how changes to the read-only mode are pushed to other processes.
+# This is the dotted path of a multidb.notify.Notifier subclass, or None (the
+# default) to let each process wait for its copy of the mode to expire, and
+# MULTIDB_READ_ONLY_NOTIFIER_OPTIONS holds keyword arguments for it. The
+# FileNotifier watches the file at MULTIDB_READ_ONLY_NOTIFY_PATH.
+READ_ONLY_NOTIFIER = getattr(settings, 'MULTIDB_READ_ONLY_NOTIFIER', None)
+READ_ONLY_NOTIFIER_OPTIONS = getattr(settings, 'MULTIDB_READ_ONLY_NOTIFIER_OPTIONS', {})
+READ_ONLY_NOTIFY_PATH = getattr(settings, 'MULTIDB_READ_ONLY_NOTIFY_PATH', None)
+
+
+# Determine whether connections are opened when the application starts, so
+# the first requests don't pay for connecting. This is True for every
+# database, or a list of aliases. Connection pools that exist by then are
+# also filled to their min_size.
+PREWARM = getattr(settings, 'MULTIDB_PREWARM', False)
+
+
+# Determine whether databases that keep failing are taken out of the routing
+# for a while. This is a dict of keyword arguments for
+# multidb.breaker.CircuitBreaker, or None, for example
+# {
+#   'threshold': 5,  # failures in a row
+#   'backoff': 1.0,  # seconds, doubled after each failed probe
+#   'max_backoff': 60.0,
+# }
+CIRCUIT_BREAKER = getattr(settings, 'MULTIDB_CIRCUIT_BREAKER', None)
+
+
+# Determine how many reads on read-only databases each request may run again
+# on another read-only database, when the connection to the first one was
+# lost. Reads in transactions are never retried.
+# The other databases are the ones used for the same HTTP methods.
+# It will be in the format
+# {
+#   alias1: [alias2, alias3, ...],
+#   ...
+# }
+READ_RETRIES = getattr(settings, 'MULTIDB_READ_RETRIES', 0)
+REPLICA_SIBLINGS = _build_replica_siblings()
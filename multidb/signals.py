@@ -1,20 +1,25 @@
 # -*- coding: utf-8 -*-
-from threading import local
+import contextvars
+
 from django.dispatch import Signal
 
 
-class FunctionPool(local):
+class FunctionPool(object):
     """
-    A function pool that uses thread locals for storage. This is used to
+    A function pool that uses context variables for storage. This is used to
     queue up functions to run once when necessary. This means that each
-    thread has its own pool of messages.
+    thread has its own pool of messages, and so does each asyncio task.
 
     """
 
+    def __init__(self, name='multidb.function_pool'):
+        self._data = contextvars.ContextVar(name, default=None)
+
     def __iter__(self):
         """Return all queued functions."""
-        if hasattr(self, '_thread_data'):
-            for key, value in self._thread_data.items():
+        data = self._data.get()
+        if data:
+            for key, value in data.items():
                 if key:
                     yield value
                 else:
@@ -22,8 +27,9 @@ class FunctionPool(local):
                         yield item
 
     def __len__(self):
-        if hasattr(self, '_thread_data'):
-            return len(self._thread_data)
+        data = self._data.get()
+        if data:
+            return len(data)
         else:
             return 0
 
@@ -55,26 +61,49 @@ class FunctionPool(local):
 
         """
 
-        if not hasattr(self, '_thread_data'):
-            self._thread_data = {}
+        data = self._data.get()
+        if data is None:
+            data = {}
+            self._data.set(data)
 
         if key:
-            self._thread_data[key] = func
+            data[key] = func
         else:
-            self._thread_data.setdefault(None, [])
-            self._thread_data[None].append(func)
+            data.setdefault(None, [])
+            data[None].append(func)
 
     def clear(self):
-        if hasattr(self, '_thread_data'):
-            del self._thread_data
+        self._data.set(None)
 
 
 pre_commit = Signal()
 post_commit = Signal()
 post_rollback = Signal()
 
-pre_commit_function_pool = FunctionPool()
-post_commit_function_pool = FunctionPool()
+# Sent after a cursor's executemany(), with the alias, sql, size of the
+# batch and the elapsed time in seconds.
+batch_executed = Signal()
+
+# Sent at the end of a request which ran the same SQL fingerprint more than
+# MULTIDB_REPEATED_QUERY_THRESHOLD times, with the request and a dict of the
+# repeated fingerprints and their counts.
+repeated_queries = Signal()
+
+# Sent when connections have been opened at startup (see MULTIDB_PREWARM),
+# with dicts of the seconds taken to connect to each alias and to fill each
+# connection pool (by alias prefix), and of the errors by alias or prefix.
+connections_warmed = Signal()
+
+# Sent by the circuit breaker (see MULTIDB_CIRCUIT_BREAKER) with the alias
+# when a database is taken out of the routing, with the failures in a row and
+# the backoff in seconds; when a request is sent to it as a probe; and when
+# it is put back after a successful probe.
+replica_ejected = Signal()
+replica_probing = Signal()
+replica_readmitted = Signal()
+
+pre_commit_function_pool = FunctionPool('multidb.pre_commit_function_pool')
+post_commit_function_pool = FunctionPool('multidb.post_commit_function_pool')
 
 
 def queue_pre_commit(func, key=None):
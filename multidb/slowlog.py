@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+A sampled slow query log, written in the background.
+
+Queries taking longer than the threshold are sampled, rendered and handed to
+a bounded queue. A writer thread drains the queue in batches and writes each
+record as a JSON line, to a file or to a logger. Request threads never wait
+for the writer: when the queue is full, records are dropped and counted.
+
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import weakref
+
+from . import settings as config
+
+
+# Every slow query log, so they can be reset in forked processes.
+logs = weakref.WeakSet()
+
+
+def reset_after_fork():
+    # A forked process has none of the writer threads, and the queues' locks
+    # may have been held by threads that aren't there, so start again.
+    for log in list(logs):
+        log.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+
+class SlowQueryLog(object):
+
+    def __init__(self, threshold=1.0, sample_rate=1.0, path=None, logger='multidb.slow_queries',
+                 queue_size=10000, batch_size=100):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.path = path
+        self.logger = logging.getLogger(logger)
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.registered = False
+        self.reset()
+        logs.add(self)
+
+    def reset(self):
+        """Forget the writer thread and the queued records, in a forked process."""
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def record(self, alias, sql, params, elapsed, error=False):
+        """
+        Queue a query for the log, if it is slow enough and is sampled.
+        The SQL is only rendered with its params once this is decided.
+        """
+        if elapsed < self.threshold:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        from .cursors import get_sql_output
+        try:
+            sql = get_sql_output(sql, params)
+        except Exception:
+            sql = f'{sql} {params!r}'
+
+        self.start()
+        try:
+            self.queue.put_nowait({
+                'time': time.time(),
+                'alias': alias,
+                'elapsed_ms': round(elapsed * 1000, 3),
+                'error': error,
+                'sql': sql,
+            })
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def start(self):
+        """Start the writer thread, in the process that first needs it."""
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='multidb-slow-queries', daemon=True)
+                    self.thread.start()
+                    if not self.registered:
+                        # Registered once, and inherited by forked processes.
+                        self.registered = True
+                        atexit.register(self.close)
+
+    def run(self):
+        output = open(self.path, 'a', encoding='utf-8') if self.path else None
+        try:
+            while True:
+                records = [self.queue.get()]
+                while len(records) < self.batch_size:
+                    try:
+                        records.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                closing = None in records
+                self.write([record for record in records if record is not None], output)
+                if closing:
+                    break
+        finally:
+            if output:
+                output.close()
+
+    def write(self, records, output):
+        try:
+            lines = [json.dumps(record, default=str) for record in records]
+            if output:
+                output.write(''.join(line + '\n' for line in lines))
+                output.flush()
+            else:
+                for line in lines:
+                    self.logger.info(line)
+        except Exception:
+            logging.warning('Could not write to the slow query log', exc_info=True)
+
+    def close(self, timeout=5):
+        """Write any queued records and stop the writer thread."""
+        if self.thread is not None:
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self.thread.join(timeout)
+
+
+def get_slow_query_log():
+    """Create the slow query log configured in the settings, if any."""
+    if config.SLOW_QUERY_LOG:
+        return SlowQueryLog(**config.SLOW_QUERY_LOG)
+    return None
+
+
+slow_query_log = get_slow_query_log()
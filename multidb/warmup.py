@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Opens database connections when the application starts, so the first
+requests of a new worker don't pay for connecting to each database.
+
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import settings as config
+from .connection import connection_state
+from .pool import pools
+from .signals import connections_warmed
+
+
+def get_aliases(prewarm=None):
+    """
+    The aliases to open connections to, from the MULTIDB_PREWARM setting.
+    True means the databases used by the middleware, but not the aliases
+    added by connection pools, which open their own connections.
+    """
+    prewarm = config.PREWARM if prewarm is None else prewarm
+    if prewarm is True:
+        return [alias for alias in settings.DATABASES if alias in config.ROUTED_DATABASES_SET]
+    return list(prewarm or ())
+
+
+def warm_up(aliases=None):
+    """
+    Open and check a connection to each alias, in this thread, and fill the
+    connection pools to their min_size. Failures are logged rather than
+    raised, so a database that is down doesn't stop the application from
+    starting. The connections_warmed signal is sent with the timings.
+    """
+    timings = {}
+    pool_timings = {}
+    errors = {}
+
+    with connection_state.force(None):
+        for alias in get_aliases() if aliases is None else aliases:
+            started = time.perf_counter()
+            try:
+                connection = connections[alias]
+                connection.ensure_connection()
+                if not connection.is_usable():
+                    raise connection.Database.OperationalError(f'The connection to {alias} is not usable')
+            except Exception as error:
+                logging.warning('Could not connect to %s' % alias, exc_info=True)
+                errors[alias] = error
+            timings[alias] = time.perf_counter() - started
+
+    for pool in list(pools):
+        if pool.closed or not pool.min_size:
+            continue
+        started = time.perf_counter()
+        try:
+            pool.fill()
+        except Exception as error:
+            logging.warning('Could not fill the %s connection pool' % pool.prefix, exc_info=True)
+            errors[pool.prefix] = error
+        pool_timings[pool.prefix] = time.perf_counter() - started
+
+    logging.info('Connected to %s in %.3fs' % (', '.join(timings) or 'no databases', sum(timings.values())))
+    connections_warmed.send(sender=None, timings=timings, pool_timings=pool_timings, errors=errors)
+    return timings, pool_timings, errors
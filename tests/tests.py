@@ -1,9 +1,47 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import json
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
 from os import environ as env
+from unittest import mock
+
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.db import OperationalError, ProgrammingError, connections, transaction
 from django.forms.models import modelform_factory
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase
 
-from multidb.readonly import read_only_mode, ReadOnlyError
+from multidb import decorators, settings as config
+from multidb.balancer import EWMABalancer, RoundRobinBalancer
+from multidb.cache.sluggish import SluggishCache
+from multidb.breaker import CircuitBreaker, is_connection_error
+from multidb.budgets import QueryBudget, QueryBudgetExceeded, QueryBudgetWarning, RequestBudgets
+from multidb.connection import ResolvedConnection, connection_state
+from multidb.cursors import (
+    READ, SAVEPOINT, SESSION, WRITE, RestrictedCursorWrapper, RestrictedDatabaseError, classify_sql, fingerprint_sql,
+)
+from multidb.lag import FakeLagProbe, LagSampler, MySQLLagProbe, ReplicaLagTable
+from multidb.middleware import MultiDBMiddleware
+from multidb.metrics import MetricsRegistry, estimate_percentile, merge_metrics
+from multidb.paths import PathRouter
+from multidb.fanout import FanOut, TaskCancelled, TaskTimeout
+from multidb.pool import AsyncConnectionPool, PoolTimeout, TemporaryConnectionPool
+from multidb.signals import (
+    batch_executed, connections_warmed, replica_ejected, replica_probing, replica_readmitted, repeated_queries,
+)
+from multidb.slowlog import SlowQueryLog
+from multidb.notify import FileNotifier, UnixSocketNotifier, get_notifier
+from multidb.readonly import CLUSTER, HOST, read_only_mode, ReadOnlyError
+from multidb.results import ResultCache, get_read_tables, get_replica_group, get_written_tables
+from multidb.warmup import get_aliases, warm_up
 from testuils.rollback import RollbackTestCase
 
 env['DJANGO_SETTINGS_MODULE'] = 'django.settings'
@@ -59,3 +97,1395 @@ class ReadOnlyTestCase(RollbackTestCase):
 
         # The read-only error message should have been added to the form.
         self.assertTrue(ReadOnlyError.message in form._errors.get('__all__', {}))
+
+
+class BalancerTestCase(SimpleTestCase):
+
+    def test_round_robin(self):
+        balancer = RoundRobinBalancer()
+        aliases = ['replica1', 'replica2', 'replica3']
+        chosen = [balancer.choose(aliases) for _ in range(6)]
+        self.assertEqual(chosen, aliases * 2)
+
+    def test_ewma_prefers_fast_database(self):
+        now = [0.0]
+        balancer = EWMABalancer(decay=10.0, clock=lambda: now[0])
+        balancer.observe('fast', 0.001)
+        balancer.observe('slow', 0.100)
+        for _ in range(20):
+            self.assertEqual(balancer.choose(['fast', 'slow']), 'fast')
+
+    def test_ewma_recovers_idle_database(self):
+        now = [0.0]
+        balancer = EWMABalancer(decay=10.0, clock=lambda: now[0])
+        balancer.observe('slow', 0.100)
+        balancer.observe('fast', 0.001)
+        self.assertEqual({balancer.choose(['fast', 'slow']) for _ in range(20)}, {'fast'})
+        # It decays towards the other database, and is then tried again.
+        # Unknown databases cost the mean of the others.
+        now[0] = 20.0
+        self.assertAlmostEqual(balancer.cost('slow', ['fast', 'slow']), 0.001 + 0.099 * math.exp(-2))
+        self.assertEqual(balancer.cost('new', ['fast', 'slow', 'new']), 0.0505)
+        now[0] = 60.0
+        balancer.observe('fast', 0.001)
+        self.assertEqual(balancer.cost('slow', ['fast', 'slow']), 0.001)
+        self.assertIn('slow', {balancer.choose(['fast', 'slow']) for _ in range(50)})
+
+    def test_ewma_avoids_failing_database(self):
+        now = [0.0]
+        balancer = EWMABalancer(decay=10.0, clock=lambda: now[0])
+        chosen = []
+        for _ in range(3000):
+            now[0] += 0.01
+            alias = balancer.choose(['replica1', 'replica2'])
+            chosen.append(alias)
+            if alias == 'replica2':
+                # It has stopped answering.
+                balancer.failed(alias)
+            else:
+                balancer.observe(alias, 0.002)
+        # It is tried again only when its penalty has all but decayed.
+        self.assertLess(chosen.count('replica2'), 10)
+
+    def test_connect_errors(self):
+        def connect(connection):
+            raise sqlite3.OperationalError('unable to open database file')
+
+        balancer = mock.Mock()
+        connection = mock.Mock(alias='replica1')
+        with self.assertRaises(sqlite3.OperationalError):
+            decorators.connect(connect, balancer)(connection)
+        balancer.failed.assert_called_once_with('replica1')
+
+
+class ReplicaLagTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.table = ReplicaLagTable(
+            mappings={'GET': ['replica1', 'replica2'], None: ['primary']},
+            max_lags={'replica1': 10, 'replica2': 10},
+            fallback='primary',
+        )
+
+    def test_stale_replicas_are_skipped(self):
+        self.table.publish({'replica1': 60.0, 'replica2': 1.0})
+        self.assertEqual(self.table.get_aliases_for_method('GET'), ['replica2'])
+        self.assertEqual(self.table.get_aliases_for_method('POST'), ['primary'])
+
+    def test_fallback_when_all_replicas_are_stale(self):
+        self.table.publish({'replica1': 60.0, 'replica2': float('inf')})
+        self.assertEqual(self.table.get_aliases_for_method('GET'), ['primary'])
+
+    def test_sampler_publishes_probe_results(self):
+        table = ReplicaLagTable(mappings={'GET': ['default']}, max_lags={'default': 10}, fallback='other')
+        probe = FakeLagProbe({'default': 30.0})
+        LagSampler(table, interval=1, probes={'default': probe}).sample()
+        self.assertEqual(table.lags, {'default': 30.0})
+        self.assertEqual(table.get_aliases_for_method('GET'), ['other'])
+
+    def test_mysql_probe(self):
+        def execute(sql, params=None):
+            if sql == 'SHOW REPLICA STATUS':
+                raise ProgrammingError('You have an error in your SQL syntax')
+
+        # An older server, which is a read-only database.
+        status = mock.Mock(rowcount=1, description=[('Seconds_Behind_Master',), ('Slave_IO_State',)])
+        status.execute.side_effect = execute
+        status.fetchone.return_value = (3, 'Waiting for master to send event')
+        db = mock.Mock(alias='replica1', settings_dict={'READ_ONLY': True}, vendor='mysql', Database=FakeDatabase)
+        connection = mock.Mock(**{'cursor.side_effect': lambda: RestrictedCursorWrapper(status, db)})
+        probe = MySQLLagProbe()
+        self.assertEqual(probe.measure(connection), 3.0)
+        self.assertEqual(probe.measure(connection), 3.0)
+        self.assertEqual(
+            [call.args[0] for call in status.execute.call_args_list],
+            ['SHOW REPLICA STATUS', 'SHOW SLAVE STATUS', 'SHOW SLAVE STATUS'],
+        )
+
+
+class FakeDatabase(object):
+    """The exceptions of a DB-API module, for databases that aren't installed here."""
+
+    class OperationalError(Exception):
+        pass
+
+    class InterfaceError(Exception):
+        pass
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+
+    databases = {'default'}
+
+    def setUp(self):
+        self.now = [0.0]
+        self.breaker = CircuitBreaker(threshold=3, backoff=1.0, max_backoff=3.0, clock=lambda: self.now[0])
+        self.sent = []
+        for signal in (replica_ejected, replica_probing, replica_readmitted):
+            signal.connect(self.receiver)
+            self.addCleanup(signal.disconnect, self.receiver)
+
+    def receiver(self, signal, sender, alias, **kwargs):
+        name = {replica_ejected: 'ejected', replica_probing: 'probing', replica_readmitted: 'readmitted'}[signal]
+        self.sent.append((name, alias, kwargs.get('backoff')))
+
+    def test_ejection_and_probes(self):
+        breaker = self.breaker
+        aliases = ['replica1', 'replica2']
+        for _ in range(2):
+            breaker.record_failure('replica1')
+        self.assertEqual(breaker.filter(aliases), aliases)
+        breaker.record_failure('replica1')
+        self.assertEqual(self.sent, [('ejected', 'replica1', 1.0)])
+        self.assertEqual(breaker.filter(aliases), ['replica2'])
+        # Requests fall back to the primary when every replica is ejected.
+        self.assertEqual(breaker.filter(['replica1'], fallback='default'), ['default'])
+
+        # After the backoff, one request is sent to it as a probe.
+        self.now[0] = 1.0
+        self.assertEqual(breaker.filter(aliases), ['replica1'])
+        self.assertEqual(breaker.filter(aliases), ['replica2'])
+        # The probe fails, so the next one is after twice as long.
+        breaker.record_failure('replica1')
+        self.now[0] = 2.5
+        self.assertEqual(breaker.filter(aliases), ['replica2'])
+        self.now[0] = 3.0
+        self.assertEqual(breaker.filter(aliases), ['replica1'])
+        breaker.record_success('replica1')
+        self.assertEqual(breaker.filter(aliases), aliases)
+        self.assertEqual(self.sent[1:], [
+            ('probing', 'replica1', None), ('ejected', 'replica1', 2.0),
+            ('probing', 'replica1', None), ('readmitted', 'replica1', None),
+        ])
+
+    def test_successes_reset_failures(self):
+        for _ in range(2):
+            self.breaker.record_failure('replica1')
+        self.breaker.record_success('replica1')
+        self.breaker.record_failure('replica1')
+        self.assertFalse(self.breaker.is_ejected('replica1'))
+
+    def test_cursor_errors(self):
+        with mock.patch('multidb.cursors.circuit_breaker', self.breaker), connection_state.force(None):
+            cursor = connections['default'].cursor()
+            # As if the connection was lost.
+            lost = mock.Mock(**{'execute.side_effect': sqlite3.OperationalError('disk I/O error')})
+            with mock.patch.object(cursor.cursor, 'cursor', lost):
+                for _ in range(2):
+                    with self.assertRaises(Exception):
+                        cursor.execute('SELECT 1')
+            self.assertEqual(self.breaker.failures, {'default': 2})
+            cursor.execute('SELECT 1')
+            self.assertEqual(self.breaker.failures, {})
+
+            # Errors in the query itself don't count.
+            self.assertFalse(is_connection_error(sqlite3.IntegrityError(), connections['default']))
+            with self.assertRaises(Exception):
+                cursor.execute('SELECT * FROM missing')
+            self.assertEqual(self.breaker.failures, {})
+            other = mock.Mock(vendor='oracle', Database=FakeDatabase)
+            self.assertFalse(is_connection_error(FakeDatabase.OperationalError(), other))
+            postgresql = mock.Mock(vendor='postgresql', Database=FakeDatabase)
+            self.assertTrue(is_connection_error(FakeDatabase.OperationalError(), postgresql))
+            timeout = FakeDatabase.OperationalError()
+            timeout.pgcode = '57014'
+            self.assertFalse(is_connection_error(timeout, postgresql))
+            mysql = mock.Mock(vendor='mysql', Database=FakeDatabase)
+            self.assertTrue(is_connection_error(FakeDatabase.OperationalError(2006, 'gone away'), mysql))
+            self.assertFalse(is_connection_error(FakeDatabase.OperationalError(1054, 'unknown column'), mysql))
+
+    def test_connect_errors(self):
+        def connect(connection):
+            raise FakeDatabase.OperationalError('could not connect')
+
+        connection = mock.Mock(alias='replica1', vendor='postgresql', Database=FakeDatabase)
+        with self.assertRaises(FakeDatabase.OperationalError):
+            decorators.connect(connect, mock.Mock(), self.breaker)(connection)
+        self.assertEqual(self.breaker.failures, {'replica1': 1})
+
+    @mock.patch.object(config, 'DATABASE_MAPPINGS', {'GET': ['replica1', 'replica2'], None: ['default']})
+    def test_middleware(self):
+        self.breaker.ejected = {'replica1': (10.0, 1.0)}
+        middleware = MultiDBMiddleware(lambda request: HttpResponse())
+        table = ReplicaLagTable(max_lags={'replica2': 10}, fallback='default')
+        with mock.patch('multidb.middleware.circuit_breaker', self.breaker), \
+                mock.patch('multidb.middleware.replica_lag', table):
+            self.assertEqual(middleware.get_aliases_for_method('GET'), ['replica2'])
+            table.publish({'replica2': 60.0})
+            self.assertEqual(middleware.get_aliases_for_method('GET'), ['default'])
+
+
+class ReadRetryTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.metrics = MetricsRegistry(bounds=[0.1])
+        for patcher in (
+            mock.patch.object(config, 'READ_RETRIES', 1),
+            mock.patch.object(config, 'REPLICA_SIBLINGS', {'retry1': ['retry2']}),
+            mock.patch('multidb.cursors.metrics', self.metrics),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # In files, as Django doesn't close connections to in-memory databases.
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for alias in ('retry1', 'retry2'):
+            connections.databases[alias] = {
+                'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(directory.name, f'{alias}.sqlite3'),
+            }
+            self.addCleanup(self.remove_alias, alias)
+        self.addCleanup(setattr, connection_state, 'alias', connection_state.alias)
+        connection_state.start_request()
+        self.addCleanup(connection_state.end_request)
+        # Requests are routed to the replica whose connection is lost.
+        connection_state.alias = 'retry1'
+
+    def remove_alias(self, alias):
+        with connection_state.force(None):
+            connections[alias].close()
+        delattr(connections._connections, alias)
+        del connections.databases[alias]
+
+    def get_cursor(self, error=None):
+        """A cursor for retry1, whose connection is lost when it runs a statement."""
+        with connection_state.force(None):
+            cursor = connections['retry1'].cursor()
+        cursor.cursor.cursor = mock.Mock(**{'execute.side_effect': error or sqlite3.OperationalError('disk I/O error')})
+        return cursor
+
+    def test_retry(self):
+        connection_state.query_counts = {}
+        cursor = self.get_cursor()
+        with self.assertLogs(level='WARNING'):
+            cursor.execute('SELECT 1')
+        self.assertEqual(cursor.fetchone(), (1,))
+        # The rest of the request uses the other replica.
+        self.assertEqual(connection_state.alias, 'retry2')
+        # The failed statement and the retry are each recorded once.
+        metrics = self.metrics.snapshot()['aliases']
+        self.assertEqual((metrics['retry1'][READ]['errors'], metrics['retry1'][READ]['retries']), (1, 1))
+        self.assertEqual(metrics['retry2'][READ]['count'], 1)
+        self.assertEqual(connection_state.query_counts, {'SELECT ?': 2})
+        # The broken connection has been closed.
+        with connection_state.force(None):
+            self.assertIsNone(connections['retry1'].connection)
+
+        # The request has used up its retries.
+        with self.assertRaises(OperationalError):
+            self.get_cursor().execute('SELECT 1')
+
+    def test_no_retry(self):
+        with self.assertRaises(OperationalError):
+            self.get_cursor().execute('UPDATE t SET x = 1')
+
+        # Not in transactions.
+        with connection_state.force(None), transaction.atomic(using='retry1'):
+            with self.assertRaises(OperationalError):
+                self.get_cursor().execute('SELECT 1')
+
+        # Not when the error was caused by the query.
+        with self.assertRaises(OperationalError):
+            self.get_cursor(sqlite3.OperationalError('no such table: t')).execute('SELECT * FROM t')
+
+        # Not on another replica that is ejected.
+        breaker = CircuitBreaker()
+        breaker.ejected['retry2'] = (float('inf'), 1.0)
+        with mock.patch('multidb.cursors.circuit_breaker', breaker):
+            with self.assertRaises(OperationalError):
+                self.get_cursor().execute('SELECT 1')
+
+        self.assertNotIn('retry2', self.metrics.snapshot()['aliases'])
+        self.assertEqual(connection_state.retries, 1)
+
+
+@mock.patch.object(config, 'STICKY_WINDOW', 30)
+@mock.patch.object(config, 'DATABASE_MAPPINGS', {'GET': ['retry1'], None: ['default']})
+class StickyWriteTestCase(SimpleTestCase):
+
+    databases = {'default'}
+
+    def setUp(self):
+        self.middleware = MultiDBMiddleware(lambda request: HttpResponse())
+        self.factory = RequestFactory()
+
+    def get_cookie(self):
+        request = self.factory.post('/')
+        self.middleware.process_request(request)
+        connection_state.wrote = 'default'
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertIsNone(connection_state.wrote)
+        return response.cookies[config.STICKY_COOKIE].value
+
+    def test_write_pins_client_to_primary(self):
+        request = self.factory.get('/')
+        request.COOKIES[config.STICKY_COOKIE] = self.get_cookie()
+        self.assertEqual(self.middleware.override_for_recent_write(request, ['replica1']), ['default'])
+
+    def test_replicated_write_is_shared(self):
+        request = self.factory.get('/')
+        request.COOKIES[config.STICKY_COOKIE] = self.get_cookie()
+        table = ReplicaLagTable(mappings={}, max_lags={})
+        table.publish({'replica1': 0.0}, sampled=time.time() + 1)
+        with mock.patch('multidb.middleware.replica_lag', table):
+            aliases = self.middleware.override_for_recent_write(request, ['replica1'])
+        # Replicas that have the write are used as well as the written database.
+        self.assertEqual(aliases, ['default', 'replica1'])
+
+    def test_write_to_a_read_database_pins_client(self):
+        request = self.factory.get('/')
+        request.COOKIES[config.STICKY_COOKIE] = self.get_cookie()
+        table = ReplicaLagTable(mappings={}, max_lags={})
+        table.publish({'replica1': 60.0, 'replica2': 0.0}, sampled=time.time() + 1)
+        with mock.patch('multidb.middleware.replica_lag', table):
+            aliases = self.middleware.override_for_recent_write(request, ['replica1', 'default', 'replica2'])
+        self.assertEqual(aliases, ['default', 'replica2'])
+
+    def test_no_cookie_without_write(self):
+        request = self.factory.get('/')
+        self.middleware.process_request(request)
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertNotIn(config.STICKY_COOKIE, response.cookies)
+
+    def test_only_changes_to_routed_databases_are_recorded(self):
+        connection_state.start_request()
+        self.addCleanup(connection_state.end_request)
+        with connection_state.force(None):
+            connection = connections['default']
+            with transaction.atomic(using='default'):
+                connection.cursor().execute('SELECT 1')
+        self.assertIsNone(connection_state.wrote)
+
+        for alias in ('pool_1', 'default'):
+            db = mock.Mock(alias=alias, settings_dict={})
+            db.get_autocommit.return_value = True
+            RestrictedCursorWrapper(mock.Mock(rowcount=1), db).execute('UPDATE t SET x = 1')
+            self.assertEqual(connection_state.wrote, 'default' if alias == 'default' else None)
+
+
+class PathRouterTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.router = PathRouter({
+            'default': ['/admin/', '/api/'],
+            'reports': ['/admin/reports/'],
+            'search': ['/api/search'],
+        })
+
+    def test_matching_aliases(self):
+        self.assertEqual(self.router.get_aliases('/admin/users/'), ('default',))
+        self.assertEqual(self.router.get_aliases('/admin/reports/1/'), ('default', 'reports'))
+        self.assertEqual(self.router.get_aliases('/api/search/?q=1'), ('default', 'search'))
+        self.assertEqual(self.router.get_aliases('/api/sear'), ('default',))
+
+    def test_no_match(self):
+        self.assertEqual(self.router.get_aliases('/'), ())
+        self.assertEqual(self.router.get_aliases('/adm'), ())
+        self.assertFalse(PathRouter({}))
+        self.assertEqual(PathRouter({}).get_aliases('/admin/'), ())
+
+
+class AsyncRoutingTestCase(SimpleTestCase):
+    """Concurrent async requests on one event loop each keep their own alias."""
+
+    def test_concurrent_requests_keep_their_alias(self):
+        table = ReplicaLagTable(
+            mappings={'GET': ['replica1', 'replica2', 'replica3'], None: ['default']},
+            max_lags={},
+        )
+        seen = []
+
+        async def view(request):
+            alias = connection_state.alias
+            for _ in range(5):
+                await asyncio.sleep(random.random() / 1000)
+                if connection_state.alias != alias:
+                    seen.append(None)
+            seen.append((request.method, alias))
+            return HttpResponse()
+
+        async def run():
+            middleware = MultiDBMiddleware(view)
+            factory = RequestFactory()
+            requests = [factory.get('/') if i % 2 else factory.post('/') for i in range(500)]
+            await asyncio.gather(*[middleware(request) for request in requests])
+
+        with mock.patch('multidb.middleware.replica_lag', table):
+            asyncio.run(run())
+
+        self.assertEqual(len(seen), 500)
+        self.assertNotIn(None, seen)
+        for method, alias in seen:
+            if method == 'GET':
+                self.assertIn(alias, ['replica1', 'replica2', 'replica3'])
+            else:
+                self.assertEqual(alias, 'default')
+
+    def test_read_only_mode_is_fetched_off_the_event_loop(self):
+        fetched_on_loop = []
+
+        class Backend(object):
+            def get(self, key, default=None, version=None):
+                try:
+                    asyncio.get_running_loop()
+                except RuntimeError:
+                    pass
+                else:
+                    fetched_on_loop.append(key)
+                return default
+
+        async def view(request):
+            return HttpResponse()
+
+        async def run():
+            await MultiDBMiddleware(view)(RequestFactory().get('/'))
+
+        with mock.patch.object(read_only_mode, 'cache', SluggishCache(Backend(), delay=5)):
+            self.assertFalse(read_only_mode.is_fresh())
+            asyncio.run(run())
+            self.assertTrue(read_only_mode.is_fresh())
+        self.assertEqual(fetched_on_loop, [])
+
+
+class ResolvedConnectionTestCase(SimpleTestCase):
+
+    def test_resolve(self):
+        resolved = ResolvedConnection()
+        self.assertIsNone(resolved.resolve(None))
+        self.assertIsNone(resolved.resolve('not-initialized'))
+        with connection_state.force(None):
+            connection = connections['default']
+        self.assertIs(resolved.resolve('default'), connection)
+        self.assertEqual(resolved.alias, 'default')
+        resolved.clear()
+        self.assertIsNone(resolved.connection)
+        self.assertIs(resolved.resolve('default'), connection)
+
+
+class ClassifySQLTestCase(SimpleTestCase):
+
+    def test_classify_sql(self):
+        self.assertEqual(classify_sql('SELECT 1'), READ)
+        self.assertEqual(classify_sql('  explain select 1'), READ)
+        self.assertEqual(classify_sql('SAVEPOINT "s1"'), SAVEPOINT)
+        self.assertEqual(classify_sql('ROLLBACK TO SAVEPOINT "s1"'), SAVEPOINT)
+        self.assertEqual(classify_sql('RELEASE SAVEPOINT "s1"'), SAVEPOINT)
+        self.assertEqual(classify_sql('UPDATE t SET x = 1'), WRITE)
+        self.assertEqual(classify_sql('SELECTED'), WRITE)
+        self.assertEqual(classify_sql('BEGIN'), SESSION)
+        self.assertEqual(classify_sql('START TRANSACTION'), SESSION)
+        self.assertEqual(classify_sql('ROLLBACK'), SESSION)
+        self.assertEqual(classify_sql('SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED'), SESSION)
+        self.assertEqual(classify_sql('SHOW REPLICA STATUS'), SESSION)
+
+    def test_atomic_on_read_only_database(self):
+        connections.databases['readonly'] = {
+            'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:', 'READ_ONLY': True,
+        }
+        self.addCleanup(connections.databases.pop, 'readonly')
+        with connection_state.force(None):
+            connection = connections['readonly']
+            self.addCleanup(connection.close)
+            with transaction.atomic(using='readonly'):
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                    with self.assertRaises(RestrictedDatabaseError):
+                        cursor.execute('CREATE TABLE t (x int)')
+
+    def test_read_only_checked_once_per_request(self):
+        with mock.patch('multidb.connection.read_only_mode') as mode:
+            mode.__bool__.return_value = False
+            connection_state.start_request()
+            try:
+                for _ in range(3):
+                    self.assertFalse(connection_state.read_only)
+            finally:
+                connection_state.end_request()
+            self.assertEqual(mode.__bool__.call_count, 1)
+            self.assertFalse(connection_state.read_only)
+            self.assertEqual(mode.__bool__.call_count, 2)
+
+
+class BatchCursorTestCase(SimpleTestCase):
+
+    def get_cursor(self, **settings_dict):
+        db = mock.Mock(alias='replica', settings_dict=settings_dict)
+        return RestrictedCursorWrapper(mock.Mock(rowcount=1), db)
+
+    def test_executemany_read_only(self):
+        cursor = self.get_cursor(READ_ONLY=True)
+        with self.assertRaises(RestrictedDatabaseError):
+            cursor.executemany('INSERT INTO t VALUES (%s)', [(1,), (2,)])
+        self.assertFalse(cursor.cursor.executemany.called)
+
+    def test_executemany_read_only_warning(self):
+        cursor = self.get_cursor(READ_ONLY_WARNING=True)
+        cursor.cursor.executemany.side_effect = lambda sql, param_list: list(param_list)
+        batches = []
+
+        def receiver(sender, size, **kwargs):
+            batches.append(size)
+
+        batch_executed.connect(receiver)
+        try:
+            with self.assertLogs(level='WARNING'):
+                cursor.executemany('INSERT INTO t VALUES (%s)', ((i,) for i in range(3)))
+        finally:
+            batch_executed.disconnect(receiver)
+        self.assertEqual(cursor.cursor.executemany.call_count, 1)
+        self.assertEqual(batches, [3])
+
+    def test_callproc_read_only(self):
+        cursor = self.get_cursor(READ_ONLY=True)
+        with self.assertRaises(RestrictedDatabaseError):
+            cursor.callproc('refresh_totals', [1])
+        self.get_cursor().callproc('refresh_totals', [1])
+
+
+class MetricsTestCase(SimpleTestCase):
+
+    def test_record(self):
+        registry = MetricsRegistry(bounds=[0.001, 0.01, 0.1])
+        registry.record('replica1', READ, 0.0005, rows=3)
+        registry.record('replica1', READ, 0.05, error=True)
+        registry.record('default', WRITE, 0.5, rows=100, count=100)
+        registry.record_retry('replica1', READ)
+
+        snapshot = registry.snapshot()
+        read = snapshot['aliases']['replica1'][READ]
+        self.assertEqual((read['count'], read['errors'], read['retries'], read['rows']), (2, 1, 1, 3))
+        self.assertEqual(read['buckets'], [1, 0, 1, 0])
+        write = snapshot['aliases']['default'][WRITE]
+        self.assertEqual((write['count'], write['rows'], write['buckets']), (100, 100, [0, 0, 0, 1]))
+
+        merged = merge_metrics([snapshot, snapshot])
+        self.assertEqual(merged['aliases']['replica1'][READ]['buckets'], [2, 0, 2, 0])
+        self.assertEqual(merged['aliases']['replica1'][READ]['retries'], 2)
+        self.assertEqual(read['buckets'], [1, 0, 1, 0])
+
+    def test_estimate_percentile(self):
+        bounds = [0.001, 0.01, 0.1]
+        self.assertIsNone(estimate_percentile(bounds, [0, 0, 0, 0], 50))
+        self.assertEqual(estimate_percentile(bounds, [90, 9, 1, 0], 50), 0.001)
+        self.assertEqual(estimate_percentile(bounds, [90, 9, 1, 0], 99), 0.01)
+        self.assertEqual(estimate_percentile(bounds, [0, 0, 0, 1], 99), float('inf'))
+
+
+class SlowQueryLogTestCase(SimpleTestCase):
+
+    def test_writes_slow_queries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'slow.jsonl')
+            log = SlowQueryLog(threshold=0.1, path=path)
+            log.record('replica1', 'SELECT %s', (1,), 0.05)
+            log.record('replica1', 'SELECT %s', (2,), 0.5)
+            log.close()
+            with open(path) as output:
+                records = [json.loads(line) for line in output]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['sql'], 'SELECT 2')
+        self.assertEqual(records[0]['alias'], 'replica1')
+
+    def test_drops_records_when_full(self):
+        log = SlowQueryLog(threshold=0, queue_size=2)
+        with mock.patch.object(log, 'start'):
+            for _ in range(5):
+                log.record('default', 'SELECT 1', None, 1.0)
+        self.assertEqual(log.queue.qsize(), 2)
+        self.assertEqual(log.dropped, 3)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork()')
+    def test_forked_process_starts_its_own_writer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'slow.jsonl')
+            log = SlowQueryLog(threshold=0, path=path)
+            # Started before forking, as with preloaded applications.
+            log.record('default', 'SELECT %s', ('parent',), 1.0)
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    log.record('default', 'SELECT %s', ('child',), 1.0)
+                    log.close()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            log.close()
+            with open(path) as output:
+                records = [json.loads(line)['sql'] for line in output]
+        self.assertEqual(sorted(records), ['SELECT child', 'SELECT parent'])
+
+    def test_sampling(self):
+        log = SlowQueryLog(threshold=0, sample_rate=0)
+        log.record('default', 'SELECT 1', None, 1.0)
+        self.assertIsNone(log.thread)
+
+
+class RepeatedQueriesTestCase(SimpleTestCase):
+
+    def test_fingerprint_sql(self):
+        self.assertEqual(
+            fingerprint_sql("SELECT * FROM t1 WHERE id = 12 AND name = 'it''s'  LIMIT 21"),
+            'SELECT * FROM t1 WHERE id = ? AND name = ? LIMIT ?',
+        )
+        self.assertEqual(
+            fingerprint_sql('SELECT * FROM "t" WHERE "t"."id" IN (%s, %s, %s)'),
+            fingerprint_sql('SELECT * FROM "t" WHERE "t"."id" IN (%s)'),
+        )
+        self.assertEqual(fingerprint_sql('UPDATE t SET x = %(x)s'), 'UPDATE t SET x = ?')
+
+    @mock.patch.object(config, 'REPEATED_QUERY_THRESHOLD', 2)
+    @mock.patch.object(config, 'DATABASE_MAPPINGS', {None: ['default']})
+    def test_repeated_queries_are_reported(self):
+        middleware = MultiDBMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        cursor = RestrictedCursorWrapper(mock.Mock(rowcount=1), mock.Mock(alias='default', settings_dict={}))
+        reports = []
+
+        def receiver(sender, queries, **kwargs):
+            reports.append(queries)
+
+        repeated_queries.connect(receiver)
+        try:
+            middleware.process_request(request)
+            for pk in range(3):
+                cursor.execute('SELECT * FROM t WHERE id = %s', [pk])
+            cursor.execute('SELECT * FROM other')
+            with self.assertLogs(level='WARNING'):
+                middleware.process_response(request, HttpResponse())
+        finally:
+            repeated_queries.disconnect(receiver)
+
+        self.assertEqual(reports, [{'SELECT * FROM t WHERE id = ?': 3}])
+        self.assertIsNone(connection_state.query_counts)
+
+
+class QueryBudgetTestCase(SimpleTestCase):
+
+    def run_queries(self, path, count):
+        middleware = MultiDBMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get(path)
+        cursor = RestrictedCursorWrapper(mock.Mock(rowcount=1), mock.Mock(alias='default', settings_dict={}))
+        middleware.process_request(request)
+        try:
+            for pk in range(count):
+                cursor.execute('SELECT * FROM t WHERE id = %s', [pk])
+        finally:
+            middleware.process_response(request, HttpResponse())
+
+    @mock.patch.object(config, 'QUERY_BUDGETS', {'default': (2, None, 'raise')})
+    @mock.patch.object(config, 'DATABASE_MAPPINGS', {None: ['default']})
+    def test_alias_budget_raises(self):
+        self.run_queries('/', 2)
+        with self.assertRaises(QueryBudgetExceeded):
+            self.run_queries('/', 3)
+        self.assertIsNone(connection_state.budgets)
+
+    @mock.patch.object(config, 'PATH_BUDGETS', {'/reports/': (None, 0, 'log'), '/reports/big/': (5, None, 'warn')})
+    @mock.patch.object(config, 'PATH_BUDGET_PATHS', PathRouter({
+        '/reports/': ['/reports/'], '/reports/big/': ['/reports/big/'],
+    }))
+    @mock.patch.object(config, 'DATABASE_MAPPINGS', {None: ['default']})
+    def test_path_budgets(self):
+        # The time budget is exceeded by the first query, and logged once.
+        with self.assertLogs(level='WARNING') as logs:
+            self.run_queries('/reports/', 3)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('/reports/', logs.output[0])
+
+        # The longest prefix applies.
+        with self.assertWarns(QueryBudgetWarning):
+            self.run_queries('/reports/big/', 7)
+
+        # Other paths have no budget.
+        self.run_queries('/other/', 3)
+
+    def test_options(self):
+        self.assertEqual(config._get_limits({'OPTIONS': {'QUERY_BUDGET': 3}}), (3, None, 'raise'))
+        self.assertEqual(
+            config._get_limits({'QUERY_TIME_BUDGET': 1, 'OPTIONS': {'QUERY_BUDGET_MODE': 'log'}}),
+            (None, 1, 'log'),
+        )
+        self.assertIsNone(config._get_limits({'OPTIONS': {}}))
+
+
+class ResultCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = ResultCache(cache='default', local_timeout=60)
+        self.cache.cache.clear()
+        patcher = mock.patch('multidb.cursors.result_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_cursor(self, alias, in_atomic_block=False, name='app'):
+        cursor = mock.Mock(rowcount=2, description=(('id', None, None, None, None, None, None),))
+        cursor.fetchmany.return_value = [(1,), (2,)]
+        db = mock.Mock(alias=alias, settings_dict={'NAME': name}, in_atomic_block=in_atomic_block)
+        db.features.empty_fetchmany_value = []
+        db.get_autocommit.return_value = True
+        with mock.patch.object(config, 'READ_ONLY_DATABASES_SET', {'replica', 'other_replica'}):
+            return RestrictedCursorWrapper(cursor, db)
+
+    def test_tables(self):
+        self.assertEqual(
+            get_read_tables('SELECT * FROM "app_a" INNER JOIN "app_b" ON ("app_a"."id" = "app_b"."a_id")'),
+            {'app_a', 'app_b'},
+        )
+        self.assertIsNone(get_read_tables('SELECT * FROM "app_a" WHERE "id" = %s FOR UPDATE'))
+        self.assertIsNone(get_read_tables('SELECT 1'))
+        self.assertEqual(get_written_tables('UPDATE "app_a" SET "x" = %s'), {'app_a'})
+        self.assertEqual(get_written_tables('INSERT INTO `app_b` (`x`) VALUES (%s)'), {'app_b'})
+        self.assertIsNone(get_written_tables('ALTER TABLE "app_a" ADD COLUMN "y" integer'))
+        self.assertEqual(get_written_tables('BEGIN'), frozenset())
+
+    def test_read_through(self):
+        replica = self.make_cursor('replica')
+        sql = 'SELECT "id" FROM "app_a" WHERE "x" = %s'
+
+        replica.execute(sql, [1])
+        self.assertEqual(replica.fetchall(), [(1,), (2,)])
+        replica.execute(sql, [1])
+        self.assertEqual(replica.fetchmany(1), [(1,)])
+        self.assertEqual(replica.fetchmany(5), [(2,)])
+        self.assertEqual(replica.fetchmany(5), [])
+        self.assertEqual(replica.cursor.execute.call_count, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # Different params are a different entry.
+        replica.execute(sql, [2])
+        self.assertEqual(replica.cursor.execute.call_count, 2)
+
+        # A write to the table makes the entries stale.
+        self.make_cursor('default').execute('UPDATE "app_a" SET "x" = %s', [3])
+        replica.execute(sql, [1])
+        self.assertEqual(replica.cursor.execute.call_count, 3)
+
+    def test_databases_are_kept_apart(self):
+        replica = self.make_cursor('replica')
+        other_replica = self.make_cursor('other_replica', name='other')
+        other_replica.cursor.fetchmany.return_value = [(3,)]
+        sql = 'SELECT "id" FROM "app_a"'
+
+        # The same query on another database has its own results.
+        for _ in range(2):
+            replica.execute(sql)
+            other_replica.execute(sql)
+            self.assertEqual(replica.fetchall(), [(1,), (2,)])
+            self.assertEqual(other_replica.fetchall(), [(3,)])
+        self.assertEqual((replica.cursor.execute.call_count, other_replica.cursor.execute.call_count), (1, 1))
+
+        # And writes only make the results of their own database stale.
+        self.make_cursor('other', name='other').execute('UPDATE "app_a" SET "x" = %s', [3])
+        replica.execute(sql)
+        other_replica.execute(sql)
+        self.assertEqual((replica.cursor.execute.call_count, other_replica.cursor.execute.call_count), (1, 2))
+
+        # Unless the databases are in the same replica group.
+        self.assertEqual(
+            get_replica_group({'NAME': 'replica', 'OPTIONS': {'REPLICA_GROUP': 'app'}}),
+            get_replica_group({'NAME': 'app'}),
+        )
+
+    def test_recent_writes_are_not_cached(self):
+        replica = self.make_cursor('replica')
+        sql = 'SELECT "id" FROM "app_a"'
+        self.make_cursor('default').execute('UPDATE "app_a" SET "x" = %s', [3])
+        # The replica may not have replicated the write yet.
+        for _ in range(2):
+            replica.execute(sql)
+        self.assertEqual(replica.cursor.execute.call_count, 2)
+
+        # Once it is known to have replicated it.
+        table = ReplicaLagTable(mappings={}, max_lags={})
+        table.publish({'replica': 0.0}, sampled=time.time() + 1)
+        with mock.patch('multidb.results.replica_lag', table):
+            for _ in range(2):
+                replica.execute(sql)
+        self.assertEqual(replica.cursor.execute.call_count, 3)
+
+        # Or after the lag window.
+        self.make_cursor('default').execute('UPDATE "app_a" SET "x" = %s', [4])
+        self.cache.lag_window = 0.01
+        time.sleep(0.02)
+        for _ in range(2):
+            replica.execute(sql)
+        self.assertEqual(replica.cursor.execute.call_count, 4)
+
+    def test_invalidated_after_commit(self):
+        replica = self.make_cursor('replica')
+        sql = 'SELECT "id" FROM "app_a"'
+        replica.execute(sql)
+
+        self.make_cursor('default', in_atomic_block=True).execute('DELETE FROM "app_a"')
+        replica.execute(sql)
+        self.assertEqual(replica.cursor.execute.call_count, 1)
+
+        self.commit('default')
+        replica.execute(sql)
+        self.assertEqual(replica.cursor.execute.call_count, 2)
+
+    def test_rolled_back_writes_are_ignored(self):
+        replica = self.make_cursor('replica')
+        sql = 'SELECT "id" FROM "app_a"'
+        replica.execute(sql)
+
+        self.make_cursor('default', in_atomic_block=True).execute('DELETE FROM "app_a"')
+        self.rollback('default')
+        self.commit('default')
+        replica.execute(sql)
+        self.assertEqual(replica.cursor.execute.call_count, 1)
+
+    def test_transactions_of_each_database(self):
+        replica = self.make_cursor('replica')
+        sql = 'SELECT "id" FROM "app_a"'
+        replica.execute(sql)
+
+        # Transactions on two databases write to the tables.
+        self.make_cursor('default', in_atomic_block=True).execute('DELETE FROM "app_a"')
+        self.make_cursor('other', in_atomic_block=True).execute('DELETE FROM "app_b"')
+
+        # Committing or rolling back one of them leaves the other's pending.
+        self.commit('other')
+        self.rollback('other')
+        replica.execute(sql)
+        self.assertEqual(replica.cursor.execute.call_count, 1)
+
+        self.commit('default')
+        replica.execute(sql)
+        self.assertEqual(replica.cursor.execute.call_count, 2)
+
+    def commit(self, alias):
+        decorators.committed(lambda db: None, self.cache)(mock.Mock(alias=alias))
+
+    def rollback(self, alias):
+        decorators.rolled_back(lambda db: None, self.cache)(mock.Mock(alias=alias))
+
+    def test_primary_is_not_cached(self):
+        primary = self.make_cursor('default')
+        primary.execute('SELECT "id" FROM "app_a"')
+        primary.execute('SELECT "id" FROM "app_a"')
+        self.assertEqual(primary.cursor.execute.call_count, 2)
+
+
+class SluggishCacheTestCase(SimpleTestCase):
+
+    def make_backend(self, delay=0):
+        backend = mock.Mock()
+        values = {}
+
+        def get(key, default=None, version=None):
+            time.sleep(delay)
+            return values.get((key, version), default)
+
+        def set(key, value, timeout=None, version=None):
+            values[(key, version)] = value
+
+        backend.get.side_effect = get
+        backend.set.side_effect = set
+        return backend
+
+    def test_bounded(self):
+        cache = SluggishCache(self.make_backend(), max_size=2)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, key.upper())
+        self.assertEqual(list(cache._values), [('b', None), ('c', None)])
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(list(cache._values), [('c', None), ('a', None)])
+
+    def test_versions_and_instances(self):
+        backend = self.make_backend()
+        cache = SluggishCache(backend)
+        cache.set('key', 1, version=1)
+        cache.set('key', 2, version=2)
+        self.assertEqual((cache.get('key', version=1), cache.get('key', version=2)), (1, 2))
+        self.assertIsNone(SluggishCache(mock.Mock(**{'get.return_value': None})).get('key'))
+
+    def test_single_flight(self):
+        backend = self.make_backend(delay=0.05)
+        cache = SluggishCache(backend, delay=0)
+        cache.set('key', 'old')
+        backend.set('key', 'new')
+        backend.get.reset_mock()
+        results = []
+
+        threads = [threading.Thread(target=lambda: results.append(cache.get('key'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(backend.get.call_count, 1)
+        self.assertIn('new', results)
+        self.assertEqual(set(results), {'old', 'new'})
+
+    def test_refresh_ahead(self):
+        backend = self.make_backend()
+        cache = SluggishCache(backend, delay=0.1, fetch_timeout=0.05)
+        self.addCleanup(cache.stop_refreshing)
+        backend.set('key', 'old')
+        cache.refresh_ahead('key')
+        time.sleep(0.1)
+
+        backend.set('key', 'new')
+        time.sleep(0.15)
+        backend.get.reset_mock()
+        self.assertEqual(cache.get('key'), 'new')
+        self.assertFalse(backend.get.called)
+
+        # Failing or slow backends leave the last known value in place.
+        backend.get.side_effect = Exception('down')
+        with self.assertLogs(level='WARNING'):
+            time.sleep(0.25)
+        self.assertEqual(cache._get('key'), 'new')
+
+
+class ReadOnlyScopeTestCase(SimpleTestCase):
+
+    databases = {'default'}
+
+    def tearDown(self):
+        for scope in (CLUSTER, HOST):
+            read_only_mode.disable(scope)
+        read_only_mode.disable(alias='default')
+
+    def test_scopes(self):
+        self.assertFalse(read_only_mode)
+        read_only_mode.enable(CLUSTER)
+        self.assertTrue(read_only_mode)
+        self.assertFalse(read_only_mode.is_enabled(HOST))
+        read_only_mode.disable(CLUSTER)
+        self.assertFalse(read_only_mode)
+
+    def test_alias_scope(self):
+        cursor = RestrictedCursorWrapper(mock.Mock(rowcount=1), mock.Mock(alias='default', settings_dict={}))
+        read_only_mode.enable(alias='default')
+        self.assertFalse(read_only_mode)
+        cursor.execute('SELECT 1')
+        with self.assertRaises(ReadOnlyError):
+            cursor.execute('UPDATE t SET x = 1')
+
+    def test_pool_aliases_have_no_scope(self):
+        keys = read_only_mode.get_keys()
+        self.assertIn('multidb.readonly.alias:default', keys)
+
+        pool = TemporaryConnectionPool('scope', max_size=1)
+        self.addCleanup(pool.close)
+        with pool.get() as alias:
+            read_only_mode.enable(alias=alias)
+            self.addCleanup(read_only_mode.disable, alias=alias)
+            self.assertEqual(read_only_mode.get_keys(), keys)
+            self.assertEqual(read_only_mode.get_read_only_aliases(), frozenset())
+
+    @mock.patch.object(config, 'DATABASE_MAPPINGS', {None: ['default']})
+    def test_request_snapshot(self):
+        middleware = MultiDBMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().post('/')
+        form = modelform_factory(ContentType, fields=['app_label', 'model'])({'app_label': 'a', 'model': 'b'})
+
+        read_only_mode.enable(alias='default')
+        middleware.process_request(request)
+        try:
+            # Changes during the request don't apply until the next one.
+            read_only_mode.enable(CLUSTER)
+            read_only_mode.disable(alias='default')
+            self.assertFalse(connection_state.read_only)
+            self.assertTrue(connection_state.is_alias_read_only('default'))
+            self.assertTrue(form.is_valid())
+        finally:
+            middleware.process_response(request, HttpResponse())
+
+        self.assertTrue(connection_state.read_only)
+        self.assertFalse(connection_state.is_alias_read_only('default'))
+
+    def check_notifier(self, notifier):
+        notified = threading.Event()
+        notifier.listen(notified.set)
+        try:
+            time.sleep(0.05)
+            notifier.notify()
+            self.assertTrue(notified.wait(1))
+        finally:
+            notifier.stop()
+
+    def test_file_notifier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_notifier(FileNotifier(os.path.join(directory, 'readonly'), interval=0.01))
+
+            # The path can be set in the settings, and is needed.
+            with mock.patch.object(config, 'READ_ONLY_NOTIFY_PATH', os.path.join(directory, 'setting')):
+                self.assertEqual(FileNotifier().path, os.path.join(directory, 'setting'))
+            with self.assertRaises(ImproperlyConfigured):
+                FileNotifier()
+
+    def test_notifier_is_opt_in(self):
+        self.assertIsNone(get_notifier())
+
+    def test_unix_socket_notifier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_notifier(UnixSocketNotifier(directory))
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+
+    databases = {'default'}
+
+    def test_stress(self):
+        pool = TemporaryConnectionPool('stress', max_size=4, timeout=10)
+        self.addCleanup(pool.close)
+        lock = threading.Lock()
+        active = [0, 0]
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(25):
+                    with pool.get() as alias, connection_state.force(alias):
+                        with lock:
+                            active[0] += 1
+                            active[1] = max(active)
+                        with connections[alias].cursor() as cursor:
+                            cursor.execute('SELECT 1')
+                            self.assertEqual(cursor.fetchone(), (1,))
+                        with lock:
+                            active[0] -= 1
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=worker) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(active[1], 4)
+        self.assertLessEqual(pool.size, 4)
+        self.assertEqual(len(pool.idle), pool.size)
+
+    def test_timeout(self):
+        pool = TemporaryConnectionPool('timeout', max_size=1)
+        self.addCleanup(pool.close)
+        with pool.get():
+            with self.assertRaises(PoolTimeout):
+                with pool.get(timeout=0.01):
+                    pass
+        with pool.get(timeout=0.01):
+            pass
+
+    def test_idle_eviction(self):
+        pool = TemporaryConnectionPool('idle', min_size=1, max_idle=0.01)
+        self.addCleanup(pool.close)
+        pool.fill()
+        with pool.get() as first, pool.get() as second:
+            pass
+        time.sleep(0.02)
+        pool.evict_idle()
+        self.assertEqual(pool.size, 1)
+        # The connection released first has been idle for longest.
+        self.assertEqual([alias for alias, released in pool.idle], [first])
+        self.assertEqual(list(pool.slots), [second])
+
+    def test_leak_detection(self):
+        pool = TemporaryConnectionPool('leak', leak_threshold=0.01)
+        self.addCleanup(pool.close)
+        with self.assertLogs(level='WARNING') as logs:
+            with pool.get():
+                time.sleep(0.02)
+                pool.report_leaks()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('test_leak_detection', logs.output[0])
+
+    def test_reuse(self):
+        pool = TemporaryConnectionPool('reuse', max_size=1, reuse=True, max_lifetime=60)
+        self.addCleanup(pool.close)
+
+        def use(sql='SELECT 1', commit=True):
+            with pool.get() as alias, connection_state.force(alias):
+                connection = connections[alias]
+                connection.set_autocommit(commit)
+                with connection.cursor() as cursor:
+                    cursor.execute(sql)
+                return connection.connection
+
+        first = use()
+        thread = threading.Thread(target=lambda: self.assertIs(use(), first))
+        thread.start()
+        thread.join()
+
+        # Open transactions are rolled back on release.
+        use('CREATE TEMPORARY TABLE reused (id integer)')
+        use('INSERT INTO reused VALUES (1)', commit=False)
+        with pool.get() as alias, connection_state.force(alias):
+            self.assertTrue(connections[alias].get_autocommit())
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT COUNT(*) FROM reused')
+                self.assertEqual(cursor.fetchone(), (0,))
+
+        # Connections are closed, to be reopened, after max_lifetime.
+        pool.max_lifetime = 0
+        [wrapper] = pool.wrappers.values()
+        with connection_state.force(None), mock.patch.object(wrapper, 'close') as close:
+            use()
+        close.assert_called_once_with()
+
+    def test_closing_does_not_hold_the_lock(self):
+        pool = TemporaryConnectionPool('unlocked', reuse=True)
+        self.addCleanup(pool.close)
+        with pool.get() as alias:
+            wrapper = pool.wrappers[alias]
+        pool.max_idle = 0
+
+        def acquire():
+            if pool.lock.acquire(timeout=1):
+                acquired.append(True)
+                pool.lock.release()
+
+        def close():
+            # Other threads can use the pool while a slow connection closes.
+            thread = threading.Thread(target=acquire)
+            thread.start()
+            thread.join()
+
+        acquired = []
+
+        with connection_state.force(None), mock.patch.object(wrapper, 'close', side_effect=close) as mock_close:
+            pool.evict_idle()
+        mock_close.assert_called_once_with()
+        self.assertEqual(acquired, [True])
+        self.assertEqual(list(pool.slots), [alias])
+
+    def test_slots(self):
+        databases = set(connections.databases)
+        pool = TemporaryConnectionPool('slot', max_size=2)
+        self.assertEqual(set(connections.databases) - databases, {'slot1', 'slot2'})
+
+        # Each slot has its own copy of the settings.
+        connections.databases['slot1']['OPTIONS']['timeout'] = 1
+        self.assertNotIn('timeout', connections.databases['slot2']['OPTIONS'])
+        self.assertNotIn('timeout', connections.databases['default']['OPTIONS'])
+
+        pool.close()
+        self.assertEqual(set(connections.databases), databases)
+
+    def test_many_checkouts(self):
+        databases = len(connections.databases)
+        pool = TemporaryConnectionPool('many', max_idle=0)
+        self.addCleanup(pool.close)
+        for _ in range(50):
+            with pool.get(), pool.get(), pool.get():
+                for _ in range(50):
+                    with pool.get():
+                        pass
+            pool.evict_idle()
+        self.assertEqual(pool.slot_count, 4)
+        self.assertEqual(len(connections.databases), databases + 4)
+        self.assertFalse(any(hasattr(connections._connections, alias) for alias in pool.slots))
+
+
+SLOW_SQL = 'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 100000000) SELECT COUNT(*) FROM c'
+
+
+class FanOutTestCase(SimpleTestCase):
+
+    databases = {'default'}
+
+    def setUp(self):
+        pool = TemporaryConnectionPool('fanout', max_size=3, timeout=10)
+        self.addCleanup(pool.close)
+        self.fan_out = FanOut(pool)
+        self.addCleanup(self.fan_out.close)
+
+    def query(self, sql):
+        def run():
+            with connections['default'].cursor() as cursor:
+                cursor.execute(sql)
+                return connection_state.alias, cursor.fetchone()[0]
+        return run
+
+    def test_gather(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def together(value):
+            def run():
+                # Only returns if the tasks run at the same time.
+                barrier.wait()
+                return value, connection_state.alias
+            return run
+
+        results = self.fan_out.gather(together(1), together(2), together(3))
+        self.assertEqual([value for value, alias in results], [1, 2, 3])
+        # Each task is routed to its own connection, and the caller's routing is unchanged.
+        self.assertEqual({alias for value, alias in results}, {'fanout1', 'fanout2', 'fanout3'})
+
+        self.assertEqual(self.fan_out.gather(self.query('SELECT 1'), self.query('SELECT 2')), [
+            (mock.ANY, 1), (mock.ANY, 2),
+        ])
+        self.assertEqual(connection_state.alias, config.FALLBACK_DATABASE)
+
+    def test_timeout(self):
+        started = time.monotonic()
+        with self.assertRaises(TaskTimeout):
+            self.fan_out.gather(self.query('SELECT 1'), self.query(SLOW_SQL), timeout=0.1)
+        self.assertLess(time.monotonic() - started, 5)
+
+        results = self.fan_out.gather(self.query(SLOW_SQL), self.query('SELECT 1'), timeout=0.1, return_exceptions=True)
+        self.assertIsInstance(results[0], TaskTimeout)
+        self.assertEqual(results[1][1], 1)
+
+    def test_cancellation(self):
+        def fail():
+            raise ValueError('failed')
+
+        slow = self.fan_out.submit(self.query(SLOW_SQL))
+        with self.assertRaises(ValueError):
+            self.fan_out.gather(fail)
+        slow.cancel()
+        with self.assertRaises(TaskCancelled):
+            slow.future.result(timeout=5)
+
+        # The rest are cancelled when one fails, and the workers are freed.
+        started = time.monotonic()
+        with self.assertRaises(ValueError):
+            self.fan_out.gather(self.query(SLOW_SQL), fail)
+        self.fan_out.close()
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_budgets(self):
+        budgets = connection_state.budgets = RequestBudgets(QueryBudget('/', max_queries=10))
+        query_counts = connection_state.query_counts = {}
+        self.addCleanup(connection_state.end_request)
+
+        self.fan_out.gather(self.query('SELECT 1'), self.query('SELECT 2'), self.query('SELECT 3'))
+        # Each task counts its queries on its own, and they are added up after.
+        self.assertEqual(budgets.path_budget.queries, 3)
+        self.assertEqual(sum(query_counts.values()), 3)
+
+
+class AsyncConnectionPoolTestCase(SimpleTestCase):
+
+    databases = {'default'}
+
+    def setUp(self):
+        self.pool = AsyncConnectionPool('async', max_size=2)
+        self.addCleanup(self.pool.close)
+
+    def query(self, sql):
+        with connections['default'].cursor() as cursor:
+            cursor.execute(sql)
+            return connection_state.alias, cursor.fetchone()[0]
+
+    def test_shared_connections(self):
+        active = [0, 0]
+        ticks = []
+
+        async def request(number):
+            async with self.pool.acquire() as connection:
+                active[0] += 1
+                active[1] = max(active)
+                alias, value = await connection.run(self.query, f'SELECT {number}')
+                await asyncio.sleep(0.01)
+                active[0] -= 1
+            # Routed to the pooled connection only within run().
+            self.assertEqual(alias, connection.alias)
+            self.assertEqual(connection_state.alias, config.FALLBACK_DATABASE)
+            return value
+
+        async def tick():
+            # The event loop keeps running while coroutines wait for connections.
+            while len(ticks) < 5:
+                ticks.append(None)
+                await asyncio.sleep(0.005)
+
+        async def main():
+            results = await asyncio.gather(*[request(number) for number in range(10)], tick())
+            return results[:-1]
+
+        self.assertEqual(asyncio.run(main()), list(range(10)))
+        self.assertEqual(active[1], 2)
+        self.assertEqual(len(ticks), 5)
+        self.assertEqual(self.pool.pool.size, 2)
+
+    def test_timeout(self):
+        async def main():
+            async with self.pool.acquire(), self.pool.acquire():
+                with self.assertRaises(PoolTimeout):
+                    async with self.pool.acquire(timeout=0.01):
+                        pass
+            async with self.pool.acquire(timeout=0.01):
+                pass
+
+        asyncio.run(main())
+
+    def test_cancellation(self):
+        async def main():
+            async with self.pool.acquire() as connection:
+                task = asyncio.ensure_future(connection.run(self.query, SLOW_SQL))
+                await asyncio.sleep(0.1)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            # The connection has been interrupted and returned to the pool.
+            async with self.pool.acquire(timeout=1) as connection:
+                return await connection.run(self.query, 'SELECT 1')
+
+        started = time.monotonic()
+        self.assertEqual(asyncio.run(main())[1], 1)
+        self.assertLess(time.monotonic() - started, 5)
+
+
+class WarmUpTestCase(SimpleTestCase):
+
+    databases = {'default'}
+
+    def test_aliases(self):
+        self.assertEqual(get_aliases(False), [])
+        self.assertEqual(get_aliases(['default']), ['default'])
+        self.assertIn('default', get_aliases(True))
+        # Not the aliases of pools.
+        pool = TemporaryConnectionPool('prewarm_', max_size=2)
+        self.addCleanup(pool.close)
+        self.assertNotIn('prewarm_1', get_aliases(True))
+
+    def test_warm_up(self):
+        pool = TemporaryConnectionPool('warm', min_size=2, reuse=True)
+        self.addCleanup(pool.close)
+        sent = []
+
+        def receiver(**kwargs):
+            sent.append(kwargs)
+
+        connections_warmed.connect(receiver)
+        self.addCleanup(connections_warmed.disconnect, receiver)
+        with self.assertLogs(level='WARNING'):
+            warm_up(['default', 'missing'])
+
+        [kwargs] = sent
+        self.assertEqual(set(kwargs['timings']), {'default', 'missing'})
+        self.assertEqual(set(kwargs['pool_timings']), {'warm'})
+        self.assertEqual(set(kwargs['errors']), {'missing'})
+
+        # The pool's connections have been opened.
+        self.assertEqual(pool.size, 2)
+        with connection_state.force(None):
+            self.assertTrue(all(wrapper.connection is not None for wrapper in pool.wrappers.values()))
+
+    def test_keepalive(self):
+        pool = TemporaryConnectionPool('keepalive', min_size=2, reuse=True)
+        self.addCleanup(pool.close)
+        pool.fill()
+        # Set after filling the pool, so it doesn't start checking them in the background.
+        pool.keepalive = 0.01
+        idle = list(pool.idle)
+        time.sleep(0.02)
+
+        # Connections that don't respond are closed, to be reopened when used.
+        first, second = pool.wrappers.values()
+        with connection_state.force(None), mock.patch.object(first, 'is_usable', return_value=False), \
+                mock.patch.object(first, 'close') as close:
+            pool.ping_idle()
+        close.assert_called_once_with()
+        self.assertEqual(list(pool.idle), idle)
+
+        # They aren't checked again until they have been idle for keepalive seconds.
+        with connection_state.force(None), mock.patch.object(second, 'is_usable') as is_usable:
+            pool.ping_idle()
+        is_usable.assert_not_called()